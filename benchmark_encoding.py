@@ -0,0 +1,108 @@
+"""
+A script to compare frame encoding profiles.
+
+For each profile in src.utils.ENCODING_PROFILES it reports the encode time
+and payload size, and, if an API token is given, the end-to-end latency of
+describing the encoded frame with the model.
+
+$ python benchmark_encoding.py --images /path/to/image.jpg
+$ python benchmark_encoding.py --live --model 1.5_flash --api_token $(cat .api_token)
+"""
+
+import argparse
+import statistics
+import time
+
+import cv2
+import google.generativeai as genai
+
+from src.camera import Camera
+from src.model import Model, ModelChoices
+from src.utils import ENCODING_PROFILES, convert_frame_to_blob
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--profiles",
+        type=str,
+        nargs="+",
+        choices=list(ENCODING_PROFILES),
+        default=list(ENCODING_PROFILES),
+    )
+    parser.add_argument("--repeat", type=int, default=20, help="encodes per frame")
+    parser.add_argument("--model", type=ModelChoices, choices=ModelChoices.values())
+    parser.add_argument("--api_token", type=str, default=None)
+
+    mutually_exclusive_group = parser.add_mutually_exclusive_group(required=True)
+    mutually_exclusive_group.add_argument("--images", type=str, nargs="+", default=None)
+    mutually_exclusive_group.add_argument("--live", action="store_true")
+
+    return parser.parse_args()
+
+
+def load_frames(args):
+    if args.live:
+        camera = Camera()
+        frame = camera.read_frame()
+        camera.close()
+        return [frame]
+
+    frames = []
+    for path in args.images:
+        frame = cv2.imread(path)
+        assert frame is not None, f"Could not read image {path}"
+        frames.append(frame)
+    return frames
+
+
+def benchmark_profile(profile, frames, repeat, model=None):
+    encode_times = []
+    payload_sizes = []
+    request_times = []
+    for frame in frames:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            blob = convert_frame_to_blob(frame, profile)
+            encode_times.append(time.perf_counter() - start)
+        payload_sizes.append(len(blob.data))
+
+        if model is not None:
+            start = time.perf_counter()
+            model.describe_image_from_blob(blob)
+            request_times.append(time.perf_counter() - start)
+
+    return {
+        "encode_ms": 1000 * statistics.median(encode_times),
+        "payload_kb": statistics.mean(payload_sizes) / 1024,
+        "request_s": statistics.median(request_times) if request_times else None,
+    }
+
+
+def main():
+    args = parse_args()
+
+    model = None
+    if args.api_token:
+        assert args.model, "--model is required to measure request latency"
+        genai.configure(api_key=args.api_token)
+        model = Model(args.model)
+
+    frames = load_frames(args)
+    print(
+        f"{'profile':<10} {'encode (ms)':>12} {'payload (kB)':>13} {'request (s)':>12}"
+    )
+    for name in args.profiles:
+        results = benchmark_profile(ENCODING_PROFILES[name], frames, args.repeat, model)
+        request = (
+            f"{results['request_s']:>12.2f}"
+            if results["request_s"] is not None
+            else f"{'-':>12}"
+        )
+        print(
+            f"{name:<10} {results['encode_ms']:>12.2f} {results['payload_kb']:>13.1f} {request}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+"""
+A script to measure the throughput of the full capture -> model -> database
+pipeline, offline.
+
+Frames are replayed from a video file or an image directory, the model is
+replaced by FakeModel and the database by an in-memory store, and the
+runner's stages run through the same Pipeline as in twistd.py. It reports
+frames per second, per-stage latency percentiles and memory use.
+
+$ python benchmark_pipeline.py --video /path/to/doorstep.mp4 --frames 200 --latency 1.5
+$ python benchmark_pipeline.py --images /path/to/snapshots --store mongomock --batch_size 4
+$ python benchmark_pipeline.py --video /path/to/doorstep.mp4 --store sqlite
+"""
+
+import argparse
+import resource
+import statistics
+import time
+import tracemalloc
+from collections import defaultdict
+
+from twisted.internet import defer, reactor
+
+from src.cache import SceneCache
+from src.cascade import ModelCascade
+from src.detector import LocalDetector
+from src.fakes import FakeModel, InMemoryClient
+from src.inference import InferenceEngine
+from src.roi import RegionCropper
+from src.services.pipeline import Pipeline, TickDropped
+from src.services.runner import CCTVLoggerRunner
+from src.sources import ImageDirectorySource, VideoFileSource
+from src.store import open_store
+from src.utils import ENCODING_PROFILES
+
+# --store -> store URI, besides the "memory" InMemoryClient
+STORE_URIS = {"mongomock": "mongomock://", "sqlite": "sqlite:///:memory:"}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--video", type=str, default=None)
+    source.add_argument("--images", type=str, default=None, help="image directory")
+    parser.add_argument("--fps", type=float, default=1.0, help="fps of --images")
+    parser.add_argument(
+        "--speed", type=float, default=None, help="replay speed (default: unpaced)"
+    )
+    parser.add_argument("--frames", type=int, default=100, help="ticks to run")
+
+    parser.add_argument("--latency", type=float, default=1.0, help="model latency (s)")
+    parser.add_argument("--jitter", type=float, default=0.2)
+    parser.add_argument(
+        "--fast_latency",
+        type=float,
+        default=None,
+        help="cascade from a fast model with this latency to the --latency one",
+    )
+    parser.add_argument("--error_rate", type=float, default=0.0)
+    parser.add_argument(
+        "--store", choices=["memory", "mongomock", "sqlite"], default="memory"
+    )
+    parser.add_argument("--rpm", type=float, default=None, help="requests per minute")
+    parser.add_argument("--deadline", type=float, default=60.0)
+    parser.add_argument("--retries", type=int, default=3)
+    parser.add_argument(
+        "--hedge", type=float, default=None, help="hedging quantile, e.g. 0.95"
+    )
+
+    parser.add_argument("--motion_threshold", type=float, default=None)
+    parser.add_argument("--cache", action="store_true", help="enable the scene cache")
+    parser.add_argument(
+        "--crop", action="store_true", help="send only the changed regions"
+    )
+    parser.add_argument(
+        "--detect", action="store_true", help="gate frames on the local detector"
+    )
+    parser.add_argument(
+        "--profile", choices=list(ENCODING_PROFILES), default="lossless"
+    )
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--concurrency", type=int, default=1, help="infer workers")
+    parser.add_argument(
+        "--in_flight", type=int, default=None, help="max ticks in flight"
+    )
+    return parser.parse_args()
+
+
+def percentiles(values):
+    if not values:
+        return "-"
+    ordered = sorted(values)
+
+    def at(q):
+        return 1000 * ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    return f"p50 {at(0.5):8.1f}  p90 {at(0.9):8.1f}  p99 {at(0.99):8.1f}"
+
+
+class StageTimer:
+    "Wraps stage callables to record how long each call takes"
+
+    def __init__(self):
+        self.durations = defaultdict(list)
+
+    def wrap(self, name, func):
+        def timed(item):
+            start = time.perf_counter()
+            try:
+                return func(item)
+            finally:
+                self.durations[name].append(time.perf_counter() - start)
+
+        return timed
+
+
+def build_runner(args):
+    if args.video:
+        source = VideoFileSource(args.video, speed=args.speed, loop=True)
+    else:
+        source = ImageDirectorySource(
+            args.images, fps=args.fps, speed=args.speed, loop=True
+        )
+    if args.store == "memory":
+        client = InMemoryClient()
+    else:
+        client = open_store(STORE_URIS[args.store])
+
+    def engine(latency):
+        return InferenceEngine(
+            FakeModel(latency=latency, jitter=args.jitter, error_rate=args.error_rate),
+            max_in_flight=args.concurrency,
+            requests_per_minute=args.rpm,
+            deadline=args.deadline,
+            max_retries=args.retries,
+            backoff=0.1,
+            hedge_quantile=args.hedge,
+        )
+
+    model = engine(args.latency)
+    if args.fast_latency is not None:
+        model = ModelCascade(engine(args.fast_latency), model)
+    return CCTVLoggerRunner(
+        camera=source,
+        model=model,
+        client=client,
+        motion_threshold=args.motion_threshold,
+        scene_cache=SceneCache() if args.cache else None,
+        region_cropper=RegionCropper() if args.crop else None,
+        local_detector=LocalDetector() if args.detect else None,
+        encoding_profile=ENCODING_PROFILES[args.profile],
+        batch_size=args.batch_size,
+    )
+
+
+def drive(pipeline, frames, results):
+    """
+    Keeps the pipeline full until `frames` ticks completed.
+
+    :return: Deferred firing once the last tick completed
+    """
+    done = defer.Deferred()
+    state = {"submitted": 0, "completed": 0}
+
+    def failed(failure):
+        key = "dropped" if failure.check(TickDropped) else "failed"
+        results[key] += 1
+
+    def completed(_, submitted_at):
+        state["completed"] += 1
+        results["tick"].append(time.perf_counter() - submitted_at)
+        if state["completed"] == frames:
+            done.callback(None)
+        else:
+            submit()
+
+    def submit():
+        while (
+            pipeline.in_flight < pipeline.max_in_flight and state["submitted"] < frames
+        ):
+            state["submitted"] += 1
+            deferred = pipeline.submit()
+            deferred.addErrback(failed)
+            deferred.addCallback(completed, time.perf_counter())
+
+    submit()
+    return done
+
+
+def main():
+    args = parse_args()
+    runner = build_runner(args)
+    timer = StageTimer()
+    workers = {"infer": args.concurrency}
+    pipeline = Pipeline(
+        [
+            (name, timer.wrap(name, func), workers.get(name, 1))
+            for name, func in runner.stages()
+        ],
+        queue_size=max(2, args.concurrency),
+        max_in_flight=args.in_flight or args.concurrency + 1,
+    )
+    results = {"tick": [], "failed": 0, "dropped": 0}
+
+    tracemalloc.start()
+    pipeline.startService()
+    start = time.perf_counter()
+
+    def finished(_):
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        report(args, runner, timer, results, elapsed, peak)
+        pipeline.stopService().addBoth(lambda _: reactor.stop())
+
+    reactor.callWhenRunning(
+        lambda: drive(pipeline, args.frames, results).addBoth(finished)
+    )
+    reactor.run()
+
+
+def report(args, runner, timer, results, elapsed, peak_traced):
+    completed = len(results["tick"]) - results["failed"] - results["dropped"]
+    print(f"ticks:      {len(results['tick'])} in {elapsed:.1f}s")
+    print(f"throughput: {completed / elapsed:.2f} frames/s")
+    print(
+        f"described:  {runner.described_frames}  skipped: {runner.skipped_frames}  "
+        f"failed: {results['failed']}  dropped: {results['dropped']}"
+    )
+    if runner.scene_cache is not None:
+        print(f"cache:      {runner.scene_cache.stats()}")
+    if isinstance(runner.model, ModelCascade):
+        print(f"cascade:    {runner.model.stats()}")
+    print("latency (ms):")
+    for name, durations in timer.durations.items():
+        print(
+            f"  {name:<8} {percentiles(durations)}  (mean {1000 * statistics.mean(durations):.1f})"
+        )
+    print(f"  {'tick':<8} {percentiles(results['tick'])}")
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(
+        f"memory:     peak traced {peak_traced / 2**20:.1f} MiB, max RSS {max_rss / 1024:.1f} MiB"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,9 @@ export default defineConfig({
   server: {
     proxy: {
       "/scene": "http://localhost:8080",
+      "/events": "http://localhost:8080",
+      "/history": "http://localhost:8080",
+      "/summary": "http://localhost:8080",
     },
   },
 });
@@ -0,0 +1,113 @@
+"""
+A script to describe archives of snapshots in bulk and store the scenes,
+e.g. to backfill the database with footage recorded before the logger ran.
+
+Directories are walked lazily, images are decoded on a pool of processes,
+described concurrently within the model's quota and stored in batches as
+they come in. Stored images are recorded in a checkpoint file: run the same
+command again after an interruption and it picks up where it stopped.
+
+$ python describe_images.py /path/to/snapshots --model 1.5_flash --api_token $(cat .api_token)
+$ python describe_images.py /path/to/snapshots --store sqlite:///cctv_logger.db --name_format %Y%m%d_%H%M%S
+"""
+
+import argparse
+import logging
+
+import google.generativeai as genai
+
+from src.backfill import Backfill, iter_images
+from src.fakes import FakeModel
+from src.inference import InferenceEngine
+from src.model import MODEL_QUOTAS, Model, ModelChoices
+from src.store import open_store
+from src.utils import ENCODING_PROFILES
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("paths", nargs="+", help="image files and directories")
+    parser.add_argument(
+        "--model", type=ModelChoices, choices=ModelChoices.values(), required=True
+    )
+    parser.add_argument("--api_token", type=str, default=None)
+    parser.add_argument(
+        "--fake_latency",
+        type=float,
+        default=None,
+        help="describe with FakeModel, taking this many seconds per image",
+    )
+    parser.add_argument(
+        "--store", type=str, default=None, help="store URI (default: local MongoDB)"
+    )
+    parser.add_argument("--collection", type=str, default=None)
+    parser.add_argument("--checkpoint", type=str, default="describe_images.checkpoint")
+    parser.add_argument(
+        "--recursive", action=argparse.BooleanOptionalAction, default=True
+    )
+    parser.add_argument(
+        "--name_format",
+        type=str,
+        default=None,
+        help="strptime format of the file names (default: use modification times)",
+    )
+    parser.add_argument(
+        "--profile", choices=list(ENCODING_PROFILES), default="balanced"
+    )
+    parser.add_argument(
+        "--processes", type=int, default=None, help="decoding processes"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=8, help="model requests in flight"
+    )
+    parser.add_argument("--rpm", type=float, default=None, help="requests per minute")
+    parser.add_argument("--tpm", type=float, default=None, help="tokens per minute")
+    parser.add_argument("--batch_size", type=int, default=50)
+    parser.add_argument("--report_interval", type=float, default=10)
+    return parser.parse_args()
+
+
+def build_engine(args):
+    requests_per_minute, tokens_per_minute = MODEL_QUOTAS[args.model]
+    if args.fake_latency is not None:
+        model = FakeModel(latency=args.fake_latency)
+    else:
+        genai.configure(api_key=args.api_token)
+        model = Model(args.model, request_timeout=70)
+    return InferenceEngine(
+        model,
+        max_in_flight=args.concurrency,
+        requests_per_minute=args.rpm or requests_per_minute,
+        tokens_per_minute=args.tpm or tokens_per_minute,
+    )
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    engine = build_engine(args)
+    backfill = Backfill(
+        engine,
+        open_store(args.store),
+        checkpoint_path=args.checkpoint,
+        collection=args.collection,
+        encoding_profile=args.profile,
+        processes=args.processes,
+        batch_size=args.batch_size,
+        name_format=args.name_format,
+        report_interval=args.report_interval,
+    )
+    try:
+        backfill.run(
+            iter_images(args.paths, recursive=args.recursive),
+            total_images=iter_images(args.paths, recursive=args.recursive),
+        )
+    except KeyboardInterrupt:
+        print(f"Interrupted, run again to resume from {args.checkpoint}")
+    finally:
+        engine.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,328 @@
+"""
+Module for keeping the encoded frames behind the scenes, on disk.
+
+FrameArchive is an append-only store: frames are appended, as encoded for
+the model, to segment files, and each segment has an index file of
+fixed-size (timestamp, offset, length, format) records. Segments are
+rotated by size or age and deleted, whole, after the retention period or
+once the archive outgrows its size cap.
+
+Reads go through read-only memory maps and return memoryviews of them, so
+reading a frame copies nothing: its pages are only touched as it is
+written out, with no decoding or re-encoding. A map stays open while views
+of it are alive, even once its segment is rotated or deleted.
+
+>> archive = FrameArchive("frames/camera0")
+>> ref = archive.append(blob.data, blob.mime_type, timestamp)
+>> data, mime_type = archive.read(ref)  # memoryview
+>> data, mime_type, ref = archive.find(timestamp)  # frame at or before timestamp
+"""
+
+import bisect
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from array import array
+from datetime import datetime, timezone
+
+LOG = logging.getLogger("cctv_logger")
+
+DATA_SUFFIX = ".frames"
+INDEX_SUFFIX = ".index"
+# timestamp (ms since epoch), offset, length, format code, padding
+INDEX_RECORD = struct.Struct("<qQIB3x")
+MIME_TYPES = ["image/png", "image/jpeg", "image/webp"]
+
+
+def _milliseconds(timestamp):
+    if timestamp.tzinfo is None:
+        # Mongo returns naive UTC datetimes
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return int(timestamp.timestamp() * 1000)
+
+
+class _Segment:
+    "A data file and its index, loaded in memory as arrays for bisection"
+
+    def __init__(self, directory, name):
+        self.name = name
+        self.data_path = os.path.join(directory, name + DATA_SUFFIX)
+        self.index_path = os.path.join(directory, name + INDEX_SUFFIX)
+        self.timestamps = array("q")
+        self.offsets = array("Q")
+        self.lengths = array("I")
+        self.formats = array("B")
+        self.size = 0
+        self.created = time.time()
+        self._map = None
+        self._mapped_size = 0
+        # remapping isn't left to the archive's lock, readers don't take it
+        self._map_lock = threading.Lock()
+        self._mapped_size = 0
+
+    def load(self):
+        """Reads the index, dropping records whose frame didn't make it to disk."""
+        self.size = os.path.getsize(self.data_path)
+        self.created = os.path.getmtime(self.index_path)
+        with open(self.index_path, "rb") as index_file:
+            content = index_file.read()
+        usable = len(content) - len(content) % INDEX_RECORD.size
+        for record in INDEX_RECORD.iter_unpack(content[:usable]):
+            timestamp, offset, length, mime_format = record
+            if offset + length > self.size:
+                break
+            self._add(timestamp, offset, length, mime_format)
+        return self
+
+    def _add(self, timestamp, offset, length, mime_format):
+        self.timestamps.append(timestamp)
+        self.offsets.append(offset)
+        self.lengths.append(length)
+        self.formats.append(mime_format)
+
+    def locate(self, offset):
+        "Returns (length, format code) of the frame starting at offset"
+        index = bisect.bisect_left(self.offsets, offset)
+        if index == len(self.offsets) or self.offsets[index] != offset:
+            raise KeyError(f"No frame at {self.name}:{offset}")
+        return self.lengths[index], self.formats[index]
+
+    def read(self, offset, length):
+        "Returns a memoryview of the frame, raises KeyError if the segment is gone"
+        with self._map_lock:
+            # the active segment grows, map it again when reading past the mapping
+            if self._map is None or offset + length > self._mapped_size:
+                self._unmap()
+                try:
+                    with open(self.data_path, "rb") as data_file:
+                        self._map = mmap.mmap(
+                            data_file.fileno(), 0, access=mmap.ACCESS_READ
+                        )
+                except FileNotFoundError:
+                    raise KeyError(f"No frame segment {self.name}")
+                self._mapped_size = len(self._map)
+            return memoryview(self._map)[offset : offset + length]
+
+    def _unmap(self):
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                # frames of it are still being served, the map is closed
+                # once the last view is released
+                pass
+            self._map = None
+
+    def close(self):
+        with self._map_lock:
+            self._unmap()
+
+    def delete(self):
+        self.close()
+        for path in (self.data_path, self.index_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class FrameArchive:
+    """
+    Append-only store of encoded frames, one per camera.
+
+    Frames are referred to by dicts {"segment", "offset", "length", "mime_type"}
+    (see schemas.FrameRef), which is what the scene documents store.
+    """
+
+    def __init__(
+        self,
+        directory,
+        max_segment_bytes=256 * 2**20,
+        max_segment_age=3600,
+        retention=None,
+        max_bytes=None,
+    ):
+        """
+        :param directory: str: where segment files are written, created if needed
+        :param max_segment_bytes: int: size after which a new segment is started
+        :param max_segment_age: float: seconds after which a new segment is started
+        :param retention: float: seconds after which whole segments are deleted
+            (None keeps them forever)
+        :param max_bytes: int: size of the archive above which the oldest
+            segments are deleted (None: no cap)
+        """
+        self.directory = directory
+        self.max_segment_bytes = max_segment_bytes
+        self.max_segment_age = max_segment_age
+        self.retention = retention
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._segments = []
+        names = sorted(
+            name[: -len(INDEX_SUFFIX)]
+            for name in os.listdir(directory)
+            if name.endswith(INDEX_SUFFIX)
+        )
+        for name in names:
+            try:
+                self._segments.append(_Segment(directory, name).load())
+            except OSError:
+                LOG.exception(f"Could not load frame segment {name}, skipping it")
+        # never append to a segment from a previous run, its tail may be torn
+        self._data_file = None
+        self._index_file = None
+
+    def _start_segment(self, timestamp_ms):
+        self._close_files()
+        # names sort chronologically, a counter keeps them unique within a millisecond
+        name = f"{timestamp_ms:015d}"
+        while any(segment.name == name for segment in self._segments):
+            name = f"{int(name) + 1:015d}"
+        segment = _Segment(self.directory, name)
+        self._data_file = open(segment.data_path, "ab")
+        self._index_file = open(segment.index_path, "ab")
+        self._segments.append(segment)
+        return segment
+
+    def _close_files(self):
+        for open_file in (self._data_file, self._index_file):
+            if open_file is not None:
+                open_file.close()
+        self._data_file = self._index_file = None
+
+    def _active(self, timestamp_ms):
+        segment = self._segments[-1] if self._data_file is not None else None
+        if (
+            segment is None
+            or segment.size >= self.max_segment_bytes
+            or time.time() - segment.created >= self.max_segment_age
+        ):
+            segment = self._start_segment(timestamp_ms)
+            self._expire()
+        return segment
+
+    def append(self, data, mime_type, timestamp=None):
+        """
+        Appends an encoded frame.
+
+        :param data: bytes: encoded image
+        :param mime_type: str: its mime type, e.g. "image/jpeg"
+        :param timestamp: datetime: capture time (default: now)
+
+        :return: dict: reference to the frame, to store with its scene
+        """
+        timestamp = timestamp or datetime.now(tz=timezone.utc)
+        timestamp_ms = _milliseconds(timestamp)
+        mime_format = MIME_TYPES.index(mime_type)
+        with self._lock:
+            segment = self._active(timestamp_ms)
+            offset = segment.size
+            self._data_file.write(data)
+            # the data must be on disk before the index points to it
+            self._data_file.flush()
+            self._index_file.write(
+                INDEX_RECORD.pack(timestamp_ms, offset, len(data), mime_format)
+            )
+            self._index_file.flush()
+            segment.size += len(data)
+            segment._add(timestamp_ms, offset, len(data), mime_format)
+        return {
+            "segment": segment.name,
+            "offset": offset,
+            "length": len(data),
+            "mime_type": mime_type,
+        }
+
+    def _segment(self, name):
+        for segment in self._segments:
+            if segment.name == name:
+                return segment
+        raise KeyError(f"No frame segment {name}")
+
+    def read(self, ref):
+        """
+        Returns (data, mime_type) of a frame, raises KeyError if there is none.
+        The data is a memoryview of the segment's map.
+
+        :param ref: dict: reference returned by append(), only its segment and
+            offset are needed
+        """
+        offset = int(ref["offset"])
+        # only the lookup holds the lock, not the read
+        with self._lock:
+            segment = self._segment(ref["segment"])
+            length, mime_format = segment.locate(offset)
+        return segment.read(offset, length), MIME_TYPES[mime_format]
+
+    def find(self, timestamp=None):
+        """
+        Returns (data, mime_type, ref) of the last frame captured at or before
+        timestamp (default: the latest frame), or None if there is none. The
+        data is a memoryview of the segment's map.
+        """
+        with self._lock:
+            for segment in reversed(self._segments):
+                if not segment.timestamps:
+                    continue
+                if timestamp is None:
+                    index = len(segment.timestamps) - 1
+                else:
+                    index = (
+                        bisect.bisect_right(
+                            segment.timestamps, _milliseconds(timestamp)
+                        )
+                        - 1
+                    )
+                    if index < 0:
+                        continue
+                offset, length = segment.offsets[index], segment.lengths[index]
+                mime_type = MIME_TYPES[segment.formats[index]]
+                ref = {
+                    "segment": segment.name,
+                    "offset": offset,
+                    "length": length,
+                    "mime_type": mime_type,
+                }
+                break
+            else:
+                return None
+        return segment.read(offset, length), mime_type, ref
+
+    def _expire(self):
+        """
+        Deletes the segments whose newest frame is older than the retention,
+        and the oldest ones while the archive is bigger than max_bytes
+        """
+        oldest_kept = None
+        if self.retention is not None:
+            oldest_kept = (time.time() - self.retention) * 1000
+        size = sum(segment.size for segment in self._segments)
+        # the active segment, last, is never deleted
+        while len(self._segments) > 1:
+            segment = self._segments[0]
+            expired = oldest_kept is not None and (
+                not segment.timestamps or segment.timestamps[-1] < oldest_kept
+            )
+            if not expired and (self.max_bytes is None or size <= self.max_bytes):
+                break
+            LOG.info(f"Deleting expired frame segment {segment.name}")
+            segment.delete()
+            self._segments.pop(0)
+            size -= segment.size
+
+    def stats(self):
+        with self._lock:
+            return {
+                "segments": len(self._segments),
+                "frames": sum(len(segment.timestamps) for segment in self._segments),
+                "bytes": sum(segment.size for segment in self._segments),
+            }
+
+    def close(self):
+        with self._lock:
+            self._close_files()
+            for segment in self._segments:
+                segment.close()
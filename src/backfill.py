@@ -0,0 +1,383 @@
+"""
+Module for describing archives of snapshots in bulk, see describe_images.py.
+
+Images are found lazily, one directory at a time, decoded and resized on a
+pool of processes, described concurrently through an InferenceEngine (so
+within the model's quota) and written to the store in batches as the
+descriptions come in. The paths of stored images are appended to a
+checkpoint file, so an interrupted run skips them when it is started again.
+
+>> backfill = Backfill(engine, open_store(), checkpoint_path="backfill.checkpoint")
+>> backfill.run(iter_images(["/path/to/snapshots"]))
+"""
+
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from datetime import datetime, timedelta, timezone
+
+import cv2
+import google.generativeai as genai
+from bson import ObjectId
+from pymongo.errors import BulkWriteError, ConnectionFailure
+
+from src.camera import FrameNotFoundError
+from src.parsing import parse_scene
+from src.sources import IMAGE_EXTENSIONS
+from src.store import MongoDocument, StoreUnavailable
+from src.utils import ENCODING_PROFILES
+
+LOG = logging.getLogger("cctv_logger")
+
+
+def iter_images(paths, recursive=True):
+    """
+    Yields the image files among `paths` and in the directories among them,
+    in file name order. Directories are listed as they are reached, so the
+    first images come out straight away, whatever the size of the archive.
+
+    :param paths: list: image files and directories
+    :param recursive: bool: whether to look into subdirectories
+    """
+    for path in paths:
+        if not os.path.isdir(path):
+            if path.lower().endswith(IMAGE_EXTENSIONS):
+                yield path
+            continue
+        with os.scandir(path) as entries:
+            entries = sorted(entries, key=lambda entry: entry.name)
+        for entry in entries:
+            if entry.is_dir():
+                if recursive:
+                    yield from iter_images([entry.path], recursive=recursive)
+            elif entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                yield entry.path
+
+
+def capture_time(path, name_format=None):
+    """
+    Returns when an image was taken, read from its file name if a format is
+    given (e.g. "%Y%m%d_%H%M%S" for 20240701_142501.jpg), otherwise its
+    modification time. Times without a timezone are taken as UTC.
+    """
+    if name_format is not None:
+        stem = os.path.splitext(os.path.basename(path))[0]
+        timestamp = datetime.strptime(stem, name_format)
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.replace(tzinfo=timezone.utc)
+        return timestamp
+    return datetime.fromtimestamp(os.path.getmtime(path), timezone.utc)
+
+
+def document_id(path, timestamp):
+    """
+    ObjectId of the scene of an image: its capture time, as in any ObjectId,
+    followed by a hash of its path. Storing an image twice (after a crash,
+    before its checkpoint was written) then hits a duplicate key instead of
+    adding a second scene.
+    """
+    digest = hashlib.sha1(os.path.abspath(path).encode()).digest()
+    seconds = int(timestamp.timestamp()) & 0xFFFFFFFF
+    return ObjectId(seconds.to_bytes(4, "big") + digest[:8])
+
+
+def _init_worker():
+    # one thread per process, the pool already uses every core
+    cv2.setNumThreads(1)
+
+
+def encode_image(path, profile):
+    """
+    Reads and encodes an image, in a worker process.
+
+    :param profile: str: name of the EncodingProfile, see ENCODING_PROFILES
+    :return: tuple of (mime type, encoded bytes)
+    """
+    frame = cv2.imread(path)
+    if frame is None:
+        raise FrameNotFoundError(f"Could not read image {path}")
+    encoding_profile = ENCODING_PROFILES[profile]
+    return encoding_profile.mime_type, encoding_profile.encode(frame)
+
+
+class Checkpoint:
+    "Append-only file of the paths of the images already stored"
+
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                self.done = {line.rstrip("\n") for line in f if line.strip()}
+        self._file = open(path, "a")
+
+    def __contains__(self, image_path):
+        return os.path.abspath(image_path) in self.done
+
+    def add(self, image_paths):
+        "Records images as stored, on disk before returning"
+        image_paths = [os.path.abspath(image_path) for image_path in image_paths]
+        self._file.write("".join(f"{image_path}\n" for image_path in image_paths))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.done.update(image_paths)
+
+    def close(self):
+        self._file.close()
+
+
+class Progress:
+    """
+    Counts processed images and estimates the time left. The images left to
+    do are counted on a background thread, the ETA is known once it is done.
+    """
+
+    def __init__(self, images=None, window=60):
+        """
+        :param images: iterable: every image of the run, counted in the background
+            (None: no ETA)
+        :param window: float: seconds of recent throughput the ETA is based on
+        """
+        self.described = 0
+        self.skipped = 0
+        self.failed = 0
+        self.total = None
+        self.window = window
+        self._started = time.monotonic()
+        # (time, images described so far)
+        self._history = deque([(self._started, 0)])
+        if images is not None:
+            threading.Thread(
+                target=self._count, args=(images,), name="backfill-count", daemon=True
+            ).start()
+
+    def _count(self, images):
+        self.total = sum(1 for _ in images)
+
+    def update(self, described=0, skipped=0, failed=0):
+        self.described += described
+        self.skipped += skipped
+        self.failed += failed
+        now = time.monotonic()
+        self._history.append((now, self.described))
+        while len(self._history) > 2 and self._history[0][0] < now - self.window:
+            self._history.popleft()
+
+    def rate(self):
+        "Images described per second, recently"
+        (start, first), (end, last) = self._history[0], self._history[-1]
+        return (last - first) / (end - start) if end > start else 0.0
+
+    def line(self):
+        elapsed = timedelta(seconds=round(time.monotonic() - self._started))
+        rate = self.rate()
+        line = (
+            f"{self.described} described, {self.skipped} skipped, "
+            f"{self.failed} failed in {elapsed}, {rate:.2f} images/s"
+        )
+        if self.total is not None:
+            left = self.total - self.described - self.skipped - self.failed
+            eta = timedelta(seconds=round(left / rate)) if rate else "?"
+            line += f", {max(left, 0)} left, ETA {eta}"
+        return line
+
+
+class Backfill:
+    """
+    Describes images and stores their scenes, resuming from a checkpoint.
+
+    Images are decoded ahead of the model requests, a bounded number at a
+    time, so memory use doesn't depend on the size of the archive.
+    """
+
+    def __init__(
+        self,
+        model,
+        client,
+        checkpoint_path="backfill.checkpoint",
+        collection=None,
+        encoding_profile="balanced",
+        processes=None,
+        batch_size=50,
+        batch_max_age=10,
+        name_format=None,
+        report_interval=10,
+        store_retries=5,
+    ):
+        """
+        :param model: InferenceEngine: sends the requests, within quota
+            (its max_in_flight requests are kept running)
+        :param client: SceneStore: where scenes are stored
+        :param checkpoint_path: str: file recording the images already stored
+        :param collection: str: collection to store the scenes in (defaults to the client's)
+        :param encoding_profile: str: name of the EncodingProfile images are sent with
+        :param processes: int: processes decoding images (default: one per core)
+        :param batch_size: int: scenes written to the store at a time
+        :param batch_max_age: float: seconds after which scenes are written
+            even if there are fewer than batch_size
+        :param name_format: str: strptime format of the file names, giving the
+            capture times (default: file modification times)
+        :param report_interval: float: seconds between progress reports
+        :param store_retries: int: attempts at writing a batch while the store
+            is unreachable, before giving up
+        """
+        self.model = model
+        self.client = client
+        self.checkpoint = Checkpoint(checkpoint_path)
+        self.collection = collection
+        self.encoding_profile = encoding_profile
+        self.processes = processes or os.cpu_count()
+        self.batch_size = batch_size
+        self.batch_max_age = batch_max_age
+        self.name_format = name_format
+        self.report_interval = report_interval
+        self.store_retries = store_retries
+        # images decoded ahead of the requests
+        self.lookahead = self.processes + 2 * model.max_in_flight
+
+    def run(self, images, total_images=None):
+        """
+        Describes and stores the images not in the checkpoint yet.
+
+        :param images: iterable: image paths, e.g. iter_images(paths)
+        :param total_images: iterable: the same paths again, counted in the
+            background for the ETA (None: no ETA)
+        :return: Progress: counts of the run
+        """
+        progress = Progress(total_images)
+        images = iter(images)
+        # future -> image path
+        encoding = {}
+        describing = {}
+        # (image path, document) not stored yet
+        batch = []
+        batch_started = None
+        last_report = time.monotonic()
+
+        decoders = ProcessPoolExecutor(self.processes, initializer=_init_worker)
+        requests = ThreadPoolExecutor(
+            self.model.max_in_flight, thread_name_prefix="backfill"
+        )
+        try:
+            while True:
+                exhausted = self._fill(images, encoding, describing, progress, decoders)
+                if exhausted and not encoding and not describing:
+                    break
+
+                done, _ = wait(
+                    list(encoding) + list(describing),
+                    timeout=self.batch_max_age,
+                    return_when=FIRST_COMPLETED,
+                )
+                for future in done:
+                    if future in encoding:
+                        path = encoding.pop(future)
+                        try:
+                            mime_type, data = future.result()
+                        except Exception as e:
+                            LOG.warning(f"Skipping {path}: {e}")
+                            progress.update(failed=1)
+                            continue
+                        blob = genai.protos.Blob(mime_type=mime_type, data=data)
+                        request = requests.submit(
+                            self.model.describe_image_from_blob, blob
+                        )
+                        describing[request] = path
+                        continue
+
+                    path = describing.pop(future)
+                    try:
+                        document = self._document(path, future.result())
+                    except Exception as e:
+                        LOG.warning(f"Could not describe {path}: {e}")
+                        progress.update(failed=1)
+                        continue
+                    batch.append((path, document))
+                    batch_started = batch_started or time.monotonic()
+
+                if batch and (
+                    len(batch) >= self.batch_size
+                    or time.monotonic() - batch_started >= self.batch_max_age
+                ):
+                    # taken out first: if the store is down for good, the
+                    # batch isn't tried again on the way out
+                    stored, batch, batch_started = batch, [], None
+                    self._store(stored, progress)
+
+                if time.monotonic() - last_report >= self.report_interval:
+                    print(progress.line(), flush=True)
+                    last_report = time.monotonic()
+        finally:
+            # on an interrupt too: what was described is kept, the rest is
+            # left for the next run
+            for future in list(encoding) + list(describing):
+                future.cancel()
+            decoders.shutdown(wait=False, cancel_futures=True)
+            requests.shutdown(wait=False, cancel_futures=True)
+            if batch:
+                self._store(batch, progress)
+            self.checkpoint.close()
+            print(progress.line(), flush=True)
+        return progress
+
+    def _fill(self, images, encoding, describing, progress, decoders):
+        "Starts decoding images up to the lookahead, returns whether none are left"
+        while len(encoding) + len(describing) < self.lookahead:
+            path = next(images, None)
+            if path is None:
+                return True
+            if path in self.checkpoint:
+                progress.update(skipped=1)
+                continue
+            encoding[decoders.submit(encode_image, path, self.encoding_profile)] = path
+        return False
+
+    def _document(self, path, response):
+        timestamp = capture_time(path, self.name_format)
+        # Pydantic performs validation for us
+        document = MongoDocument(scene=parse_scene(response), timestamp=timestamp)
+        document = document.dict()
+        document["_id"] = document_id(path, timestamp)
+        return document
+
+    def _store(self, batch, progress):
+        "Writes a batch of scenes, then records their images in the checkpoint"
+        documents = [document for _, document in batch]
+        for attempt in range(self.store_retries):
+            try:
+                self.client.insert_documents(documents, collection=self.collection)
+            except (ConnectionFailure, StoreUnavailable) as e:
+                if attempt == self.store_retries - 1:
+                    raise
+                LOG.warning(f"Could not write {len(documents)} scenes: {e}")
+                time.sleep(2**attempt)
+                continue
+            except BulkWriteError as e:
+                # duplicates were written by an earlier run that stopped
+                # before its checkpoint, the other errors are left for the next run
+                errors = [
+                    error
+                    for error in e.details.get("writeErrors", [])
+                    if error.get("code") != 11000
+                ]
+                if errors:
+                    LOG.error(f"Could not write {len(errors)} scenes: {errors}")
+                    unwritten = {error["index"] for error in errors}
+                    batch = [
+                        item
+                        for index, item in enumerate(batch)
+                        if index not in unwritten
+                    ]
+                    progress.update(failed=len(unwritten))
+            break
+        self.checkpoint.add([path for path, _ in batch])
+        progress.update(described=len(batch))
@@ -0,0 +1,252 @@
+"""
+Module for writing scenes to the database in batches.
+
+Scenes are validated straight away but only written with insert_many once
+enough of them are buffered, once the oldest has waited long enough, or on
+close(). If the database can't be reached the documents are appended to a local
+spill file, which is written back on the next successful flush.
+
+>> writer = BulkSceneWriter(MongoClient(), max_docs=20, max_age=10)
+>> writer.add(scene, timestamp)
+>> ...
+>> writer.close()
+"""
+
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+from bson import ObjectId, json_util
+from pymongo.errors import BulkWriteError, ConnectionFailure
+
+from src.store import MongoDocument, StoreUnavailable
+
+LOG = logging.getLogger("cctv_logger")
+
+
+class BulkSceneWriter:
+    """
+    Buffers validated scene documents and flushes them with insert_many.
+
+    Thread-safe: scenes can be added from several pipeline threads. A
+    background thread flushes the buffer when it is full or gets older than
+    max_age, so add() never waits for the database.
+    """
+
+    def __init__(
+        self,
+        client,
+        max_docs=20,
+        max_age=10,
+        max_buffer=1000,
+        write_concern=None,
+        spill_path="scenes_spill.jsonl",
+    ):
+        """
+        :param client: SceneStore: store used to insert the documents
+        :param max_docs: int: flush once this many documents are buffered
+        :param max_age: float: flush once the oldest buffered document is this many seconds old
+        :param max_buffer: int: maximum number of documents kept in memory, the rest
+            is spilled to disk while MongoDB is unreachable
+        :param write_concern: dict: write concern of the inserts, e.g. {"w": 1, "j": False}
+        :param spill_path: str: file documents are spilled to when MongoDB is unreachable
+        """
+        self.client = client
+        self.max_docs = max_docs
+        self.max_age = max_age
+        self.max_buffer = max_buffer
+        self.write_concern = write_concern
+        self.spill_path = spill_path
+
+        # (db, collection, document) in insertion order
+        self._buffer = []
+        self._oldest = None
+        self._condition = threading.Condition()
+        # only one flush at a time, so documents are written in order
+        self._flush_lock = threading.Lock()
+        self._closed = False
+
+        self.written = 0
+        self.spilled = 0
+        self.failed_flushes = 0
+
+        self._flusher = threading.Thread(
+            target=self._flush_periodically, name="bulk-writer", daemon=True
+        )
+        self._flusher.start()
+
+    def add(
+        self, scene, timestamp=None, db=None, collection=None, crop=None, frame=None
+    ):
+        """
+        Validates a scene and buffers it for insertion.
+
+        :param scene: Scene: scene description as outputted by model
+        :param timestamp: datetime: time when scene was captured (if not provided, uses now())
+        :param db: str: mongo database name (if not provided, uses client default)
+        :param collection: str: mongo collection name (if not provided, uses client default)
+        :param crop: CropGeometry: parts of the frame the scene describes (None: whole frame)
+        :param frame: FrameRef: where the frame is archived (None: not archived)
+        """
+        timestamp = timestamp or datetime.now(tz=timezone.utc)
+        # Pydantic performs validation for us
+        document = MongoDocument(
+            scene=scene, timestamp=timestamp, crop=crop, frame=frame
+        ).dict()
+        # set the _id here, so that retrying a partially written batch
+        # fails on duplicates instead of inserting them twice
+        document["_id"] = ObjectId()
+
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("BulkSceneWriter is closed")
+            self._buffer.append((db, collection, document))
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            # wake up the flusher, which writes the buffer once it is full
+            self._condition.notify()
+
+    def _take(self):
+        with self._condition:
+            buffered, self._buffer = self._buffer, []
+            self._oldest = None
+            return buffered
+
+    def flush(self):
+        """
+        Writes the spill file (if any) and the buffered documents to MongoDB.
+        Documents that can't be written are kept, in memory up to max_buffer
+        and in the spill file beyond that.
+
+        :return: bool: whether everything was written
+        """
+        with self._flush_lock:
+            if os.path.exists(self.spill_path) and not self._flush_spill():
+                # MongoDB is still unreachable, retry on the next flush
+                return False
+            return self._write(self._take())
+
+    def _write(self, buffered, keep=True):
+        """
+        Inserts documents grouped by collection, returns whether all of them
+        were written. Unwritten documents are put back in the buffer, unless
+        `keep` is False (they are still on disk).
+        """
+        groups = {}
+        for db, collection, document in buffered:
+            groups.setdefault((db, collection), []).append(document)
+
+        for index, ((db, collection), documents) in enumerate(groups.items()):
+            try:
+                self.client.insert_documents(
+                    documents,
+                    db=db,
+                    collection=collection,
+                    write_concern=self.write_concern,
+                )
+            except (ConnectionFailure, StoreUnavailable) as e:
+                self.failed_flushes += 1
+                LOG.warning(f"Could not write {len(buffered)} scenes: {e}")
+                unwritten = [
+                    (db, collection, document)
+                    for (db, collection), documents in list(groups.items())[index:]
+                    for document in documents
+                ]
+                if keep:
+                    self._keep(unwritten)
+                return False
+            except BulkWriteError as e:
+                # duplicates were written by an earlier, partially failed flush
+                errors = [
+                    error
+                    for error in e.details.get("writeErrors", [])
+                    if error.get("code") != 11000
+                ]
+                if errors:
+                    LOG.error(f"Could not write {len(errors)} scenes: {errors}")
+            self.written += len(documents)
+        return True
+
+    def _keep(self, unwritten):
+        "Puts unwritten documents back in the buffer, spilling what doesn't fit"
+        with self._condition:
+            self._buffer = unwritten + self._buffer
+            overflow = len(self._buffer) - self.max_buffer
+            if overflow > 0:
+                spill, self._buffer = self._buffer[:overflow], self._buffer[overflow:]
+            else:
+                spill = []
+            if self._buffer and self._oldest is None:
+                self._oldest = time.monotonic()
+        if spill:
+            self._spill(spill)
+
+    def _spill(self, documents):
+        with open(self.spill_path, "a") as f:
+            for db, collection, document in documents:
+                f.write(
+                    json_util.dumps(
+                        {"db": db, "collection": collection, "document": document}
+                    )
+                    + "\n"
+                )
+        self.spilled += len(documents)
+        LOG.warning(f"Spilled {len(documents)} scenes to {self.spill_path}")
+
+    def _flush_spill(self):
+        "Writes back the spill file, returns whether it succeeded"
+        with open(self.spill_path) as f:
+            spilled = [json_util.loads(line) for line in f if line.strip()]
+        LOG.info(f"Writing back {len(spilled)} spilled scenes")
+        # the file is only removed once written: documents that fail again
+        # stay on disk, and those already written are duplicates next time
+        if not self._write(
+            [(doc["db"], doc["collection"], doc["document"]) for doc in spilled],
+            keep=False,
+        ):
+            return False
+        os.remove(self.spill_path)
+        return True
+
+    def _flush_periodically(self):
+        # after a failed flush, the next one waits max_age even if the buffer is full
+        retry_at = 0.0
+        while True:
+            with self._condition:
+                if self._closed:
+                    return
+                if self._oldest is None:
+                    self._condition.wait()
+                    continue
+                now = time.monotonic()
+                if now < retry_at:
+                    self._condition.wait(retry_at - now)
+                    continue
+                remaining = self._oldest + self.max_age - now
+                if remaining > 0 and len(self._buffer) < self.max_docs:
+                    self._condition.wait(remaining)
+                    continue
+            if not self.flush():
+                retry_at = time.monotonic() + self.max_age
+
+    def close(self):
+        """Stops the background thread and flushes what's left."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._flusher.join()
+        self.flush()
+        # whatever MongoDB didn't take is kept on disk for the next run
+        unwritten = self._take()
+        if unwritten:
+            self._spill(unwritten)
+
+    def stats(self):
+        return {
+            "buffered": len(self._buffer),
+            "written": self.written,
+            "spilled": self.spilled,
+            "failed_flushes": self.failed_flushes,
+        }
@@ -0,0 +1,162 @@
+"""
+Module for caching model responses for near-identical frames.
+
+Frames are keyed by their difference hash (dHash): a 64-bit fingerprint that
+barely changes under noise, compression or small lighting shifts. Two frames
+whose hashes are within a few bits of each other are considered the same scene.
+
+>> cache = SceneCache(max_distance=4, path="scene_cache.db")
+>> frame_hash = dhash(frame)
+>> scene = cache.get(frame_hash)
+>> if scene is None:
+>>     scene = ...  # ask the model
+>>     cache.put(frame_hash, scene)
+"""
+
+import shelve
+import threading
+import time
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+DEFAULT_HASH_SIZE = 8
+
+
+def dhash(frame: np.ndarray, hash_size=DEFAULT_HASH_SIZE) -> int:
+    """
+    Computes the difference hash of a frame.
+
+    The frame is shrunk to (hash_size + 1) x hash_size grayscale pixels and
+    each bit records whether a pixel is brighter than its right neighbour.
+
+    :param frame: np.ndarray: BGR or grayscale frame
+    :param hash_size: int: number of rows/bits per row of the hash
+
+    :return: int with hash_size ** 2 bits
+    """
+    if frame.ndim == 3:
+        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(frame, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+class SceneCache:
+    """
+    LRU cache of parsed scenes keyed by frame hash, with TTL expiry.
+
+    Lookups match any entry whose hash is within max_distance bits of the
+    query, so a slightly different frame of the same scene is still a hit.
+    If a path is given, entries are also kept in a shelve file and reloaded
+    on start-up. Safe to share between pipeline threads.
+    """
+
+    def __init__(self, capacity=256, ttl=3600, max_distance=4, path=None):
+        """
+        :param capacity: int: maximum number of scenes kept in memory
+        :param ttl: float: seconds after which an entry is considered stale
+        :param max_distance: int: maximum Hamming distance between hashes for a hit
+        :param path: str: optional file for the on-disk backing store
+        """
+        self.capacity = capacity
+        self.ttl = ttl
+        self.max_distance = max_distance
+        self.hits = 0
+        self.misses = 0
+        # frame_hash -> (insertion time, scene), least recently used first
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._store = shelve.open(path) if path else None
+        if self._store is not None:
+            self._load()
+
+    def _load(self):
+        for key, (inserted_at, scene) in self._store.items():
+            if not self._expired(inserted_at):
+                self._entries[int(key, 16)] = (inserted_at, scene)
+        # shelve order is arbitrary, so rebuild LRU order from insertion time
+        self._entries = OrderedDict(
+            sorted(self._entries.items(), key=lambda item: item[1][0])
+        )
+        self._evict()
+
+    def _expired(self, inserted_at):
+        return time.time() - inserted_at > self.ttl
+
+    def _remove(self, frame_hash):
+        del self._entries[frame_hash]
+        if self._store is not None:
+            self._store.pop(f"{frame_hash:x}", None)
+
+    def _evict(self):
+        for frame_hash in [
+            h
+            for h, (inserted_at, _) in self._entries.items()
+            if self._expired(inserted_at)
+        ]:
+            self._remove(frame_hash)
+        while len(self._entries) > self.capacity:
+            self._remove(next(iter(self._entries)))
+
+    def get(self, frame_hash):
+        """
+        Returns the cached scene closest to frame_hash, or None on a miss.
+
+        :param frame_hash: int: hash of the frame as returned by dhash()
+        """
+        with self._lock:
+            self._evict()
+            best, best_distance = None, self.max_distance + 1
+            for cached_hash in self._entries:
+                distance = hamming_distance(frame_hash, cached_hash)
+                if distance < best_distance:
+                    best, best_distance = cached_hash, distance
+                    if distance == 0:
+                        break
+
+            if best is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._entries.move_to_end(best)
+            return self._entries[best][1]
+
+    def put(self, frame_hash, scene):
+        """
+        Stores a parsed scene under frame_hash.
+
+        :param frame_hash: int: hash of the frame as returned by dhash()
+        :param scene: Scene: parsed scene returned by the model
+        """
+        entry = (time.time(), scene)
+        with self._lock:
+            self._entries[frame_hash] = entry
+            self._entries.move_to_end(frame_hash)
+            if self._store is not None:
+                self._store[f"{frame_hash:x}"] = entry
+            self._evict()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "size": len(self._entries),
+        }
+
+    def close(self):
+        with self._lock:
+            if self._store is not None:
+                self._store.close()
+                self._store = None
+
+    def __len__(self):
+        return len(self._entries)
@@ -8,14 +8,30 @@ Module for interacting with the video capturing device.
 
 >> camera = Camera()
 >> camera.show_feed()
+
+In grabbing mode a background thread keeps pulling frames from the device,
+so read_frame() returns the freshest frame immediately:
+
+>> camera = Camera(grabbing=True)
+>> frame = camera.read_frame()
+>> camera.grabber.stats()
 """
+
+import threading
+import time
+
 import cv2
 import numpy as np
 
 # The device ID is an integer that identifies which
-# video capturing device to use.
+# video capturing device to use by default. Cameras can also be
+# opened from an RTSP/HTTP stream URL or a video file path.
 VIDEO_CAPTURING_DEVICE_ID = 0
 
+# Number of frames kept by the grabber thread. A frame returned by
+# FrameGrabber.latest() is overwritten after this many further grabs.
+DEFAULT_RING_BUFFER_SIZE = 4
+
 
 class FrameNotFoundError(Exception):
     pass
@@ -40,23 +56,189 @@ def show_frame(frame: np.ndarray) -> int:
     return key
 
 
+class FrameGrabber(threading.Thread):
+    """
+    Thread that continuously grabs frames from a VideoCapture into a
+    preallocated ring buffer.
+
+    OpenCV queues frames inside the driver, so reading a frame every few
+    seconds returns one captured seconds earlier. Grabbing continuously keeps
+    that queue empty and the newest frame always at hand.
+    """
+
+    def __init__(self, video_capture, buffer_size=DEFAULT_RING_BUFFER_SIZE):
+        super().__init__(name="camera-grabber", daemon=True)
+        self.video_capture = video_capture
+        self.buffer_size = buffer_size
+        self._buffers = None
+        self._timestamps = [0.0] * buffer_size
+        self._latest = None
+        self._condition = threading.Condition()
+        self._running = True
+
+        # stats
+        self.grabbed = 0
+        self.failed = 0
+        self.dropped = 0
+        self._last_read = 0
+        self._total_grab_time = 0.0
+        self._max_grab_time = 0.0
+
+    def run(self):
+        while self._running:
+            start = time.monotonic()
+            if not self.video_capture.grab():
+                self.failed += 1
+                time.sleep(0.1)
+                continue
+
+            if self._buffers is None:
+                returned, frame = self.video_capture.retrieve()
+                if not returned:
+                    # the frame size is still unknown, try again with the next grab
+                    self.failed += 1
+                    continue
+                self._buffers = [np.empty_like(frame) for _ in range(self.buffer_size)]
+            slot = 0 if self._latest is None else (self._latest + 1) % self.buffer_size
+            # retrieve() decodes straight into the preallocated slot
+            returned, _ = self.video_capture.retrieve(self._buffers[slot])
+            if not returned:
+                self.failed += 1
+                continue
+
+            grab_time = time.monotonic() - start
+            with self._condition:
+                self._timestamps[slot] = time.time()
+                self._latest = slot
+                self.grabbed += 1
+                self._total_grab_time += grab_time
+                self._max_grab_time = max(self._max_grab_time, grab_time)
+                self._condition.notify_all()
+
+    def stop(self):
+        self._running = False
+        with self._condition:
+            self._condition.notify_all()
+
+    def latest(self, timeout=None, newer_than=None):
+        """
+        Returns (frame, timestamp, sequence number) for the freshest frame in the
+        buffer, or (None, None, None) if there is none within the timeout.
+
+        The frame is a read-only view into the ring buffer, not a copy.
+
+        :param timeout: float: seconds to wait if no (new) frame is available yet
+        :param newer_than: int: sequence number the returned frame must be newer than
+        """
+        newer_than = 0 if newer_than is None else newer_than
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self.grabbed > newer_than or not self._running,
+                timeout=timeout,
+            )
+            if self._latest is None or self.grabbed <= newer_than:
+                return None, None, None
+            # frames grabbed since the previous read that nobody will ever see
+            self.dropped += max(0, self.grabbed - self._last_read - 1)
+            self._last_read = self.grabbed
+            frame = self._buffers[self._latest].view()
+            frame.flags.writeable = False
+            return frame, self._timestamps[self._latest], self.grabbed
+
+    def stats(self):
+        with self._condition:
+            latest_timestamp = (
+                self._timestamps[self._latest] if self._latest is not None else None
+            )
+            return {
+                "grabbed": self.grabbed,
+                "failed": self.failed,
+                "dropped": self.dropped,
+                "mean_grab_latency": (
+                    self._total_grab_time / self.grabbed if self.grabbed else None
+                ),
+                "max_grab_latency": self._max_grab_time,
+                "latest_frame_age": (
+                    time.time() - latest_timestamp if latest_timestamp else None
+                ),
+            }
+
+
 class Camera:
-    def __init__(self):
-        self.video_capture = cv2.VideoCapture(VIDEO_CAPTURING_DEVICE_ID)
+    def __init__(
+        self,
+        source=VIDEO_CAPTURING_DEVICE_ID,
+        grabbing=False,
+        buffer_size=DEFAULT_RING_BUFFER_SIZE,
+    ):
+        """
+        :param source: int | str: device index, stream URL or video file path
+        :param grabbing: bool: whether to continuously grab frames on a background thread
+        :param buffer_size: int: number of frames in the grabber's ring buffer
+        """
+        self.source = source
+        self.video_capture = cv2.VideoCapture(source)
+        self.grabber = None
+        if grabbing:
+            self.grabber = FrameGrabber(self.video_capture, buffer_size=buffer_size)
+            self.grabber.start()
 
     def frames(self) -> "Iterable[np.ndarray]":
+        if self.grabber is not None:
+            yield from self._grabbed_frames()
+            return
         while True:
             try:
                 yield self.read_frame()
             except FrameNotFoundError:
-                raise StopIteration
+                return
 
-    def read_frame(self) -> np.ndarray:
-        returned, frame = self.video_capture.read()
+    def _grabbed_frames(self):
+        """
+        Yields each new frame from the ring buffer, waiting for the next one.
+        The frames are read-only views, copy them to keep them past the next
+        few grabs.
+        """
+        seen = None
+        while self.grabber.is_alive():
+            frame, _, sequence = self.grabber.latest(timeout=1, newer_than=seen)
+            if frame is None:
+                continue
+            seen = sequence
+            yield frame
+
+    def read_frame(self, timeout=1.0, out=None) -> np.ndarray:
+        """
+        Reads the current frame.
+
+        In grabbing mode this returns a copy of the freshest frame of the ring
+        buffer without blocking on the device. The ring buffer slot is
+        overwritten by later grabs, while the frame may be used for a while,
+        e.g. encoded on another thread. Pass `out` to reuse an array of your
+        own instead of allocating one per frame (a new array is returned if it
+        doesn't have the frame's shape, e.g. after a change of resolution).
+
+        :param timeout: float: seconds to wait for the grabber's first frame
+        :param out: np.ndarray: optional array to read the frame into
+        """
+        if self.grabber is not None:
+            frame, _, _ = self.grabber.latest(timeout=timeout)
+            if frame is None:
+                raise FrameNotFoundError(
+                    f"Could not grab frames from device {self.source}"
+                )
+            if (
+                out is not None
+                and out.shape == frame.shape
+                and out.dtype == frame.dtype
+            ):
+                np.copyto(out, frame)
+                return out
+            return frame.copy()
+
+        returned, frame = self.video_capture.read(out)
         if not returned:
-            raise FrameNotFoundError(
-                f"Could not grab frames from device {VIDEO_CAPTURING_DEVICE_ID}"
-            )
+            raise FrameNotFoundError(f"Could not grab frames from device {self.source}")
         return frame
 
     def close(self):
@@ -67,6 +249,9 @@ class Camera:
         NOTE: release() is automatically called by VideoCapture destructor
         when the program exits.
         """
+        if self.grabber is not None:
+            self.grabber.stop()
+            self.grabber.join()
         self.video_capture.release()
 
     def is_open(self):
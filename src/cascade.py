@@ -0,0 +1,245 @@
+"""
+Module for describing frames with a cheap model first, and an expensive
+one only when it matters.
+
+Most frames show an empty street: FLASH describes them well enough, and
+much faster than PRO. ModelCascade sends every frame to the fast model and
+escalates to the accurate model only the frames its EscalationRule picks
+(persons or vehicles seen, malformed JSON, uncertain answers).
+
+>> model = ModelCascade(Model(ModelChoices.FLASH), Model(ModelChoices.PRO))
+>> runner = CCTVLoggerRunner(model=model)
+"""
+
+import json
+import logging
+import threading
+import time
+
+from src.metrics import REGISTRY
+from src.parsing import parse_json
+from src.schemas import Scene
+
+LOG = logging.getLogger("cctv_logger")
+
+FAST = "fast"
+ACCURATE = "accurate"
+
+TIER_SECONDS = REGISTRY.histogram(
+    "cctv_cascade_request_seconds",
+    "Latency of the requests to each tier of the model cascade",
+    ("tier",),
+)
+ESCALATIONS = REGISTRY.counter(
+    "cctv_cascade_escalations_total",
+    "Frames escalated to the accurate model, by reason",
+    ("reason",),
+)
+
+# answers showing the model couldn't make something out
+UNCERTAIN_VALUES = {"", "unsure", "unknown", "unclear", "n/a", "none"}
+
+
+class EscalationRule:
+    """
+    Decides whether the fast model's answer needs the accurate model.
+
+    Calling the rule with a scene (or None if the answer wasn't valid JSON)
+    returns the reason to escalate, or None to keep the answer.
+    """
+
+    def __init__(
+        self,
+        on_persons=True,
+        on_vehicles=True,
+        on_malformed=True,
+        on_uncertain=True,
+    ):
+        """
+        :param on_persons: bool: escalate scenes with persons
+        :param on_vehicles: bool: escalate scenes with vehicles
+        :param on_malformed: bool: escalate answers that aren't a valid scene
+        :param on_uncertain: bool: escalate scenes with blank or "unsure" fields
+        """
+        self.on_persons = on_persons
+        self.on_vehicles = on_vehicles
+        self.on_malformed = on_malformed
+        self.on_uncertain = on_uncertain
+
+    def __call__(self, scene):
+        if not isinstance(scene, dict) or not all(
+            key in scene for key in Scene.__required_keys__
+        ):
+            return "malformed" if self.on_malformed else None
+        if self.on_persons and scene["persons"]:
+            return "persons"
+        if self.on_vehicles and scene["vehicles"]:
+            return "vehicles"
+        if self.on_uncertain and self._is_uncertain(scene):
+            return "uncertain"
+        return None
+
+    @staticmethod
+    def _is_uncertain(scene):
+        environment = scene["environment"] or {}
+        values = [environment.get("weather"), environment.get("summary")]
+        for person in scene["persons"] or []:
+            values.extend([person.get("gender"), person.get("clothes")])
+        for vehicle in scene["vehicles"] or []:
+            values.extend([vehicle.get("type"), vehicle.get("color")])
+        return any(
+            value is None or str(value).strip().lower() in UNCERTAIN_VALUES
+            for value in values
+        )
+
+
+class ModelCascade:
+    """
+    Two-tier model with the describe_* interface of Model.
+
+    The accurate model's answer replaces the fast one's for escalated
+    frames. If the accurate model fails, the fast answer is kept when it
+    was a valid scene.
+    """
+
+    def __init__(self, fast_model, accurate_model, escalation_rule=None):
+        """
+        :param fast_model: Model: tries every frame, e.g. Model(ModelChoices.FLASH)
+        :param accurate_model: Model: describes escalated frames, e.g. Model(ModelChoices.PRO)
+        :param escalation_rule: callable: scene dict (None if malformed) -> reason
+            to escalate or None (default: EscalationRule())
+        """
+        self.fast_model = fast_model
+        self.accurate_model = accurate_model
+        self.escalation_rule = escalation_rule or EscalationRule()
+        self._lock = threading.Lock()
+        self.calls = {FAST: 0, ACCURATE: 0}
+        self.latency = {FAST: 0.0, ACCURATE: 0.0}
+        self.escalations = {}
+
+    def _request(self, tier, describe, *args, **options):
+        start = time.perf_counter()
+        try:
+            return describe(*args, **options)
+        finally:
+            elapsed = time.perf_counter() - start
+            TIER_SECONDS.observe(elapsed, tier=tier)
+            with self._lock:
+                self.calls[tier] += 1
+                self.latency[tier] += elapsed
+
+    def _escalation(self, scene):
+        reason = self.escalation_rule(scene)
+        if reason is not None:
+            ESCALATIONS.inc(reason=reason)
+            with self._lock:
+                self.escalations[reason] = self.escalations.get(reason, 0) + 1
+        return reason
+
+    @staticmethod
+    def _loads(response):
+        try:
+            return parse_json(response)
+        except ValueError:
+            return None
+
+    def split_batch_response(self, response, timestamps):
+        return self.fast_model.split_batch_response(response, timestamps)
+
+    def describe_image_from_blob(self, image_blob, prompt="", on_text=None):
+        """
+        See Model.describe_image_from_blob.
+
+        Both tiers stream to on_text, the accurate model's text starting over.
+        """
+        options = {"on_text": on_text} if on_text is not None else {}
+        response = self._request(
+            FAST,
+            self.fast_model.describe_image_from_blob,
+            image_blob,
+            prompt,
+            **options,
+        )
+        scene = self._loads(response)
+        reason = self._escalation(scene)
+        if reason is None:
+            return response
+
+        LOG.info(f"Escalating frame to the accurate model ({reason})")
+        try:
+            return self._request(
+                ACCURATE,
+                self.accurate_model.describe_image_from_blob,
+                image_blob,
+                prompt,
+                **options,
+            )
+        except Exception:
+            if reason == "malformed":
+                raise
+            LOG.exception("Accurate model failed, keeping the fast model's scene")
+            return response
+
+    def describe_images_from_blobs(self, image_blobs, timestamps, prompt=""):
+        """
+        See Model.describe_images_from_blobs.
+
+        The escalated frames of the batch are sent together in a second batch.
+        """
+        response = self._request(
+            FAST,
+            self.fast_model.describe_images_from_blobs,
+            image_blobs,
+            timestamps,
+            prompt,
+        )
+        try:
+            scenes = [
+                scene for _, scene in self.split_batch_response(response, timestamps)
+            ]
+        except ValueError:
+            # can't tell which scene is which, the whole batch is malformed
+            scenes = [None] * len(image_blobs)
+
+        escalated = [
+            index
+            for index, scene in enumerate(scenes)
+            if self._escalation(scene) is not None
+        ]
+        if not escalated:
+            return response
+
+        LOG.info(f"Escalating {len(escalated)} of {len(scenes)} frames")
+        escalated_timestamps = [timestamps[index] for index in escalated]
+        try:
+            accurate_response = self._request(
+                ACCURATE,
+                self.accurate_model.describe_images_from_blobs,
+                [image_blobs[index] for index in escalated],
+                escalated_timestamps,
+                prompt,
+            )
+            accurate_scenes = self.accurate_model.split_batch_response(
+                accurate_response, escalated_timestamps
+            )
+        except Exception:
+            if any(scenes[index] is None for index in escalated):
+                raise
+            LOG.exception("Accurate model failed, keeping the fast model's scenes")
+            return response
+
+        for index, (_, scene) in zip(escalated, accurate_scenes):
+            scenes[index] = scene
+        return json.dumps(scenes)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "calls": dict(self.calls),
+                "mean_latency": {
+                    tier: self.latency[tier] / self.calls[tier]
+                    for tier in self.calls
+                    if self.calls[tier]
+                },
+                "escalations": dict(self.escalations),
+            }
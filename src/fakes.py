@@ -0,0 +1,215 @@
+"""
+Local stand-ins for the Gemini model and the database.
+
+They let the runner (and the benchmarks) run without an API key or a
+MongoDB instance:
+
+>> runner = CCTVLoggerRunner(
+>>     camera=VideoFileSource("/path/to/doorstep.mp4", speed=None),
+>>     model=FakeModel(latency=2.0, error_rate=0.05),
+>>     client=InMemoryClient(),
+>> )
+"""
+
+import itertools
+import json
+import random
+import threading
+import time
+from datetime import datetime, timezone
+
+from google.api_core import exceptions as api_exceptions
+
+from src.model import Model
+from src.mongo_client import MongoClient
+from src.reid import SightingIndex
+from src.sightings import RollingSightings
+from src.store import LocalCountsDocument, MongoDocument
+
+CANNED_SCENES = [
+    {
+        "environment": {"weather": "overcast", "summary": "Empty street, parked cars."},
+        "persons": [],
+        "vehicles": [{"type": "van", "color": "white"}],
+    },
+    {
+        "environment": {"weather": "sunny", "summary": "A man walks past the door."},
+        "persons": [{"clothes": "blue jacket and jeans", "gender": "male"}],
+        "vehicles": [{"type": "van", "color": "white"}],
+    },
+    {
+        "environment": {"weather": "sunny", "summary": "Two people cycling by."},
+        "persons": [
+            {"clothes": "red coat", "gender": "female"},
+            {"clothes": "black hoodie", "gender": "unsure"},
+        ],
+        "vehicles": [{"type": "bicycle", "color": "green"}],
+    },
+]
+
+
+# pieces a streamed response is split into
+STREAM_CHUNKS = 4
+
+
+class FakeModelError(api_exceptions.ServiceUnavailable):
+    "Raised by FakeModel to simulate a failed request (a 503, so it is retried)"
+
+
+class FakeModel:
+    """
+    Pretends to be a Model: waits for a configurable latency and returns
+    canned scenes, in turn, as JSON text.
+    """
+
+    split_batch_response = staticmethod(Model.split_batch_response)
+    default_prompt = Model.BASIC_PROMPT + Model.JSON_PROMPT
+    batch_prompt = (
+        Model.BATCH_PROMPT
+        + Model.BASIC_PROMPT
+        + Model.JSON_PROMPT
+        + Model.BATCH_JSON_PROMPT
+    )
+
+    def __init__(self, latency=1.0, jitter=0.0, error_rate=0.0, scenes=None, seed=None):
+        """
+        :param latency: float: mean seconds per request
+        :param jitter: float: standard deviation of the latency
+        :param error_rate: float: probability of a request raising FakeModelError
+        :param scenes: list: scenes returned in turn (default: CANNED_SCENES)
+        :param seed: int: seed of the random generator, for reproducible runs
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self._scenes = itertools.cycle(scenes or CANNED_SCENES)
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+
+    def _request(self, response="", on_text=None):
+        with self._lock:
+            self.requests += 1
+            delay = max(0.0, self._random.gauss(self.latency, self.jitter))
+            failed = self._random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+        if on_text is None:
+            time.sleep(delay)
+        else:
+            # the response arrives in STREAM_CHUNKS pieces over the latency
+            for chunk in range(1, STREAM_CHUNKS + 1):
+                time.sleep(delay / STREAM_CHUNKS)
+                if failed and chunk > STREAM_CHUNKS // 2:
+                    break
+                on_text(response[: len(response) * chunk // STREAM_CHUNKS])
+        if failed:
+            raise FakeModelError("Simulated model error")
+        return response
+
+    def _next_scene(self):
+        with self._lock:
+            return next(self._scenes)
+
+    def describe_image_from_blob(self, image_blob, prompt="", on_text=None):
+        return self._request(json.dumps(self._next_scene()), on_text)
+
+    def describe_images_from_blobs(self, image_blobs, timestamps, prompt=""):
+        return self._request(json.dumps([self._next_scene() for _ in image_blobs]))
+
+
+class InMemoryClient:
+    """
+    Keeps scenes in memory, with the part of the MongoClient interface used
+    by the runner and the bulk writer.
+
+    For the full interface without a server, use open_store("sqlite:///:memory:")
+    or MongoClient("mongomock://") (requires the mongomock package) instead.
+    """
+
+    default_collection = "camera0"
+
+    def __init__(self, sightings_window=3600, sighting_index_window=None):
+        self._collections = {}
+        self._lock = threading.Lock()
+        self._sightings = {}
+        self._sighting_indexes = {}
+        self.sightings_window = sightings_window
+        self.sighting_index_window = sighting_index_window
+
+    def _documents(self, collection):
+        return self._collections.setdefault(collection or self.default_collection, [])
+
+    def insert_scene(
+        self, scene, timestamp=None, db=None, collection=None, crop=None, frame=None
+    ):
+        timestamp = timestamp or datetime.now(tz=timezone.utc)
+        # Pydantic performs validation for us
+        document = MongoDocument(
+            scene=scene, timestamp=timestamp, crop=crop, frame=frame
+        ).dict()
+        self.insert_documents([document], collection=collection)
+
+    def insert_documents(self, documents, db=None, collection=None, write_concern=None):
+        with self._lock:
+            self._documents(collection).extend(documents)
+        index = self.sighting_index(collection=collection)
+        for document in documents:
+            self.rolling_sightings(collection=collection).add(
+                document["scene"], document["timestamp"]
+            )
+            if index is not None:
+                index.add(document["scene"], document["timestamp"])
+
+    def insert_detections(self, counts, timestamp=None, db=None, collection=None):
+        timestamp = timestamp or datetime.now(tz=timezone.utc)
+        document = LocalCountsDocument(timestamp=timestamp, **counts).dict()
+        collection = (collection or self.default_collection) + (
+            MongoClient.detections_suffix
+        )
+        with self._lock:
+            self._documents(collection).append(document)
+
+    def rolling_sightings(self, db=None, collection=None):
+        collection = collection or self.default_collection
+        with self._lock:
+            if collection not in self._sightings:
+                self._sightings[collection] = RollingSightings(
+                    window=self.sightings_window
+                )
+            return self._sightings[collection]
+
+    def sighting_index(self, db=None, collection=None):
+        if self.sighting_index_window is None:
+            return None
+        collection = collection or self.default_collection
+        with self._lock:
+            if collection not in self._sighting_indexes:
+                self._sighting_indexes[collection] = SightingIndex(
+                    window=self.sighting_index_window
+                )
+            return self._sighting_indexes[collection]
+
+    def get_latest_scene(self, db=None, collection=None, verbose=False):
+        with self._lock:
+            documents = self._documents(collection)
+            latest = max(documents, key=lambda d: d["timestamp"], default={})
+        return {"scene": latest.get("scene"), "timestamp": latest.get("timestamp")}
+
+    def get_scenes_in_timerange(
+        self, start_time, end_time=None, db=None, collection=None, verbose=False
+    ):
+        end_time = end_time or datetime.now(tz=timezone.utc)
+        with self._lock:
+            documents = sorted(
+                self._documents(collection), key=lambda d: d["timestamp"]
+            )
+        res = [d for d in documents if start_time <= d["timestamp"] <= end_time]
+        if verbose:
+            return [(d["scene"], d["timestamp"]) for d in res]
+        return [d["scene"] for d in res]
+
+    def count(self, collection=None):
+        with self._lock:
+            return len(self._documents(collection))
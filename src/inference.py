@@ -0,0 +1,426 @@
+"""
+Module for sending requests to the model concurrently, within quota.
+
+InferenceEngine wraps a Model (or anything with the same describe_*
+methods) and can be used in its place:
+
+>> model = InferenceEngine(Model(ModelChoices.PRO), max_in_flight=4, requests_per_minute=360)
+>> runner = CCTVLoggerRunner(model=model)
+
+Every request
+1. waits for one of max_in_flight slots,
+2. waits for the token buckets matching the RPM and TPM quotas,
+3. runs with a deadline, and is retried with jittered exponential backoff
+   if it fails with a transient error (quota, unavailable, timeout),
+4. optionally gets a hedged duplicate when it takes longer than the
+   recent p95 latency; the first response wins.
+
+Each request sent, retries and hedges included, is also charged to an
+optional budget bucket, see AdaptiveScheduler.budget.
+
+A request past its deadline is abandoned but keeps its slot until the
+client library gives up, so give the Model a request_timeout as well.
+"""
+
+import logging
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from google.api_core import exceptions as api_exceptions
+
+from src.metrics import REGISTRY
+
+LOG = logging.getLogger("cctv_logger")
+
+# Gemini 1.5 bills each image as a fixed number of tokens, whatever its size
+IMAGE_TOKENS = 258
+# rough allowance for the JSON response, counted against the TPM quota
+RESPONSE_TOKENS = 400
+
+# errors worth retrying, anything else (e.g. a malformed request) fails at once
+TRANSIENT_ERRORS = (
+    api_exceptions.TooManyRequests,
+    api_exceptions.ResourceExhausted,
+    api_exceptions.ServiceUnavailable,
+    api_exceptions.InternalServerError,
+    api_exceptions.GatewayTimeout,
+    api_exceptions.DeadlineExceeded,
+    ConnectionError,
+    TimeoutError,
+)
+
+REQUESTS = REGISTRY.counter(
+    "cctv_model_requests_total",
+    "Model requests sent, by result (ok, error, timeout)",
+    ("result",),
+)
+RETRIES = REGISTRY.counter(
+    "cctv_model_retries_total",
+    "Model requests retried after a transient error, by error",
+    ("error",),
+)
+HEDGES = REGISTRY.counter(
+    "cctv_model_hedges_total",
+    "Hedged duplicate requests, by outcome (sent, won)",
+    ("outcome",),
+)
+THROTTLE_SECONDS = REGISTRY.histogram(
+    "cctv_model_throttle_seconds",
+    "Time requests waited for a slot and for the rate limits",
+)
+
+
+class RequestDeadlineExceeded(TimeoutError):
+    "Raised when a model request doesn't complete before its deadline"
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket: `rate` tokens per second, up to `capacity`.
+
+    >> bucket = TokenBucket(rate=360 / 60, capacity=360 / 60)
+    >> bucket.acquire()  # blocks until a token is available
+    """
+
+    def __init__(self, rate, capacity=None):
+        """
+        :param rate: float: tokens added per second
+        :param capacity: float: maximum tokens, i.e. the largest burst (default: rate)
+        """
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(
+            self.capacity, self._tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
+
+    def try_acquire(self, amount=1):
+        """Takes `amount` tokens if available right now, returns whether it did."""
+        # a request bigger than the bucket would never go through
+        amount = min(amount, self.capacity)
+        with self._lock:
+            self._refill()
+            if self._tokens >= amount:
+                self._tokens -= amount
+                return True
+            return False
+
+    def acquire(self, amount=1, timeout=None):
+        """
+        Blocks until `amount` tokens are available and takes them.
+
+        :return: bool: False if they weren't available within timeout seconds
+        """
+        amount = min(amount, self.capacity)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= amount:
+                    self._tokens -= amount
+                    return True
+                wait = (amount - self._tokens) / self.rate
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                wait = min(wait, remaining)
+            time.sleep(wait)
+
+    def set_rate(self, rate, capacity=None):
+        "Changes the rate (and capacity) from now on, keeping the tokens earned so far"
+        with self._lock:
+            self._refill()
+            self.rate = rate
+            self.capacity = capacity or rate
+            self._tokens = min(self._tokens, self.capacity)
+
+    def available(self):
+        "Tokens available right now"
+        with self._lock:
+            self._refill()
+            return self._tokens
+
+    def charge(self, amount=1):
+        "Takes tokens without waiting, going into debt if there aren't enough"
+        with self._lock:
+            self._refill()
+            self._tokens -= amount
+
+    def release(self, amount=1):
+        "Gives back tokens taken for a request that wasn't sent"
+        with self._lock:
+            self._tokens = min(self.capacity, self._tokens + amount)
+
+    def drain(self):
+        "Empties the bucket, e.g. when the server says the quota is exhausted"
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens, 0)
+
+
+class InferenceEngine:
+    """
+    Runs model requests on a bounded pool of threads, with rate limiting,
+    deadlines, retries and hedging. Has the describe_* interface of Model.
+    """
+
+    def __init__(
+        self,
+        model,
+        max_in_flight=4,
+        requests_per_minute=None,
+        tokens_per_minute=None,
+        deadline=60.0,
+        max_retries=3,
+        backoff=1.0,
+        max_backoff=30.0,
+        hedge_quantile=None,
+        hedge_min_samples=20,
+        retry_on=TRANSIENT_ERRORS,
+        budget=None,
+    ):
+        """
+        :param model: Model: model sending the requests
+        :param max_in_flight: int: maximum number of requests running at once,
+            hedged duplicates included
+        :param requests_per_minute: float: RPM quota (None: unlimited)
+        :param tokens_per_minute: float: TPM quota, requests are counted with an
+            estimate of their tokens (None: unlimited)
+        :param deadline: float: seconds a single attempt may take once sent,
+            waiting for a slot or for quota excluded (None: no deadline)
+        :param max_retries: int: attempts after the first one on transient errors
+        :param backoff: float: base of the exponential backoff, in seconds
+        :param max_backoff: float: longest wait between two attempts
+        :param hedge_quantile: float: send a duplicate request when the first one
+            takes longer than this quantile of recent latencies, e.g. 0.95
+            (None disables hedging)
+        :param hedge_min_samples: int: latencies needed before hedging starts
+        :param retry_on: tuple: exception types retried
+        :param budget: TokenBucket: charged one token per request sent, without
+            waiting for it, e.g. AdaptiveScheduler.budget (None: no budget)
+        """
+        self.model = model
+        self.max_in_flight = max_in_flight
+        self.deadline = deadline
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_samples = hedge_min_samples
+        self.retry_on = retry_on
+        self.budget = budget
+
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_in_flight, thread_name_prefix="inference"
+        )
+        # bursts are capped at ten seconds worth of quota, so that a burst
+        # followed by the steady rate can't go over the per-minute limit
+        self._requests = (
+            TokenBucket(requests_per_minute / 60, capacity=requests_per_minute / 6)
+            if requests_per_minute
+            else None
+        )
+        self._tokens = (
+            TokenBucket(tokens_per_minute / 60, capacity=tokens_per_minute / 6)
+            if tokens_per_minute
+            else None
+        )
+        self._latencies = deque(maxlen=200)
+        self._lock = threading.Lock()
+        self._random = random.Random()
+
+    def __getattr__(self, name):
+        # clear_uploads(), prompts... but no request that would bypass the
+        # slots, quotas, retries and budget
+        if name == "model" or name.startswith("describe_"):
+            raise AttributeError(f"{type(self).__name__} has no attribute {name!r}")
+        return getattr(self.model, name)
+
+    def split_batch_response(self, response, timestamps):
+        return self.model.split_batch_response(response, timestamps)
+
+    def describe_image_from_blob(self, image_blob, prompt="", on_text=None):
+        """
+        See Model.describe_image_from_blob.
+
+        Only the first request of an attempt streams to on_text, not its hedge,
+        and requests abandoned at the deadline stop streaming to it.
+        """
+        tokens = self.estimate_tokens(1, prompt or self.model.default_prompt)
+        return self._call(
+            self.model.describe_image_from_blob, (image_blob, prompt), tokens, on_text
+        )
+
+    def describe_image_from_path(self, image_path, prompt="", verbose=False):
+        """See Model.describe_image_from_path."""
+        tokens = self.estimate_tokens(1, prompt or self.model.default_prompt)
+        return self._call(
+            self.model.describe_image_from_path, (image_path, prompt, verbose), tokens
+        )
+
+    def describe_images_from_blobs(self, image_blobs, timestamps, prompt=""):
+        """See Model.describe_images_from_blobs."""
+        tokens = self.estimate_tokens(
+            len(image_blobs), prompt or self.model.batch_prompt, len(image_blobs)
+        )
+        return self._call(
+            self.model.describe_images_from_blobs,
+            (image_blobs, timestamps, prompt),
+            tokens,
+        )
+
+    @staticmethod
+    def estimate_tokens(images, prompt, responses=1):
+        "Rough token count of a request, about 4 characters per text token"
+        return images * IMAGE_TOKENS + len(prompt) // 4 + responses * RESPONSE_TOKENS
+
+    def _call(self, func, args, tokens, on_text=None):
+        for attempt in range(self.max_retries + 1):
+            try:
+                return self._attempt(func, args, tokens, on_text)
+            except self.retry_on as error:
+                if isinstance(error, api_exceptions.ResourceExhausted):
+                    # we went over quota anyway, make every caller slow down
+                    for bucket in (self._requests, self._tokens):
+                        if bucket is not None:
+                            bucket.drain()
+                if attempt == self.max_retries:
+                    raise
+                RETRIES.inc(error=type(error).__name__)
+                # "full jitter" keeps callers failing together from retrying together
+                delay = self._random.uniform(
+                    0, min(self.max_backoff, self.backoff * 2**attempt)
+                )
+                LOG.warning(
+                    f"Model request failed ({error!r}), retrying in {delay:.1f}s "
+                    f"({attempt + 1}/{self.max_retries})"
+                )
+                time.sleep(delay)
+
+    def _attempt(self, func, args, tokens, on_text=None):
+        if on_text is None:
+            return self._wait(func, args, tokens, {})
+
+        streaming = [on_text]
+
+        def relay(text):
+            if streaming:
+                streaming[0](text)
+
+        try:
+            return self._wait(func, args, tokens, {"on_text": relay})
+        finally:
+            streaming.clear()
+
+    def _wait(self, func, args, tokens, options):
+        pending = {self._launch(func, args, tokens, options)}
+        # waiting for a slot or for quota is backpressure, not part of the deadline
+        deadline = None if self.deadline is None else time.monotonic() + self.deadline
+        hedged = None
+
+        hedge_after = self._hedge_delay()
+        if hedge_after is not None:
+            done, _ = wait(pending, timeout=hedge_after)
+            # hedge only with spare capacity, it must never wait for quota
+            if not done and self._try_reserve(tokens):
+                hedged = self._executor.submit(self._run, func, args)
+                pending.add(hedged)
+                HEDGES.inc(outcome="sent")
+                LOG.info(f"Model request slower than {hedge_after:.1f}s, hedging")
+
+        error = None
+        while pending:
+            timeout = None if deadline is None else max(0, deadline - time.monotonic())
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                if future.exception() is None:
+                    if future is hedged:
+                        HEDGES.inc(outcome="won")
+                    return future.result()
+                error = future.exception()
+        if error is not None and not pending:
+            raise error
+        # abandoned requests keep their slot until they return, see request_timeout
+        REQUESTS.inc(result="timeout")
+        raise RequestDeadlineExceeded(
+            f"Model request took longer than {self.deadline}s"
+        )
+
+    def _launch(self, func, args, tokens, options):
+        """Waits for a slot and for the rate limits, then starts the request."""
+        start = time.monotonic()
+        self._slots.acquire()
+        for bucket, amount in ((self._requests, 1), (self._tokens, tokens)):
+            if bucket is not None:
+                bucket.acquire(amount)
+        THROTTLE_SECONDS.observe(time.monotonic() - start)
+        if self.budget is not None:
+            self.budget.charge()
+        return self._executor.submit(self._run, func, args, options)
+
+    def _try_reserve(self, tokens):
+        "Takes a slot and the rate limit tokens only if they are free right now"
+        if not self._slots.acquire(blocking=False):
+            return False
+        if self._requests is not None and not self._requests.try_acquire(1):
+            self._slots.release()
+            return False
+        if self._tokens is not None and not self._tokens.try_acquire(tokens):
+            if self._requests is not None:
+                self._requests.release(1)
+            self._slots.release()
+            return False
+        if self.budget is not None:
+            self.budget.charge()
+        return True
+
+    def _run(self, func, args, options=None):
+        "Runs on an executor thread, holding a slot taken by the caller"
+        start = time.monotonic()
+        try:
+            result = func(*args, **(options or {}))
+        except Exception:
+            REQUESTS.inc(result="error")
+            raise
+        finally:
+            self._slots.release()
+        REQUESTS.inc(result="ok")
+        with self._lock:
+            self._latencies.append(time.monotonic() - start)
+        return result
+
+    def _hedge_delay(self):
+        """Latency after which to hedge, None if hedging is off or not ready."""
+        if self.hedge_quantile is None:
+            return None
+        with self._lock:
+            if len(self._latencies) < self.hedge_min_samples:
+                return None
+            latencies = sorted(self._latencies)
+        index = min(len(latencies) - 1, int(self.hedge_quantile * len(latencies)))
+        return latencies[index]
+
+    def stats(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+        return {
+            "max_in_flight": self.max_in_flight,
+            "p50_latency": latencies[len(latencies) // 2] if latencies else None,
+            "hedge_after": self._hedge_delay(),
+        }
+
+    def close(self):
+        self._executor.shutdown(wait=False)
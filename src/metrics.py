@@ -0,0 +1,314 @@
+"""
+Module for in-process metrics, exposed in the Prometheus text format.
+
+Counters and histograms are cheap enough for the hot path: an update takes
+a lock and bumps a few numbers, there is no I/O. Components register their
+metrics on the shared REGISTRY when they are imported:
+
+>> MODEL_SECONDS = REGISTRY.histogram("cctv_model_request_seconds", "...", ("camera",))
+>> with MODEL_SECONDS.time(camera="camera0"):
+>>     response = model.describe_image_from_blob(blob)
+
+and REGISTRY.render() returns the text served at /metrics.
+
+SamplingProfiler is an optional hook that samples the stacks of the
+pipeline's worker threads, to see where the time goes inside a stage.
+"""
+
+import bisect
+import logging
+import math
+import sys
+import threading
+import time
+import traceback
+from abc import ABC, abstractmethod
+from collections import Counter as StackCounter
+from contextlib import contextmanager
+
+LOG = logging.getLogger("cctv_logger")
+
+# seconds, from a cache hit to a slow model request
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# bytes, from a small thumbnail to a full-resolution PNG
+SIZE_BUCKETS = (2**10, 2**13, 2**15, 2**17, 2**19, 2**20, 2**21, 2**22, 2**23)
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n"))
+        for name, value in pairs
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class _Metric(ABC):
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        """
+        :param name: str: metric name, e.g. cctv_frames_total
+        :param documentation: str: help text
+        :param labelnames: tuple: names of the labels every update must give
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}")
+        return tuple(labels[name] for name in self.labelnames)
+
+    @abstractmethod
+    def _samples(self):
+        "Yields the (name, rendered labels, value) of every sample"
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        lines.extend(
+            f"{name}{labels} {_format_value(value)}"
+            for name, labels, value in self._samples()
+        )
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    "A value that only goes up, e.g. the number of skipped frames"
+
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield self.name, _format_labels(self.labelnames, key), value
+
+
+class Gauge(_Metric):
+    """
+    A value read when the metrics are rendered.
+
+    func returns either a number, or a dict mapping label value tuples to
+    numbers, so gauges can expose the stats() of existing components.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, documentation, func, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.func = func
+
+    def _samples(self):
+        try:
+            values = self.func()
+        except Exception:
+            LOG.exception(f"Could not collect {self.name}")
+            return
+        if not isinstance(values, dict):
+            values = {(): values}
+        for key, value in sorted(values.items()):
+            if value is not None:
+                yield self.name, _format_labels(self.labelnames, key), value
+
+
+class Histogram(_Metric):
+    "Counts observations in cumulative buckets, with their sum"
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # one count per bucket, then +Inf, then the sum
+                counts = self._values[key] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        "Observes the duration of the block, also when it raises"
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels):
+        counts = self._values.get(self._key(labels))
+        return sum(counts[:-1]) if counts else 0
+
+    def _samples(self):
+        with self._lock:
+            values = sorted((key, list(counts)) for key, counts in self._values.items())
+        for key, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts[:-1]):
+                cumulative += count
+                labels = _format_labels(
+                    self.labelnames, key, [("le", _format_value(bound))]
+                )
+                yield f"{self.name}_bucket", labels, cumulative
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_sum", labels, counts[-1]
+            yield f"{self.name}_count", labels, cumulative
+
+
+class Registry:
+    """
+    Collection of metrics, rendered together.
+
+    Asking twice for the same name returns the same metric, so modules can
+    declare their metrics at import time without coordinating.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f"{name} is already registered as a {metric.kind}")
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._get_or_create(Counter, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._get_or_create(
+            Histogram, name, documentation, labelnames, buckets=buckets
+        )
+
+    def gauge(self, name, documentation, func, labelnames=()):
+        """Registers a gauge, replacing an existing one (e.g. after a restart)."""
+        with self._lock:
+            self._metrics[name] = Gauge(name, documentation, func, labelnames)
+            return self._metrics[name]
+
+    def unregister(self, name):
+        with self._lock:
+            self._metrics.pop(name, None)
+
+    def render(self):
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda metric: metric.name)
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of some threads at a fixed interval.
+
+    Collects how often each stack was seen, in the "folded" format read by
+    flamegraph tools (frames separated by semicolons, then the count).
+    Sampling runs on its own thread and only walks frame objects, so the
+    overhead stays low even with interval=0.01.
+
+    >> profiler = SamplingProfiler(thread_prefix="pipeline-")
+    >> profiler.start()
+    >> print(profiler.folded())
+    """
+
+    def __init__(self, interval=0.01, thread_prefix="", max_depth=40):
+        """
+        :param interval: float: seconds between samples
+        :param thread_prefix: str: only sample threads whose name starts with it
+        :param max_depth: int: innermost frames kept per stack
+        """
+        self.interval = interval
+        self.thread_prefix = thread_prefix
+        self.max_depth = max_depth
+        self.samples = 0
+        self._stacks = StackCounter()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="sampling-profiler", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            names = {
+                thread.ident: thread.name
+                for thread in threading.enumerate()
+                if thread.name.startswith(self.thread_prefix)
+            }
+            stacks = []
+            for ident, frame in sys._current_frames().items():
+                if ident == own or ident not in names:
+                    continue
+                entries = traceback.extract_stack(frame, limit=self.max_depth)
+                stacks.append(
+                    ";".join(
+                        [names[ident]]
+                        + [
+                            f"{entry.name} ({entry.filename}:{entry.lineno})"
+                            for entry in entries
+                        ]
+                    )
+                )
+            with self._lock:
+                self.samples += 1
+                self._stacks.update(stacks)
+
+    def folded(self):
+        with self._lock:
+            stacks = self._stacks.most_common()
+        return "".join(f"{stack} {count}\n" for stack, count in stacks)
+
+    def reset(self):
+        with self._lock:
+            self.samples = 0
+            self._stacks.clear()
@@ -4,13 +4,15 @@ Module for interacting with Google's Gemini models.
 See e.g. list(genai.list_models()) for a comprehensive list.
 """
 
-import json
 import mimetypes
+import typing
 from enum import Enum
 
 import google.generativeai as genai
 
+from src.parsing import parse_json
 from src.schemas import Scene
+from src.uploads import UploadCache
 
 IMAGE_MIMETYPES = ["image/png", "image/jpeg", "image/webp", "image/heic", "image/heif"]
 
@@ -38,6 +40,13 @@ class ModelChoices(str, Enum):
         return [c.value for c in cls]
 
 
+# (requests, tokens) per minute quota of each model, see InferenceEngine
+MODEL_QUOTAS = {
+    ModelChoices.FLASH: (1000, 4_000_000),
+    ModelChoices.PRO: (360, 4_000_000),
+}
+
+
 class Model:
     """
     Basic Class for interfacing with Google's Gemini Models.
@@ -71,18 +80,48 @@ class Model:
     }
     """
 
-    def __init__(self, model_choice: ModelChoices):
+    BATCH_PROMPT = """
+    You are given {count} images taken by the same camera, in chronological order, each preceded by its capture time. Describe every image separately, as follows.
+    """
+
+    BATCH_JSON_PROMPT = """
+    Return a JSON list with exactly {count} elements, one per image, in the same order as the images.
+    """
+
+    def __init__(
+        self, model_choice: ModelChoices, request_timeout=None, upload_cache=None
+    ):
+        """
+        :param model_choice: ModelChoices: which Gemini model to use
+        :param request_timeout: float: seconds after which requests are abandoned
+            (default: the client library's)
+        :param upload_cache: UploadCache: files uploaded by describe_image_from_path,
+            share one between models to share the uploads (defaults to UploadCache())
+        """
         # Set the relevant JSON response if using newest models
         config = {}
+        batch_config = {}
         if model_choice == ModelChoices.FLASH:
             config["response_mime_type"] = "application/json"
+            batch_config["response_mime_type"] = "application/json"
             self.default_prompt = self.BASIC_PROMPT + self.JSON_PROMPT
+            self.batch_prompt = (
+                self.BATCH_PROMPT
+                + self.BASIC_PROMPT
+                + self.JSON_PROMPT
+                + self.BATCH_JSON_PROMPT
+            )
         elif model_choice == ModelChoices.PRO:
             # formal response schema declaration is supposed to work better
             config["response_mime_type"] = "application/json"
             config["response_schema"] = Scene
+            batch_config["response_mime_type"] = "application/json"
+            batch_config["response_schema"] = typing.List[Scene]
             # model PRO works without JSON_PROMPT due to config response_schema above
             self.default_prompt = self.BASIC_PROMPT
+            self.batch_prompt = (
+                self.BATCH_PROMPT + self.BASIC_PROMPT + self.BATCH_JSON_PROMPT
+            )
         else:  # 1.0 cannot process images
             raise ValueError(
                 "Model Gemini 1.0 cannot read images, so not supproted yet."
@@ -91,12 +130,21 @@ class Model:
         self._model = genai.GenerativeModel(
             ModelChoices.api_name(model_choice), generation_config=config
         )
-        self.uploaded_files = []
+        self._batch_config = batch_config
+        self._request_options = (
+            {"timeout": request_timeout} if request_timeout is not None else None
+        )
+        self.upload_cache = upload_cache or UploadCache()
+
+    @property
+    def uploaded_files(self):
+        return self.upload_cache.files()
 
     def describe_image_from_path(self, image_path, prompt="", verbose=False):
         """
         Describes image using Google's model given a file path.
-        Keeps pointer to image uploaded in object's cache.
+        The upload is cached by content, describing the same image again
+        reuses it (see src.uploads.UploadCache).
 
         :param image_path: str: path for image
         :param prompt: str: prompt for the model. model-dependent default set by class and __init__
@@ -107,47 +155,99 @@ class Model:
         mime, _ = mimetypes.guess_type(image_path)
         assert mime in IMAGE_MIMETYPES, f"Unsupported filetype: {mime}"
 
-        uploaded_file = genai.upload_file(path=image_path)
-        self.uploaded_files.append(uploaded_file)
-        if verbose:
-            print(
-                f"Uploaded file '{uploaded_file.display_name}' as: {uploaded_file.uri}."
-            )
+        uploaded_file = self.upload_cache.get(image_path, verbose=verbose)
 
         # Recommendation is to place prompt after image if using a single image
         prompt = prompt or self.default_prompt
-        response = self._model.generate_content([uploaded_file, prompt])
+        response = self._model.generate_content(
+            [uploaded_file, prompt], request_options=self._request_options
+        )
 
         return uploaded_file, response.text
 
-    def describe_image_from_blob(self, image_blob, prompt=""):
+    def describe_image_from_blob(self, image_blob, prompt="", on_text=None):
         """
         Describes image using Google's model given a blob object
         representing a PNG image.
 
         :param image_blob: genai.protos.Blob: Blob representing a PNG image
         :param prompt: str: prompt for the model. model-dependent default set by class and __init__
+        :param on_text: callable: when given, the response is streamed and
+            on_text is called with the text received so far after every chunk,
+            e.g. a src.parsing.SceneStream
 
         :return: model response
         """
         prompt = prompt or self.default_prompt
-        response = self._model.generate_content([image_blob, prompt])
+        if on_text is None:
+            response = self._model.generate_content(
+                [image_blob, prompt], request_options=self._request_options
+            )
+            return response.text
+
+        response = self._model.generate_content(
+            [image_blob, prompt], stream=True, request_options=self._request_options
+        )
+        text = ""
+        for chunk in response:
+            try:
+                text += chunk.text
+            except ValueError:
+                # a chunk without text, e.g. the last one with the finish reason
+                continue
+            on_text(text)
+        return text
+
+    def describe_images_from_blobs(self, image_blobs, timestamps, prompt=""):
+        """
+        Describes several images in a single request, one scene per image.
+
+        Each image is labelled with its capture time so the model can tell them
+        apart; use split_batch_response() to pair the scenes with the timestamps.
+
+        :param image_blobs: list: genai.protos.Blob objects, in chronological order
+        :param timestamps: list: datetime when each image was captured
+        :param prompt: str: prompt for the model, "{count}" is replaced by the number
+            of images (model-dependent default set by class and __init__)
 
+        :return: model response, a JSON list of scenes
+        """
+        assert len(image_blobs) == len(timestamps), "One timestamp per image needed"
+
+        contents = []
+        for i, (image_blob, timestamp) in enumerate(zip(image_blobs, timestamps)):
+            contents.append(f"Image {i + 1}, captured at {timestamp.isoformat()}:")
+            contents.append(image_blob)
+        prompt = prompt or self.batch_prompt
+        # not str.format(): the JSON prompts contain braces of their own
+        contents.append(prompt.replace("{count}", str(len(image_blobs))))
+
+        response = self._model.generate_content(
+            contents,
+            generation_config=self._batch_config,
+            request_options=self._request_options,
+        )
         return response.text
 
-    def clear_uploads(self):
+    @staticmethod
+    def split_batch_response(response, timestamps):
         """
-        Deletes uploaded images from server and resets the cache
+        Pairs the scenes of a batch response with the timestamps of the images.
+
+        :param response: str: model response from describe_images_from_blobs()
+        :param timestamps: list: datetime when each image was captured
+
+        :return: list of (timestamp, scene dict) tuples
         """
-        for file in self.uploaded_files:
-            genai.delete_file(file.name)
-        self.uploaded_files = []
+        scenes = parse_json(response)
+        if not isinstance(scenes, list) or len(scenes) != len(timestamps):
+            raise ValueError(
+                f"Expected a list of {len(timestamps)} scenes, got: {response}"
+            )
+        return list(zip(timestamps, scenes))
 
-    @staticmethod
-    def parse_json(maybe_json):
-        try:
-            parsed_json = json.loads(maybe_json)
-            return parsed_json
-        except ValueError as e:
-            print(f"{e}: Not a JSON, you might want to check it properly.")
-            return None
+    def clear_uploads(self):
+        """
+        Deletes uploaded images from server, in parallel, and resets the cache
+        """
+        self.upload_cache.clear()
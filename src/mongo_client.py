@@ -1,29 +1,104 @@
+from collections import Counter
 from datetime import datetime, timezone
 
-from pydantic import BaseModel as PydanticModel
+from bson import ObjectId
 from pymongo import MongoClient as PymongoClient
-from pymongo import ASCENDING, DESCENDING
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+from pymongo.errors import BulkWriteError, ConnectionFailure
+from pymongo.write_concern import WriteConcern
 
-from src.schemas import Scene
+from src.sightings import (
+    KEY_FIELDS,
+    PERSON,
+    VEHICLE,
+    hour_start,
+    rollup_increments,
+)
+from src.store import LocalCountsDocument, MongoDocument, SceneStore
 
 
-class MongoDocument(PydanticModel):
-    scene: Scene
-    timestamp: datetime
-
-
-class MongoClient:
+class MongoClient(SceneStore):
     "Wrapper around pymongo client for interacting with MongoDB"
 
     protected_db_names = ("admin", "config", "local")
-    default_db = "cctv_logger"
-    default_collection = "camera0"
+    # hourly sighting counts of a collection are stored in "<collection>_hourly"
+    rollup_suffix = "_hourly"
+    # local detector counts of frames not sent to the model, see src.detector
+    detections_suffix = "_local"
+
+    # name of the index on the timestamp of scene documents
+    timestamp_index = "timestamp"
 
-    def __init__(self, uri=None):
+    def __init__(
+        self,
+        uri=None,
+        sightings_window=3600,
+        retention=None,
+        sighting_index_window=None,
+    ):
+        """
+        :param uri: str: mongo connection string (default: local instance),
+            "mongomock://" keeps everything in memory (requires mongomock)
+        :param sightings_window: float: seconds covered by the in-memory rolling
+            sighting counters
+        :param retention: int: seconds after which scenes are deleted by a TTL index
+            (default: scenes are kept forever)
+        :param sighting_index_window: float: seconds of sightings kept in the
+            in-memory similarity index, see src.reid (None disables the index)
+        """
         uri = uri or "mongodb://localhost:27017/"
-        self._client = PymongoClient(uri)
+        if uri.startswith("mongomock://"):
+            # in-memory MongoDB for tests and benchmarks, optional dependency
+            import mongomock
+
+            self._client = mongomock.MongoClient()
+        else:
+            self._client = PymongoClient(uri)
+        super().__init__(
+            sightings_window=sightings_window,
+            retention=retention,
+            sighting_index_window=sighting_index_window,
+        )
+        # (db, collection) pairs whose indexes were already checked
+        self._indexed = set()
+        # _id of documents whose insert_many failed halfway, not counted yet
+        self._unconfirmed = set()
+
+    def ensure_indexes(self, db=None, collection=None):
+        """
+        Creates the timestamp index of a scene collection, as a TTL index if a
+        retention period is set. An existing timestamp index with different
+        options is replaced.
 
-    def insert_scene(self, scene, timestamp=None, db=None, collection=None):
+        :param db: str: mongo database name (if not provided, uses object default)
+        :param collection: str: mongo collection name (if not provided, uses object default)
+        """
+        pymongo_collection = self.get_collection(db=db, collection=collection)
+        options = {}
+        if self.retention is not None:
+            options["expireAfterSeconds"] = int(self.retention)
+
+        existing = pymongo_collection.index_information().get(self.timestamp_index)
+        if existing is not None:
+            if existing.get("expireAfterSeconds") == options.get("expireAfterSeconds"):
+                return
+            pymongo_collection.drop_index(self.timestamp_index)
+        # a single ascending index serves both ascending and descending sorts
+        pymongo_collection.create_index(
+            [("timestamp", ASCENDING)], name=self.timestamp_index, **options
+        )
+
+    def get_scene_collection(self, db=None, collection=None):
+        "Returns a scene collection, making sure it is indexed the first time"
+        key = (db or self.default_db, collection or self.default_collection)
+        if key not in self._indexed:
+            self.ensure_indexes(db=db, collection=collection)
+            self._indexed.add(key)
+        return self.get_collection(db=db, collection=collection)
+
+    def insert_scene(
+        self, scene, timestamp=None, db=None, collection=None, crop=None, frame=None
+    ):
         """
         Insert a scene as captured by model into database
 
@@ -31,24 +106,170 @@ class MongoClient:
         :param timestamp: datetime: time when scene was captured (if not provided, uses now())
         :param db: str: mongo database name (if not provided, uses object default)
         :param collection: str: mongo collection name (if not provided, uses object default)
+        :param crop: CropGeometry: parts of the frame the scene describes (None: whole frame)
+        :param frame: FrameRef: where the frame is archived (None: not archived)
         """
-        pymongo_collection = self.get_collection(db=db, collection=collection)
+        pymongo_collection = self.get_scene_collection(db=db, collection=collection)
         timestamp = timestamp or datetime.now(tz=timezone.utc)
 
         # Pydantic performs validation for us
-        document = MongoDocument(scene=scene, timestamp=timestamp)
+        document = MongoDocument(
+            scene=scene, timestamp=timestamp, crop=crop, frame=frame
+        )
 
+        # seed the rolling counters first, so this scene isn't counted twice
+        self._seed_sightings(db=db, collection=collection)
         res = pymongo_collection.insert_one(document.dict())
+        self._count_sightings(scene, timestamp, db=db, collection=collection)
         return res
 
+    def insert_documents(self, documents, db=None, collection=None, write_concern=None):
+        """
+        Insert already validated documents in a single round trip
+
+        :param documents: list: MongoDocument dicts, as built by insert_scene
+        :param db: str: mongo database name (if not provided, uses object default)
+        :param collection: str: mongo collection name (if not provided, uses object default)
+        :param write_concern: dict: e.g. {"w": 1, "j": False} (default: the client's)
+        """
+        pymongo_collection = self.get_scene_collection(db=db, collection=collection)
+        if write_concern is not None:
+            pymongo_collection = pymongo_collection.with_options(
+                write_concern=WriteConcern(**write_concern)
+            )
+
+        self._seed_sightings(db=db, collection=collection)
+        try:
+            # insert_many adds the _id to each dict, don't modify the caller's
+            res = pymongo_collection.insert_many(
+                [dict(document) for document in documents], ordered=False
+            )
+        except BulkWriteError as e:
+            # the documents without an error were inserted, and so were
+            # duplicates of those a failed attempt may have inserted
+            errors = {
+                error["index"]: error for error in e.details.get("writeErrors", [])
+            }
+            self._count_documents(
+                [
+                    document
+                    for index, document in enumerate(documents)
+                    if index not in errors
+                    or (
+                        errors[index].get("code") == 11000
+                        and document.get("_id") in self._unconfirmed
+                    )
+                ],
+                db=db,
+                collection=collection,
+            )
+            self._unconfirmed.difference_update(
+                document.get("_id") for document in documents
+            )
+            raise
+        except ConnectionFailure:
+            # some of them may have been inserted: they are counted when a
+            # retry finds them in the collection
+            self._unconfirmed.update(
+                document["_id"] for document in documents if "_id" in document
+            )
+            raise
+        self._count_documents(documents, db=db, collection=collection)
+        return res
+
+    def _count_sightings(self, scene, timestamp, db=None, collection=None):
+        "Updates the rolling counters and the hourly rollup for an inserted scene"
+        self._count_documents(
+            [{"scene": scene, "timestamp": timestamp}], db=db, collection=collection
+        )
+
+    def _count_documents(self, documents, db=None, collection=None):
+        "Updates the rolling counters and the hourly rollup for inserted documents"
+        increments = Counter()
+        for document in documents:
+            self._unconfirmed.discard(document.get("_id"))
+            scene, timestamp = document["scene"], document["timestamp"]
+            if timestamp.tzinfo is None:
+                timestamp = timestamp.replace(tzinfo=timezone.utc)
+            super()._count_sightings(scene, timestamp, db=db, collection=collection)
+            hour = hour_start(timestamp)
+            for (kind, key), count in rollup_increments(scene).items():
+                increments[hour, kind, key] += count
+        if not increments:
+            return
+
+        # a single round trip for the whole batch
+        self.get_rollup_collection(db=db, collection=collection).bulk_write(
+            [
+                UpdateOne(
+                    # an embedded document rather than a list, so that the
+                    # unique index doesn't index each element separately
+                    {
+                        "hour": hour,
+                        "kind": kind,
+                        "key": dict(zip(KEY_FIELDS[kind], key)),
+                    },
+                    {"$inc": {"count": count}},
+                    upsert=True,
+                )
+                for (hour, kind, key), count in increments.items()
+            ],
+            ordered=False,
+        )
+
+    def get_sightings_in_timerange(
+        self, start_time, end_time=None, db=None, collection=None
+    ):
+        """
+        Counts persons and vehicles seen within a time range from the hourly rollups.
+
+        The range is widened to whole hours: any hour overlapping it is included.
+
+        :param start_time: datetime: left side of timestamp range
+        :param end_time: datetime: right side of timestamp range (if not provided, uses now)
+        :param db: str: mongo database name (if not provided, uses object default)
+        :param collection: str: mongo collection name (if not provided, uses object default)
+
+        :return: tuple of (gender, clothes) and (type, color) Counters
+        """
+        end_time = end_time or datetime.now(tz=timezone.utc)
+        res = self.get_rollup_collection(db=db, collection=collection).aggregate(
+            [
+                {
+                    "$match": {
+                        "hour": {"$gte": hour_start(start_time), "$lte": end_time}
+                    }
+                },
+                {
+                    "$group": {
+                        "_id": {"kind": "$kind", "key": "$key"},
+                        "count": {"$sum": "$count"},
+                    }
+                },
+            ]
+        )
+        persons = Counter()
+        vehicles = Counter()
+        for doc in res:
+            kind = doc["_id"]["kind"]
+            key = tuple(doc["_id"]["key"].get(field) for field in KEY_FIELDS[kind])
+            if kind == PERSON:
+                persons[key] += doc["count"]
+            elif kind == VEHICLE:
+                vehicles[key] += doc["count"]
+        return persons, vehicles
+
     def _get_scene(self, db_collection=None, reverse=True, verbose=False):
 
-        order = -1 if reverse else 1
-        res = db_collection.find_one(sort={"timestamp": order}) or {}
-        return {
-            "scene": res.get("scene"),
-            "timestamp": res.get("timestamp")
-        }
+        order = DESCENDING if reverse else ASCENDING
+        res = (
+            db_collection.find_one(
+                projection={"_id": False, "scene": True, "timestamp": True},
+                sort={"timestamp": order},
+            )
+            or {}
+        )
+        return {"scene": res.get("scene"), "timestamp": res.get("timestamp")}
 
     def get_first_scene(self, db=None, collection=None, verbose=False):
         """
@@ -57,7 +278,7 @@ class MongoClient:
         :param db: str: mongo database name (if not provided, uses object default)
         :param collection: str: mongo collection name (if not provided, uses object default)
         """
-        pymongo_collection = self.get_collection(db=db, collection=collection)
+        pymongo_collection = self.get_scene_collection(db=db, collection=collection)
         return self._get_scene(
             db_collection=pymongo_collection, reverse=False, verbose=verbose
         )
@@ -69,37 +290,121 @@ class MongoClient:
         :param db: str: mongo database name (if not provided, uses object default)
         :param collection: str: mongo collection name (if not provided, uses object default)
         """
-        pymongo_collection = self.get_collection(db=db, collection=collection)
+        pymongo_collection = self.get_scene_collection(db=db, collection=collection)
         return self._get_scene(db_collection=pymongo_collection, verbose=verbose)
 
-    def get_scenes_in_timerange(
-        self, start_time, end_time=None, db=None, collection=None, verbose=False
+    def iter_scenes(
+        self,
+        start_time,
+        end_time=None,
+        projection=None,
+        batch_size=500,
+        after=None,
+        limit=None,
+        reverse=False,
+        db=None,
+        collection=None,
     ):
         """
-        Retrieve the scenes from the database with timestamp within a range.
+        Lazily yields the documents with timestamp within a range, sorted by timestamp.
+
+        Documents are fetched from the server batch_size at a time, so memory
+        use doesn't depend on the length of the range.
 
         :param start_time: datetime: left side of timestamp range
         :param end_time: datetime: right side of timestamp range (if not provided, uses now)
+        :param projection: dict: fields to return (default: all fields)
+        :param batch_size: int: number of documents fetched per round trip
+        :param after: tuple: (timestamp, _id) of the last document already seen,
+            only documents after it are returned (keyset pagination)
+        :param limit: int: maximum number of documents (default: no limit)
+        :param reverse: bool: newest documents first
         :param db: str: mongo database name (if not provided, uses object default)
         :param collection: str: mongo collection name (if not provided, uses object default)
         """
+        pymongo_collection = self.get_scene_collection(db=db, collection=collection)
+        start_time, end_time = self._timerange(start_time, end_time)
 
-        pymongo_collection = self.get_collection(db=db, collection=collection)
+        query = {"timestamp": {"$gte": start_time, "$lte": end_time}}
+        if after is not None:
+            # _id breaks ties between documents with the same timestamp
+            after_timestamp, after_id = after
+            if isinstance(after_id, str):
+                after_id = ObjectId(after_id)
+            op = "$lt" if reverse else "$gt"
+            query = {
+                "$and": [
+                    query,
+                    {
+                        "$or": [
+                            {"timestamp": {op: after_timestamp}},
+                            {"timestamp": after_timestamp, "_id": {op: after_id}},
+                        ]
+                    },
+                ]
+            }
 
-        end_time = end_time or datetime.now(tz=timezone.utc)
-        # Might need to convert times if timezone-naive to timezone-aware
-        if start_time.tzinfo is None:
-            start_time = datetime.fromtimestamp(start_time.timestamp(), timezone.utc)
-        if end_time.tzinfo is None:
-            end_time = datetime.fromtimestamp(end_time.timestamp(), timezone.utc)
-        assert start_time < end_time, "Not a valid timestamp range!"
-
-        res = pymongo_collection.find(
-            {"timestamp": {"$gte": start_time, "$lte": end_time}}
+        order = DESCENDING if reverse else ASCENDING
+        cursor = pymongo_collection.find(
+            query,
+            projection=projection,
+            sort=[("timestamp", order), ("_id", order)],
+            batch_size=batch_size,
         )
-        if verbose:
-            return [(doc["scene"], doc["timestamp"]) for doc in res]
-        return [doc["scene"] for doc in res]
+        if limit is not None:
+            cursor = cursor.limit(limit)
+        try:
+            yield from cursor
+        finally:
+            cursor.close()
+
+    def insert_detections(self, counts, timestamp=None, db=None, collection=None):
+        """
+        Insert the local detector counts of a frame that wasn't described
+
+        :param counts: dict: persons, vehicles and moving counts, see Detections.counts()
+        :param timestamp: datetime: time when the frame was captured (if not provided, uses now())
+        :param db: str: mongo database name (if not provided, uses object default)
+        :param collection: str: scene collection name (if not provided, uses object default)
+        """
+        collection = (collection or self.default_collection) + self.detections_suffix
+        pymongo_collection = self.get_scene_collection(db=db, collection=collection)
+        timestamp = timestamp or datetime.now(tz=timezone.utc)
+        document = LocalCountsDocument(timestamp=timestamp, **counts)
+        return pymongo_collection.insert_one(document.dict())
+
+    def get_detections_in_timerange(
+        self, start_time, end_time=None, db=None, collection=None
+    ):
+        """
+        Retrieve the local detector counts of the frames that weren't described,
+        sorted by timestamp. Together with the scenes they cover every tick.
+
+        :param start_time: datetime: left side of timestamp range
+        :param end_time: datetime: right side of timestamp range (if not provided, uses now)
+        :param db: str: mongo database name (if not provided, uses object default)
+        :param collection: str: scene collection name (if not provided, uses object default)
+        """
+        start_time, end_time = self._timerange(start_time, end_time)
+        collection = (collection or self.default_collection) + self.detections_suffix
+        pymongo_collection = self.get_scene_collection(db=db, collection=collection)
+        cursor = pymongo_collection.find(
+            {"timestamp": {"$gte": start_time, "$lte": end_time}},
+            projection={"_id": False},
+        ).sort("timestamp", ASCENDING)
+        return list(cursor)
+
+    def get_rollup_collection(self, db=None, collection=None):
+        collection = (collection or self.default_collection) + self.rollup_suffix
+        pymongo_collection = self.get_collection(db=db, collection=collection)
+        key = (db or self.default_db, collection)
+        if key not in self._indexed:
+            pymongo_collection.create_index(
+                [("hour", ASCENDING), ("kind", ASCENDING), ("key", ASCENDING)],
+                unique=True,
+            )
+            self._indexed.add(key)
+        return pymongo_collection
 
     def get_collection(self, db=None, collection=None):
         db = db or self.default_db
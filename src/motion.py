@@ -0,0 +1,89 @@
+"""
+Module for deciding whether a frame is worth sending to the model.
+
+Frames are downsampled to a small grayscale thumbnail and compared with the
+thumbnail of the last frame that was sent. Only when the mean absolute
+difference goes over the threshold is the frame considered "changed".
+
+>> detector = MotionDetector(threshold=8.0)
+>> if detector.has_changed(frame):
+>>     ...  # send frame to the model
+"""
+
+import cv2
+import numpy as np
+
+# Size (width, height) of the thumbnail frames are compared on.
+# Small enough to be cheap, large enough to notice a person at the door.
+DEFAULT_THUMBNAIL_SIZE = (64, 48)
+
+# Mean absolute difference (0-255 scale) above which a frame counts as changed.
+DEFAULT_MOTION_THRESHOLD = 8.0
+
+
+class MotionDetector:
+    """
+    Compares frames against the last frame that was accepted.
+    """
+
+    def __init__(
+        self, threshold=DEFAULT_MOTION_THRESHOLD, thumbnail_size=DEFAULT_THUMBNAIL_SIZE
+    ):
+        """
+        :param threshold: float: mean absolute pixel difference needed to accept a frame
+        :param thumbnail_size: tuple: (width, height) of the comparison thumbnail
+        """
+        self.threshold = threshold
+        self.thumbnail_size = thumbnail_size
+        self.reference = None
+        self.last_score = None
+        # thumbnail of the frame last passed to has_changed(), see accept()
+        self._last_thumbnail = None
+
+    def thumbnail(self, frame: np.ndarray) -> np.ndarray:
+        """Returns a small, blurred grayscale version of the frame."""
+        if frame.ndim == 3:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        # INTER_AREA averages pixels, which filters out most sensor noise
+        small = cv2.resize(frame, self.thumbnail_size, interpolation=cv2.INTER_AREA)
+        return cv2.GaussianBlur(small, (3, 3), 0)
+
+    def _difference(self, thumbnail: np.ndarray) -> float:
+        """
+        Mean absolute difference between a thumbnail and the reference frame.
+        Returns infinity if there is no reference frame yet.
+        """
+        if self.reference is None:
+            return float("inf")
+        return float(cv2.absdiff(thumbnail, self.reference).mean())
+
+    def has_changed(self, frame: np.ndarray, update=True) -> bool:
+        """
+        Whether the frame differs enough from the last accepted frame.
+
+        :param frame: np.ndarray: BGR or grayscale frame
+        :param update: bool: whether to use the frame as the new reference if accepted
+
+        :return: bool
+        """
+        thumbnail = self.thumbnail(frame)
+        self.last_score = self._difference(thumbnail)
+        self._last_thumbnail = thumbnail
+        changed = self.last_score > self.threshold
+        if changed and update:
+            self.reference = thumbnail
+        return changed
+
+    def accept(self):
+        """
+        Uses the frame last passed to has_changed() as the new reference, e.g.
+        once a later check decided it is sent after all.
+        """
+        if self._last_thumbnail is not None:
+            self.reference = self._last_thumbnail
+
+    def reset(self):
+        """Forget the reference frame, so that the next frame is always accepted."""
+        self.reference = None
+        self.last_score = None
+        self._last_thumbnail = None
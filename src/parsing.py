@@ -0,0 +1,262 @@
+"""
+Module for turning model responses into scenes.
+
+Responses are JSON, but not always only JSON: some come wrapped in a
+markdown code fence, and they get cut off when the model runs out of output
+tokens or the stream breaks. IncrementalJSONParser scans the text as it
+arrives and can return, at any point, the value made of the members complete
+so far. SceneStream uses it to report a partial scene while a response is
+still streaming; parse_scene() only extracts the JSON from the text, and
+raises on truncated responses so the frame is described again rather than
+stored with a made up scene.
+
+>> SceneStream(print)('{"environment": {"weather": "sunny", "summary": "A street"}, "persons": [{"clothes": "red coat", "gender": "male"}, {"cl')
+{'environment': {'weather': 'sunny', 'summary': 'A street'}, 'persons': [{'clothes': 'red coat', 'gender': 'male'}], 'vehicles': []}
+>> parse_scene('{"environment": {"weather": "sunny", "summary": "A street"}, "persons": [{"cl')
+ValueError: Incomplete JSON: ...
+"""
+
+import json
+import logging
+import re
+
+from src.schemas import Environment, Person, Scene, Vehicle
+
+LOG = logging.getLogger("cctv_logger")
+
+# characters that matter outside strings, and inside them
+_ROOT = re.compile(r"[\[{]")
+_STRUCTURE = re.compile(r'[\[\]{},"]')
+_STRING = re.compile(r'["\\]')
+_CLOSERS = {"{": "}", "[": "]"}
+
+GENDERS = {"male", "female", "unsure"}
+
+
+class IncrementalJSONParser:
+    """
+    Scans a JSON object or list fed in pieces, each piece once.
+
+    Text before the first bracket (e.g. a code fence) is skipped, as is
+    text after the matching closing bracket.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.text = ""
+        self._position = 0
+        self._start = None
+        self._end = None
+        self._in_string = False
+        # closing brackets of the open lists and objects, innermost last
+        self._stack = []
+        # (position, closers): where the text can be cut and closed to be valid,
+        # after the last complete member (an incomplete one is left out)
+        self._safe = None
+
+    @property
+    def complete(self):
+        "Whether the closing bracket of the root value was seen"
+        return self._end is not None
+
+    def feed(self, chunk):
+        """
+        Scans the next piece of the response.
+
+        Raises ValueError on mismatched brackets.
+        """
+        self.text += chunk
+        self._scan()
+        return self
+
+    def update(self, text):
+        """
+        Scans the response received so far, only the part that is new unless
+        the text doesn't continue the previous one (e.g. a retried request).
+        """
+        if text.startswith(self.text):
+            return self.feed(text[len(self.text) :])
+        self.reset()
+        return self.feed(text)
+
+    def _scan(self):
+        text = self.text
+        position = self._position
+        while self._end is None:
+            if self._in_string:
+                match = _STRING.search(text, position)
+                if match is None:
+                    position = len(text)
+                    break
+                index = match.start()
+                if text[index] == "\\":
+                    # the escaped character may be in the next piece
+                    if index + 1 == len(text):
+                        position = index
+                        break
+                    position = index + 2
+                    continue
+                self._in_string = False
+                position = index + 1
+                continue
+
+            pattern = _ROOT if self._start is None else _STRUCTURE
+            match = pattern.search(text, position)
+            if match is None:
+                position = len(text)
+                break
+            index = match.start()
+            char = text[index]
+            position = index + 1
+            if self._start is None:
+                self._start = index
+            if char == '"':
+                self._in_string = True
+            elif char in _CLOSERS:
+                self._stack.append(_CLOSERS[char])
+            elif char in "]}":
+                if not self._stack or self._stack.pop() != char:
+                    raise ValueError(f"Unexpected {char!r} at {index} in: {text}")
+                if self._stack:
+                    self._mark(position)
+                else:
+                    self._end = position
+            else:
+                # a comma: everything before it is complete
+                self._mark(index)
+        self._position = position
+
+    def _mark(self, position):
+        self._safe = (position, "".join(reversed(self._stack)))
+
+    def value(self):
+        """Returns the root value, once complete."""
+        if self._end is None:
+            raise ValueError(f"Incomplete JSON: {self.text}")
+        return json.loads(self.text[self._start : self._end])
+
+    def partial(self):
+        """
+        Returns the root value made of the lists, objects and members complete
+        so far (the whole value once complete), or None before the first one.
+        Lists and objects still open are closed after their last complete
+        member, and left out if they have none.
+        """
+        if self._end is not None:
+            return self.value()
+        if self._safe is None:
+            return None
+        position, closers = self._safe
+        return json.loads(self.text[self._start : position] + closers)
+
+
+def parse_json(response):
+    """
+    Parses a JSON response, skipping the text around the JSON value (e.g. a
+    code fence).
+
+    Raises ValueError if there is no JSON value or it was cut off.
+    """
+    try:
+        return json.loads(response)
+    except (TypeError, ValueError):
+        pass
+    parser = IncrementalJSONParser().feed(response or "")
+    if not parser.complete:
+        LOG.warning("Response was truncated")
+    return parser.value()
+
+
+def _text(value):
+    return "" if value is None else str(value)
+
+
+def _optional_text(value):
+    return None if value is None else str(value)
+
+
+def _dicts(values):
+    return [value for value in values if isinstance(value, dict)] if values else []
+
+
+def coerce_scene(data, partial=False):
+    """
+    Fits a parsed response to the Scene schema: missing fields are filled in,
+    unexpected ones dropped and genders other than male, female or unsure
+    set to None, so storing the scene can't fail validation.
+
+    :param partial: bool: whether the response is still coming in, and may
+        not have its environment yet
+
+    Raises ValueError if the response isn't a scene at all.
+    """
+    if isinstance(data, list) and len(data) == 1:
+        # a single scene, wrapped in a list
+        data = data[0]
+    if not isinstance(data, dict):
+        raise ValueError(f"Expected a scene, got: {data!r}")
+
+    environment = data.get("environment")
+    if not isinstance(environment, dict):
+        if not partial:
+            raise ValueError(f"Expected a scene with an environment, got: {data!r}")
+        environment = {}
+    persons = []
+    for person in _dicts(data.get("persons")):
+        gender = _optional_text(person.get("gender"))
+        gender = gender.lower() if gender is not None else None
+        persons.append(
+            Person(
+                clothes=_optional_text(person.get("clothes")),
+                gender=gender if gender in GENDERS else None,
+            )
+        )
+    return Scene(
+        environment=Environment(
+            weather=_text(environment.get("weather")),
+            summary=_text(environment.get("summary")),
+        ),
+        persons=persons,
+        vehicles=[
+            Vehicle(type=_text(vehicle.get("type")), color=_text(vehicle.get("color")))
+            for vehicle in _dicts(data.get("vehicles"))
+        ],
+    )
+
+
+def parse_scene(response):
+    """
+    Returns the Scene in a model response, see parse_json() and coerce_scene().
+    """
+    return coerce_scene(parse_json(response))
+
+
+class SceneStream:
+    """
+    Follows a streaming response and calls on_scene(scene) with the partial
+    scene every time the number of persons or vehicles in it changes, so
+    nothing is reported for empty scenes.
+
+    Pass it as the on_text callback of Model.describe_image_from_blob.
+    """
+
+    def __init__(self, on_scene):
+        self.on_scene = on_scene
+        self.parser = IncrementalJSONParser()
+        self._counts = (0, 0)
+
+    def __call__(self, text):
+        if not text.startswith(self.parser.text):
+            # a new response (retry, escalation) starts from an empty scene
+            self._counts = (0, 0)
+        try:
+            scene = coerce_scene(self.parser.update(text).partial(), partial=True)
+        except ValueError:
+            # not a scene (yet), the complete response will say what went wrong
+            return
+        counts = len(scene["persons"]), len(scene["vehicles"])
+        if counts != self._counts:
+            self._counts = counts
+            self.on_scene(scene)
@@ -0,0 +1,429 @@
+"""
+Module for recognising persons and vehicles seen before, from their descriptions.
+
+The model words the same person differently from frame to frame ("man in a
+blue jacket", "man wearing blue jacket and jeans"), so counting identical
+descriptions misses most repeat visits. SightingIndex embeds every
+description with a hashed n-gram vectorizer (local, no model or network
+involved) and counts the sightings of all descriptions similar enough to a
+query one.
+
+Each distinct description is embedded once, as a row of a NumPy matrix;
+sightings are (timestamp, row) pairs kept in time order, so a count over
+the last hour is a matrix-vector product over the distinct descriptions
+plus a slice of the sightings, a few milliseconds over weeks of scenes.
+
+>> index = SightingIndex(window=7 * 86400)
+>> index.add(scene, timestamp)
+>> index.count(PERSON, "blue jacket and jeans", "male", window=3600)
+4
+"""
+
+import re
+import threading
+import zlib
+from datetime import datetime, timezone
+
+import numpy as np
+
+from src.sightings import PERSON, VEHICLE
+from src.utils import sanitise_string
+
+# words that say nothing about what someone or something looks like
+STOPWORDS = {
+    "a",
+    "an",
+    "the",
+    "and",
+    "with",
+    "in",
+    "of",
+    "wearing",
+    "wears",
+    "dressed",
+    "is",
+    "colored",
+    "coloured",
+    "man",
+    "woman",
+    "person",
+}
+_NON_WORD = re.compile(r"[^a-z0-9]+")
+
+KINDS = {PERSON: 0, VEHICLE: 1}
+# genders other than these match any gender
+GENDERS = {"male": 1, "female": 2}
+
+# colours weigh more than the other words: a blue and a black jacket are
+# different people, however similar the rest of their descriptions
+COLOURS = {
+    "black",
+    "white",
+    "grey",
+    "red",
+    "blue",
+    "green",
+    "yellow",
+    "orange",
+    "purple",
+    "pink",
+    "brown",
+    "beige",
+    "navy",
+    "silver",
+    "gold",
+    "dark",
+    "light",
+}
+_SPELLINGS = {"gray": "grey", "colour": "color"}
+
+DEFAULT_THRESHOLD = 0.6
+
+
+def _singular(word):
+    # "vans", "trainers": close enough, and "jeans" becomes "jean" everywhere
+    if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+        return word[:-1]
+    return _SPELLINGS.get(word, word)
+
+
+def normalise_description(text):
+    "Lower-cased singular words of a description, without punctuation and stopwords"
+    words = _NON_WORD.sub(" ", sanitise_string((text or "").lower())).split()
+    return " ".join(_singular(word) for word in words if word not in STOPWORDS)
+
+
+class HashedNgramVectorizer:
+    """
+    Turns descriptions into unit vectors of `dim` floats.
+
+    Features are the words, the pairs of consecutive words ("blue jacket")
+    and the character trigrams of each word ("jac", "ack"...), which match
+    spelling variants and plurals. Each feature is hashed to a dimension and
+    a sign, so no vocabulary is kept.
+
+    Colours (see COLOURS) have no trigrams, "blue" and "black" would share
+    some, and weigh colour_weight. So do the pairs they are part of, and
+    the pairs of each colour with the words it applies to ("white shirt"
+    in "white t-shirt and black shorts"), which tell apart descriptions
+    whose colours are swapped.
+    """
+
+    def __init__(self, dim=256, trigram_weight=0.5, colour_weight=2.0):
+        """
+        :param dim: int: vector size, a power of 2
+        :param trigram_weight: float: weight of character trigrams relative to words
+        :param colour_weight: float: weight of the colour features relative to words
+        """
+        assert dim & (dim - 1) == 0, "dim must be a power of 2"
+        self.dim = dim
+        self.trigram_weight = trigram_weight
+        self.colour_weight = colour_weight
+
+    def _features(self, words):
+        colour = None
+        for word in words:
+            if word in COLOURS:
+                colour = word
+                yield word, self.colour_weight
+                continue
+            yield word, 1.0
+            padded = f"<{word}>"
+            for start in range(len(padded) - 2):
+                yield padded[start : start + 3], self.trigram_weight
+            # a colour applies to the words up to the next colour, but not
+            # to the "t" of "t-shirt"
+            if colour is not None and len(word) > 1:
+                yield f"{colour}:{word}", self.colour_weight
+        for first, second in zip(words, words[1:]):
+            weight = (
+                self.colour_weight if first in COLOURS or second in COLOURS else 1.0
+            )
+            yield f"{first} {second}", weight
+
+    def vector(self, text):
+        """
+        :param text: str: description, normalised or not
+        :return: np.ndarray: float32 vector of norm 1 (all zeros if there are no words)
+        """
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for feature, weight in self._features(normalise_description(text).split()):
+            # crc32 rather than hash(), which changes between runs
+            hashed = zlib.crc32(feature.encode())
+            sign = 1.0 if hashed & 0x80000000 else -1.0
+            vector[hashed & (self.dim - 1)] += sign * weight
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+
+def _seconds(timestamp):
+    if timestamp is None:
+        timestamp = datetime.now(tz=timezone.utc)
+    elif timestamp.tzinfo is None:
+        # Mongo returns naive UTC datetimes
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return timestamp.timestamp()
+
+
+def _description(kind, key):
+    "Text embedded for a (gender, clothes) or (type, color) sighting key"
+    if kind == PERSON:
+        return key[1] or ""
+    return f"{key[1] or ''} {key[0] or ''}"
+
+
+class SightingIndex:
+    """
+    Sightings of persons and vehicles over the last `window` seconds,
+    searchable by similarity of their descriptions.
+
+    Persons only match persons of the same gender (or of unknown gender).
+    """
+
+    def __init__(
+        self,
+        window=7 * 86400,
+        threshold=DEFAULT_THRESHOLD,
+        vectorizer=None,
+        evict_every=60,
+    ):
+        """
+        :param window: float: seconds of sightings kept
+        :param threshold: float: cosine similarity above which two descriptions
+            are the same person or vehicle
+        :param vectorizer: HashedNgramVectorizer: embeds the descriptions
+            (defaults to HashedNgramVectorizer())
+        :param evict_every: float: seconds between removals of expired sightings
+        """
+        self.window = window
+        self.threshold = threshold
+        self.vectorizer = vectorizer or HashedNgramVectorizer()
+        self.evict_every = evict_every
+        self._lock = threading.Lock()
+
+        # one row per distinct description
+        self._row_ids = {}
+        self._keys = []
+        self._vectors = np.zeros((64, self.vectorizer.dim), dtype=np.float32)
+        self._kinds = np.zeros(64, dtype=np.int8)
+        self._genders = np.zeros(64, dtype=np.int8)
+        self._last_seen = np.zeros(64, dtype=np.float64)
+        # sightings, in time order once sorted
+        self._times = np.zeros(1024, dtype=np.float64)
+        self._rows = np.zeros(1024, dtype=np.int32)
+        self._size = 0
+        self._sorted = True
+        self._evicted_at = 0.0
+
+    def __len__(self):
+        return self._size
+
+    @staticmethod
+    def _grow(array, needed):
+        if needed <= len(array):
+            return array
+        grown = np.zeros((max(needed, 2 * len(array)),) + array.shape[1:], array.dtype)
+        grown[: len(array)] = array
+        return grown
+
+    def _row(self, kind, key):
+        "Returns the row of a description, embedding it the first time"
+        normalised = (
+            kind,
+            key[0] if kind == PERSON else None,
+            normalise_description(_description(kind, key)),
+        )
+        row = self._row_ids.get(normalised)
+        if row is not None:
+            return row
+        row = len(self._keys)
+        for name in ("_vectors", "_kinds", "_genders", "_last_seen"):
+            setattr(self, name, self._grow(getattr(self, name), row + 1))
+        self._vectors[row] = self.vectorizer.vector(normalised[2])
+        self._kinds[row] = KINDS[kind]
+        self._genders[row] = GENDERS.get(key[0], 0) if kind == PERSON else 0
+        self._keys.append((kind, key))
+        self._row_ids[normalised] = row
+        return row
+
+    def add_sightings(self, sightings, timestamp=None):
+        """
+        :param sightings: iterable: (kind, key) pairs, e.g. from
+            src.sightings.rollup_increments(scene).elements()
+        :param timestamp: datetime: time of the sightings (if not provided, uses now())
+        """
+        seconds = _seconds(timestamp)
+        with self._lock:
+            for kind, key in sightings:
+                row = self._row(kind, key)
+                self._last_seen[row] = max(self._last_seen[row], seconds)
+                self._times = self._grow(self._times, self._size + 1)
+                self._rows = self._grow(self._rows, self._size + 1)
+                if self._size and seconds < self._times[self._size - 1]:
+                    # late scenes, sorted before the next query
+                    self._sorted = False
+                self._times[self._size] = seconds
+                self._rows[self._size] = row
+                self._size += 1
+            if seconds - self._evicted_at >= self.evict_every:
+                self._evict(seconds)
+
+    def add(self, scene, timestamp=None):
+        """
+        Adds the persons and vehicles of a scene.
+
+        :param scene: Scene: scene description as outputted by model
+        :param timestamp: datetime: time when scene was captured (if not provided, uses now())
+        """
+        sightings = [
+            (PERSON, (person.get("gender"), person.get("clothes")))
+            for person in scene.get("persons") or []
+        ]
+        sightings.extend(
+            (VEHICLE, (vehicle.get("type"), vehicle.get("color")))
+            for vehicle in scene.get("vehicles") or []
+        )
+        self.add_sightings(sightings, timestamp)
+
+    def seed(self, scenes_with_timestamps):
+        """
+        Fills the index from (scene, timestamp) tuples, e.g. on start-up.
+        """
+        for scene, timestamp in scenes_with_timestamps:
+            self.add(scene, timestamp)
+
+    def _sort(self):
+        if self._sorted:
+            return
+        order = np.argsort(self._times[: self._size], kind="stable")
+        self._times[: self._size] = self._times[order]
+        self._rows[: self._size] = self._rows[order]
+        self._sorted = True
+
+    def _evict(self, now):
+        "Drops the sightings older than the window, and the descriptions only they used"
+        self._evicted_at = now
+        self._sort()
+        cutoff = now - self.window
+        expired = int(np.searchsorted(self._times[: self._size], cutoff))
+        if expired:
+            kept = self._size - expired
+            self._times[:kept] = self._times[expired : self._size]
+            self._rows[:kept] = self._rows[expired : self._size]
+            self._size = kept
+
+        rows = len(self._keys)
+        stale = self._last_seen[:rows] < cutoff
+        # re-numbering the rows costs a pass over the sightings, do it in bulk
+        if np.count_nonzero(stale) < max(1024, rows // 2):
+            return
+        kept_rows = np.flatnonzero(~stale)
+        renumbered = np.full(rows, -1, dtype=np.int32)
+        renumbered[kept_rows] = np.arange(len(kept_rows), dtype=np.int32)
+        for name in ("_vectors", "_kinds", "_genders", "_last_seen"):
+            array = getattr(self, name)
+            array[: len(kept_rows)] = array[kept_rows]
+        self._keys = [self._keys[row] for row in kept_rows]
+        self._row_ids = {
+            key: int(renumbered[row])
+            for key, row in self._row_ids.items()
+            if renumbered[row] >= 0
+        }
+        self._rows[: self._size] = renumbered[self._rows[: self._size]]
+
+    def _range(self, start, end):
+        "Slice of the sightings between two unix times"
+        self._sort()
+        times = self._times[: self._size]
+        return slice(
+            int(np.searchsorted(times, start)),
+            int(np.searchsorted(times, end, side="right")),
+        )
+
+    def _matches(self, vector, kind, gender, threshold):
+        "Boolean array of the rows similar to a vector"
+        rows = len(self._keys)
+        matches = self._vectors[:rows] @ vector >= threshold
+        matches &= self._kinds[:rows] == KINDS[kind]
+        if gender:
+            matches &= (self._genders[:rows] == 0) | (self._genders[:rows] == gender)
+        return matches
+
+    def count(
+        self,
+        kind,
+        description,
+        gender=None,
+        window=3600,
+        now=None,
+        threshold=None,
+    ):
+        """
+        Counts the sightings of a person or vehicle in the last `window` seconds.
+
+        :param kind: str: PERSON or VEHICLE
+        :param description: str: clothes of a person, or color and type of a vehicle
+        :param gender: str: gender of a person ("male", "female", anything else
+            matches both)
+        :param window: float: seconds to look back
+        :param now: datetime: end of the window (if not provided, uses now())
+        :param threshold: float: similarity needed to match (defaults to the index's)
+        """
+        vector = self.vectorizer.vector(description)
+        end = _seconds(now)
+        threshold = self.threshold if threshold is None else threshold
+        with self._lock:
+            matches = self._matches(vector, kind, GENDERS.get(gender, 0), threshold)
+            rows = self._rows[self._range(end - window, end)]
+            return int(np.count_nonzero(matches[rows]))
+
+    def repeated(self, start_time=None, end_time=None, window=None, thresh=0):
+        """
+        Groups the sightings of a time range by similarity and returns
+        (persons, vehicles) dicts of sighting key -> count, for the groups seen
+        more than `thresh` times. Each group is named after its most frequent
+        description.
+
+        :param start_time: datetime: left side of the range
+        :param end_time: datetime: right side of the range (default: now)
+        :param window: float: look at the last `window` seconds instead
+        :param thresh: int: minimum number of sightings to report a group
+        """
+        end = _seconds(end_time)
+        start = end - window if window is not None else _seconds(start_time)
+        with self._lock:
+            rows = len(self._keys)
+            counts = np.bincount(self._rows[self._range(start, end)], minlength=rows)
+            seen = np.flatnonzero(counts)
+            # most frequent descriptions first, they name the groups
+            seen = seen[np.argsort(-counts[seen], kind="stable")]
+            counts = counts[seen]
+            vectors = self._vectors[seen]
+            kinds = self._kinds[seen]
+            genders = self._genders[seen]
+            keys = [self._keys[row] for row in seen]
+
+        repeated = {PERSON: {}, VEHICLE: {}}
+        # each group is compared with the descriptions not grouped yet, one
+        # row at a time rather than as a matrix of every pair of descriptions
+        ungrouped = np.arange(len(seen))
+        while len(ungrouped):
+            index = ungrouped[0]
+            members = vectors[ungrouped] @ vectors[index] >= self.threshold
+            members &= kinds[ungrouped] == kinds[index]
+            if genders[index]:
+                members &= (genders[ungrouped] == 0) | (
+                    genders[ungrouped] == genders[index]
+                )
+            # a description without words matches nothing, not even itself
+            members[0] = True
+            total = int(counts[ungrouped[members]].sum())
+            ungrouped = ungrouped[~members]
+            kind, key = keys[index]
+            if total > thresh:
+                repeated[kind][key] = total
+        return repeated[PERSON], repeated[VEHICLE]
+
+    def stats(self):
+        with self._lock:
+            return {"sightings": self._size, "descriptions": len(self._keys)}
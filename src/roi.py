@@ -0,0 +1,290 @@
+"""
+Module for sending only the changed regions of a frame to the model.
+
+A BackgroundModel keeps a slowly updated average of the scene. Pixels
+that differ from it make up the changed regions; RegionCropper pads them
+and cuts them out, either as a single crop or as a mosaic of crops when
+they are far apart. The geometry is returned along with the image, so
+the scene stored in the database says which part of the frame it describes.
+
+>> cropper = RegionCropper()
+>> image, geometry = cropper.crop(frame)
+>> blob = convert_frame_to_blob(image)
+
+The background is only kept up to date by the frames it sees. When most
+frames aren't sent, pass every frame to update() and crop the sent ones
+with the regions it found:
+
+>> regions = cropper.update(frame)
+>> if worth_sending(frame):
+>>     image, geometry = cropper.crop(frame, regions)
+"""
+
+import math
+
+import cv2
+import numpy as np
+
+FULL = "full"
+CROP = "crop"
+MOSAIC = "mosaic"
+
+# pixels between the tiles of a mosaic
+MOSAIC_GAP = 8
+
+
+class BackgroundModel:
+    """
+    Running average of downscaled grayscale frames.
+
+    Frames are compared at a width of `width` pixels, which is plenty to
+    find a person or a car and keeps the per-frame cost low.
+    """
+
+    def __init__(self, alpha=0.05, threshold=25, width=320, min_area=0.002):
+        """
+        :param alpha: float: weight of each new frame in the average, the higher
+            the faster changes (parked cars, light) become background
+        :param threshold: int: pixel difference (0-255) counting as a change
+        :param width: int: width frames are downscaled to
+        :param min_area: float: smallest region kept, as a fraction of the frame
+        """
+        self.alpha = alpha
+        self.threshold = threshold
+        self.width = width
+        self.min_area = min_area
+        self._background = None
+        self._kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
+
+    def _prepare(self, frame):
+        height, width = frame.shape[:2]
+        scale = min(1.0, self.width / width)
+        small = cv2.resize(
+            frame,
+            (round(width * scale), round(height * scale)),
+            interpolation=cv2.INTER_AREA,
+        )
+        if small.ndim == 3:
+            small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        return cv2.GaussianBlur(small, (5, 5), 0), scale
+
+    def changed_regions(self, frame, update=True):
+        """
+        Returns the bounding boxes (x, y, width, height) of the regions that
+        differ from the background, in frame coordinates.
+
+        Returns None on the first frame, when there is no background yet.
+
+        :param frame: np.ndarray: BGR or grayscale frame
+        :param update: bool: whether to blend the frame into the background
+        """
+        small, scale = self._prepare(frame)
+        if self._background is None or self._background.shape != small.shape:
+            self._background = small.astype(np.float32)
+            return None
+
+        difference = cv2.absdiff(small, cv2.convertScaleAbs(self._background))
+        _, mask = cv2.threshold(difference, self.threshold, 255, cv2.THRESH_BINARY)
+        # join the pieces of a moving object into one blob
+        mask = cv2.dilate(mask, self._kernel, iterations=2)
+        contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        if update:
+            cv2.accumulateWeighted(small, self._background, self.alpha)
+
+        min_area = self.min_area * small.shape[0] * small.shape[1]
+        return [
+            tuple(round(value / scale) for value in cv2.boundingRect(contour))
+            for contour in contours
+            if cv2.contourArea(contour) >= min_area
+        ]
+
+    def reset(self):
+        self._background = None
+
+
+def _pad(box, padding, min_side, frame_width, frame_height):
+    "Grows a box by `padding` of its size, and to at least min_side, within the frame"
+    x, y, width, height = box
+    grow_x = max(width * padding, (min_side - width) / 2, 0)
+    grow_y = max(height * padding, (min_side - height) / 2, 0)
+    left = max(0, int(x - grow_x))
+    top = max(0, int(y - grow_y))
+    right = min(frame_width, int(math.ceil(x + width + grow_x)))
+    bottom = min(frame_height, int(math.ceil(y + height + grow_y)))
+    return left, top, right - left, bottom - top
+
+
+def _area(box):
+    return box[2] * box[3]
+
+
+def _overlap(a, b):
+    return (
+        a[0] < b[0] + b[2]
+        and b[0] < a[0] + a[2]
+        and a[1] < b[1] + b[3]
+        and b[1] < a[1] + a[3]
+    )
+
+
+def _union(boxes):
+    left = min(box[0] for box in boxes)
+    top = min(box[1] for box in boxes)
+    right = max(box[0] + box[2] for box in boxes)
+    bottom = max(box[1] + box[3] for box in boxes)
+    return left, top, right - left, bottom - top
+
+
+def merge_boxes(boxes):
+    "Merges overlapping boxes until none overlap"
+    boxes = list(boxes)
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(boxes)):
+            for j in range(i + 1, len(boxes)):
+                if _overlap(boxes[i], boxes[j]):
+                    boxes[i] = _union([boxes[i], boxes[j]])
+                    del boxes[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return boxes
+
+
+def pack_mosaic(sizes, gap=MOSAIC_GAP):
+    """
+    Places rectangles of the given (width, height) sizes on rows ("shelves"),
+    tallest first, aiming for a roughly square mosaic.
+
+    :return: tuple: (positions as (x, y) in the order of sizes, (width, height))
+    """
+    order = sorted(range(len(sizes)), key=lambda i: -sizes[i][1])
+    area = sum((width + gap) * (height + gap) for width, height in sizes)
+    max_width = max(max(width for width, _ in sizes), int(math.sqrt(area)))
+
+    positions = [None] * len(sizes)
+    x = y = shelf_height = mosaic_width = 0
+    for i in order:
+        width, height = sizes[i]
+        if x and x + width > max_width:
+            x, y = 0, y + shelf_height + gap
+            shelf_height = 0
+        positions[i] = (x, y)
+        x += width + gap
+        shelf_height = max(shelf_height, height)
+        mosaic_width = max(mosaic_width, x - gap)
+    return positions, (mosaic_width, y + shelf_height)
+
+
+class RegionCropper:
+    """
+    Cuts the changed regions out of frames.
+
+    The whole frame is sent when nothing stands out (first frame, global
+    lighting change) or when the regions cover most of it anyway.
+    """
+
+    def __init__(
+        self,
+        background_model=None,
+        padding=0.25,
+        min_side=224,
+        max_regions=4,
+        full_frame_ratio=0.5,
+        mosaic=True,
+    ):
+        """
+        :param background_model: BackgroundModel: finds the changed regions
+            (defaults to BackgroundModel())
+        :param padding: float: margin added around each region, as a fraction of
+            its size, so the model sees some context
+        :param min_side: int: smallest width and height of a crop, in pixels
+        :param max_regions: int: more regions than this are sent as one crop
+        :param full_frame_ratio: float: send the whole frame when the crop would
+            cover more than this fraction of it
+        :param mosaic: bool: whether distant regions are tiled in a mosaic rather
+            than sent as the single crop containing them all
+        """
+        self.background_model = background_model or BackgroundModel()
+        self.padding = padding
+        self.min_side = min_side
+        self.max_regions = max_regions
+        self.full_frame_ratio = full_frame_ratio
+        self.mosaic = mosaic
+
+    def update(self, frame):
+        """
+        Blends a frame into the background and returns its changed regions,
+        to be passed to crop().
+
+        :param frame: np.ndarray: BGR frame
+        :return: list: (x, y, width, height) boxes, empty on the first frame
+        """
+        return self.background_model.changed_regions(frame) or []
+
+    def crop(self, frame, regions=None):
+        """
+        Returns the image to send to the model and its geometry.
+
+        The geometry is a dict with
+        - mode: "full", "crop" or "mosaic"
+        - frame_size: [width, height] of the frame
+        - regions: list of {"box": [x, y, width, height] in the frame,
+          "position": [x, y] in the image sent}
+
+        :param frame: np.ndarray: BGR frame
+        :param regions: list: changed regions of the frame, as returned by
+            update(frame) (default: the frame is passed to update() here)
+        :return: tuple: (np.ndarray, dict)
+        """
+        frame_height, frame_width = frame.shape[:2]
+        frame_area = frame_width * frame_height
+        if regions is None:
+            regions = self.update(frame)
+
+        boxes = merge_boxes(
+            _pad(box, self.padding, self.min_side, frame_width, frame_height)
+            for box in regions
+        )
+        if len(boxes) > self.max_regions:
+            boxes = [_union(boxes)]
+        full_frame = frame, self._geometry(
+            FULL, frame, [(0, 0, frame_width, frame_height)], [(0, 0)]
+        )
+        covered = sum(_area(box) for box in boxes)
+        if not boxes or covered > self.full_frame_ratio * frame_area:
+            return full_frame
+
+        union = _union(boxes)
+        # a mosaic only pays off when the regions are far apart
+        if len(boxes) == 1 or not self.mosaic or covered > 0.5 * _area(union):
+            if _area(union) > self.full_frame_ratio * frame_area:
+                return full_frame
+            x, y, width, height = union
+            return frame[y : y + height, x : x + width], self._geometry(
+                CROP, frame, [union], [(0, 0)]
+            )
+
+        positions, (width, height) = pack_mosaic([box[2:] for box in boxes])
+        mosaic = np.zeros((height, width) + frame.shape[2:], dtype=frame.dtype)
+        for (x, y, box_width, box_height), (left, top) in zip(boxes, positions):
+            mosaic[top : top + box_height, left : left + box_width] = frame[
+                y : y + box_height, x : x + box_width
+            ]
+        return mosaic, self._geometry(MOSAIC, frame, boxes, positions)
+
+    @staticmethod
+    def _geometry(mode, frame, boxes, positions):
+        return {
+            "mode": mode,
+            "frame_size": [frame.shape[1], frame.shape[0]],
+            "regions": [
+                {"box": [int(value) for value in box], "position": list(position)}
+                for box, position in zip(boxes, positions)
+            ],
+        }
+
+    def reset(self):
+        self.background_model.reset()
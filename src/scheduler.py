@@ -0,0 +1,232 @@
+"""
+Module for deciding when to sample each camera.
+
+AdaptiveScheduler replaces a fixed capture interval. A camera is sampled
+every min_interval seconds while its scenes have persons or vehicles in
+them, or while there is motion in front of it, and the interval is
+multiplied by `backoff` with every static frame after that, up to
+max_interval. Both intervals depend on the time of day, see SamplingProfile.
+
+Model requests are paid for out of a daily budget, spread across the day
+in proportion to the profiles' weights: a token bucket refills at the share
+of the budget of the current profile, and cameras are sampled no faster
+than it refills once it is empty. The bucket is charged by the
+InferenceEngines, once per request actually sent: a batch of frames costs
+one request, while retries, hedges and escalations to a second model cost
+one each.
+
+>> scheduler = AdaptiveScheduler(
+>>     profiles=[
+>>         SamplingProfile(time(7), min_interval=2, max_interval=60, weight=3),
+>>         SamplingProfile(time(22), min_interval=10, max_interval=300),
+>>     ],
+>>     daily_budget=20_000,
+>> )
+>> model = InferenceEngine(Model(ModelChoices.PRO), budget=scheduler.budget)
+>> runner = MultiCameraRunner(sources, model=model, scheduler=scheduler)
+>> internet.TimerService(step=0.5, callable=runner.tick)
+"""
+
+import threading
+from datetime import datetime, time
+from time import monotonic
+
+from src.inference import TokenBucket
+from src.metrics import REGISTRY
+from src.motion import DEFAULT_MOTION_THRESHOLD
+
+DAY = 24 * 3600
+
+DEFERRED = REGISTRY.counter(
+    "cctv_sampling_deferred_total",
+    "Samples postponed because the daily model budget ran low, by camera",
+    ("camera",),
+)
+
+
+def _seconds(start: time) -> int:
+    return start.hour * 3600 + start.minute * 60 + start.second
+
+
+class SamplingProfile:
+    "How often to sample from a time of day on, until the next profile starts"
+
+    def __init__(self, start=time(0), min_interval=2, max_interval=60, weight=1.0):
+        """
+        :param start: datetime.time: local time the profile starts at
+        :param min_interval: float: seconds between samples while there is activity
+        :param max_interval: float: longest interval, reached after static frames
+        :param weight: float: share of the daily budget per hour, relative to the
+            other profiles (e.g. 3 spends three times more per hour than 1)
+        """
+        assert 0 < min_interval <= max_interval, "Not a valid interval range!"
+        self.start = start
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.weight = weight
+
+    def __repr__(self):
+        return (
+            f"SamplingProfile({self.start.isoformat()}, min_interval={self.min_interval}, "
+            f"max_interval={self.max_interval}, weight={self.weight})"
+        )
+
+
+class AdaptiveScheduler:
+    """
+    Sampling intervals of several cameras, adapted to their activity within
+    a daily budget of model requests.
+
+    Thread-safe, although ticks are usually submitted from the reactor thread.
+    """
+
+    def __init__(
+        self,
+        profiles=None,
+        daily_budget=None,
+        backoff=2.0,
+        burst=3600,
+        motion_threshold=DEFAULT_MOTION_THRESHOLD,
+    ):
+        """
+        :param profiles: list: SamplingProfile of each part of the day, in any
+            order (default: SamplingProfile() all day long)
+        :param daily_budget: int: model requests per day, across all cameras,
+            charged to `budget` by the InferenceEngines (None: no budget)
+        :param backoff: float: factor the interval grows by with every static frame
+        :param burst: float: seconds of average budget that can be saved up and
+            spent at once when activity starts
+        :param motion_threshold: float: motion score (see MotionDetector) counted
+            as activity
+        """
+        self.profiles = sorted(profiles or [SamplingProfile()], key=lambda p: p.start)
+        starts = [_seconds(profile.start) for profile in self.profiles]
+        assert len(set(starts)) == len(starts), "Profiles must start at different times"
+        # weighted seconds in a day, which the budget is spread across
+        self._weighted_day = sum(
+            profile.weight * ((starts[(index + 1) % len(starts)] - start) % DAY or DAY)
+            for index, (profile, start) in enumerate(zip(self.profiles, starts))
+        )
+        self.daily_budget = daily_budget
+        self.backoff = backoff
+        self.motion_threshold = motion_threshold
+        # charged by the InferenceEngines, see InferenceEngine(budget=...)
+        self.budget = None
+        if daily_budget is not None:
+            profile = self.profile()
+            self.budget = TokenBucket(
+                self._budget_rate(profile), capacity=daily_budget * burst / DAY
+            )
+            self._budget_profile = profile
+        # camera -> [interval, time of the last sample, time of the next sample]
+        self._cameras = {}
+        self._lock = threading.Lock()
+
+        REGISTRY.gauge(
+            "cctv_sampling_interval_seconds",
+            "Current sampling interval of each camera",
+            lambda: {(camera,): state[0] for camera, state in self._cameras.items()},
+            ("camera",),
+        )
+        if self.budget is not None:
+            REGISTRY.gauge(
+                "cctv_sampling_budget_available",
+                "Model requests that can be sent right away",
+                self.budget.available,
+            )
+
+    def profile(self, now=None):
+        """
+        Returns the profile in force at a time of day.
+
+        :param now: datetime: local time (default: now)
+        """
+        seconds = _seconds((now or datetime.now()).time())
+        current = self.profiles[-1]  # started yesterday
+        for profile in self.profiles:
+            if _seconds(profile.start) <= seconds:
+                current = profile
+        return current
+
+    def _budget_rate(self, profile):
+        "Frames per second the budget allows while the profile is in force"
+        return self.daily_budget * profile.weight / self._weighted_day
+
+    def due(self, camera):
+        """
+        Whether a camera should be sampled now: its interval has passed, and
+        there is budget left for a request.
+        """
+        now = monotonic()
+        profile = self.profile()
+        with self._lock:
+            state = self._cameras.setdefault(camera, [profile.min_interval, None, 0.0])
+            # the profile may have changed since the interval was set
+            state[0] = min(max(state[0], profile.min_interval), profile.max_interval)
+            if now < state[2]:
+                return False
+
+            if self.budget is not None:
+                if profile is not self._budget_profile:
+                    self.budget.set_rate(
+                        self._budget_rate(profile), capacity=self.budget.capacity
+                    )
+                    self._budget_profile = profile
+                available = self.budget.available()
+                if available < 1:
+                    DEFERRED.inc(camera=camera)
+                    # try again when the next request has been earned
+                    wait = (
+                        (1 - available) / self.budget.rate
+                        if self.budget.rate
+                        else profile.max_interval
+                    )
+                    state[2] = now + max(wait, 0.1)
+                    return False
+
+            state[1] = now
+            state[2] = now + state[0]
+            return True
+
+    def sampled(self, camera, tick):
+        """
+        Adapts the interval of a camera to the outcome of its last sample.
+
+        :param tick: Tick: the sample once through the runner stages (None if
+            it was dropped before going through them)
+        """
+        if tick is None:
+            return
+        profile = self.profile()
+        with self._lock:
+            state = self._cameras[camera]
+            if self._active(tick):
+                state[0] = profile.min_interval
+            else:
+                state[0] = min(state[0] * self.backoff, profile.max_interval)
+            state[2] = state[1] + state[0]
+
+    def _active(self, tick):
+        "Whether a sample shows persons, vehicles or motion"
+        for described in [tick, *tick.batch]:
+            scene = described.scene
+            if scene is not None and (scene.get("persons") or scene.get("vehicles")):
+                return True
+        if tick.detections is not None and any(tick.detections.counts().values()):
+            return True
+        return (
+            tick.motion_score is not None and tick.motion_score >= self.motion_threshold
+        )
+
+    def stats(self):
+        with self._lock:
+            stats = {
+                "intervals": {
+                    camera: state[0] for camera, state in self._cameras.items()
+                },
+                "profile": repr(self.profile()),
+            }
+        if self.budget is not None:
+            stats["budget_available"] = self.budget.available()
+            stats["budget_rate"] = self.budget.rate
+        return stats
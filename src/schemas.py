@@ -31,6 +31,31 @@ class Scene(typing.TypedDict):
     persons: typing.List[Person]
     vehicles: typing.List[Vehicle]
 
+
+class CropRegion(typing.TypedDict):
+    "Part of the frame sent to the model, and where it is in the image sent"
+
+    box: typing.List[int]
+    position: typing.List[int]
+
+
+class CropGeometry(typing.TypedDict):
+    "Which parts of the frame a scene describes, see src.roi.RegionCropper"
+
+    mode: typing.Literal["full", "crop", "mosaic"]
+    frame_size: typing.List[int]
+    regions: typing.List[CropRegion]
+
+
+class FrameRef(typing.TypedDict):
+    "Where the frame sent to the model is kept, see src.archive.FrameArchive"
+
+    segment: str
+    offset: int
+    length: int
+    mime_type: str
+
+
 class Output(typing.TypedDict):
     scene: Scene
-    timestamp: datetime.datetime
\ No newline at end of file
+    timestamp: datetime.datetime
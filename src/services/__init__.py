@@ -1,2 +1,5 @@
+from src.services.pipeline import Pipeline
 from src.services.runner import CCTVLoggerRunner
-from src.services.web import CCTVLoggerServer
\ No newline at end of file
+from src.services.multi_camera import MultiCameraRunner
+from src.services.web import CCTVLoggerServer, LatestScenes
+from src.services.writer import SceneWriterService
@@ -0,0 +1,147 @@
+"""
+Resource serving archived frames, straight from the segment files.
+
+/frame?camera=<name>
+    Latest archived frame.
+/frame?at=<iso>&camera=<name>
+    Last frame captured at or before a time.
+/frame?segment=<segment>&offset=<offset>&camera=<name>
+    The frame of a scene document, as referenced by its "frame" field.
+
+Frames are served as they were encoded for the model, straight from memory
+maps of the segment files: no decoding, no re-encoding. The lookup runs on
+the reactor's thread pool, so the archive's lock doesn't hold up the reactor,
+and the frame is then written from its memoryview a chunk at a time, as the
+connection takes them. Twisted transports only take bytes, so each chunk is
+copied once on its way out; the map is released once the frame is written.
+"""
+
+from datetime import datetime, timezone
+
+from twisted.internet import defer, interfaces, threads
+from twisted.web import http, resource, server
+from zope.interface import implementer
+
+# bytes of a frame handed to the connection at a time
+CHUNK_SIZE = 64 * 1024
+
+
+@implementer(interfaces.IPullProducer)
+class _FrameProducer:
+    "Writes a memoryview to a request, then finishes it and releases the view"
+
+    def __init__(self, request, data):
+        self.request = request
+        self.data = data
+        self._offset = 0
+
+    def start(self):
+        self.request.registerProducer(self, False)
+
+    def resumeProducing(self):
+        if self.request is None:
+            return
+        chunk = self.data[self._offset : self._offset + CHUNK_SIZE]
+        if not chunk:
+            self.request.unregisterProducer()
+            self.request.finish()
+            self.stopProducing()
+            return
+        self._offset += len(chunk)
+        self.request.write(bytes(chunk))
+
+    def stopProducing(self):
+        self.request = None
+        self.data.release()
+
+
+class FramePage(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, archives, default_camera):
+        """
+        :param archives: dict: camera name -> FrameArchive
+        :param default_camera: str: camera served when none is given
+        """
+        super().__init__()
+        self.archives = archives
+        self.default_camera = default_camera
+
+    @staticmethod
+    def _arg(request, name):
+        values = request.args.get(name.encode())
+        return values[0].decode() if values else None
+
+    def render_GET(self, request):
+        archive = self.archives.get(self._arg(request, "camera") or self.default_camera)
+        segment = self._arg(request, "segment")
+        at = self._arg(request, "at")
+        try:
+            if archive is None:
+                raise KeyError("No frame archive for this camera")
+            ref = None
+            if segment is not None:
+                ref = {"segment": segment, "offset": int(self._arg(request, "offset"))}
+            elif at is not None:
+                at = datetime.fromisoformat(at)
+                if at.tzinfo is None:
+                    at = at.replace(tzinfo=timezone.utc)
+        except KeyError as error:
+            request.setResponseCode(http.NOT_FOUND)
+            return str(error).encode()
+        except (TypeError, ValueError):
+            request.setResponseCode(http.BAD_REQUEST)
+            return b"Invalid frame reference or time"
+
+        self._render(request, archive, ref, at).addErrback(self._render_error, request)
+        return server.NOT_DONE_YET
+
+    @staticmethod
+    def _read(archive, ref, at):
+        "Returns (data, mime_type, ref) of the frame, on the thread pool"
+        if ref is not None:
+            data, mime_type = archive.read(ref)
+            return data, mime_type, ref
+        found = archive.find(at)
+        if found is None:
+            raise KeyError("No frame archived yet")
+        return found
+
+    @defer.inlineCallbacks
+    def _render(self, request, archive, ref, at):
+        gone = []
+        request.notifyFinish().addBoth(gone.append)
+        data, mime_type, found = yield threads.deferToThread(
+            self._read, archive, ref, at
+        )
+        if gone:
+            data.release()
+            return
+
+        if ref is not None:
+            # a given frame never changes
+            request.setHeader("Cache-Control", "public, max-age=31536000, immutable")
+        else:
+            request.setHeader("Cache-Control", "no-cache")
+        request.setHeader("Content-Type", mime_type)
+        if (
+            request.setETag(f'"{found["segment"]}-{found["offset"]}"'.encode())
+            == http.CACHED
+        ):
+            data.release()
+            request.finish()
+            return
+        request.setHeader("Content-Length", str(len(data)))
+        _FrameProducer(request, data).start()
+
+    @staticmethod
+    def _render_error(failure, request):
+        if request.finished or request._disconnected:
+            return
+        if failure.check(KeyError):
+            request.setResponseCode(http.NOT_FOUND)
+            request.write(str(failure.value).encode())
+        else:
+            request.setResponseCode(http.INTERNAL_SERVER_ERROR)
+            request.write(failure.getErrorMessage().encode())
+        request.finish()
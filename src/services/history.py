@@ -0,0 +1,309 @@
+"""
+Resources for browsing past scenes.
+
+/history?start=<iso>&end=<iso>&limit=<n>&cursor=<token>&order=<asc|desc>&camera=<name>
+    One page of scenes, sorted by timestamp. The response carries a "next"
+    cursor to pass back for the following page (null on the last page).
+
+/summary?start=<iso>&end=<iso>&window=<seconds>&thresh=<n>&camera=<name>
+    Persons and vehicles seen more than `thresh` times in the range (default:
+    since midnight) or in the last `window` seconds. Similar descriptions are
+    counted together when the range is covered by the similarity index.
+
+/sightings?gender=<gender>&clothes=<text>&window=<seconds>&camera=<name>
+/sightings?type=<text>&color=<text>&window=<seconds>&camera=<name>
+    Number of sightings of a person or vehicle in the last `window` seconds
+    (default: an hour), by similarity of the descriptions.
+
+Database access runs on the reactor's thread pool, and history pages are
+written to the client one chunk of documents at a time.
+"""
+
+import base64
+import json
+from datetime import datetime, timedelta, timezone
+
+from twisted.internet import defer, threads
+from twisted.web import http, resource, server
+
+from src.sightings import PERSON, VEHICLE
+from src.utils import today_start
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# documents fetched from the database and written out at a time
+CHUNK_SIZE = 50
+
+
+class BadRequest(ValueError):
+    pass
+
+
+def query_arg(request, name, parse=str, default=None):
+    "Parses a query argument, raises BadRequest if it isn't valid"
+    values = request.args.get(name.encode())
+    if not values:
+        return default
+    try:
+        return parse(values[0].decode())
+    except ValueError:
+        raise BadRequest(f"Invalid value for {name}: {values[0].decode()}")
+
+
+def encode_cursor(after):
+    "Turns a (timestamp, _id) keyset cursor into an opaque URL-safe token"
+    timestamp, document_id = after
+    token = json.dumps({"t": timestamp.isoformat(), "id": str(document_id)})
+    return base64.urlsafe_b64encode(token.encode()).decode()
+
+
+def decode_cursor(token):
+    try:
+        cursor = json.loads(base64.urlsafe_b64decode(token.encode()))
+        # the store turns the id back into its own type
+        return datetime.fromisoformat(cursor["t"]), str(cursor["id"])
+    except Exception:
+        raise BadRequest(f"Invalid cursor: {token}")
+
+
+def _seconds_ago(timestamp):
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return (datetime.now(tz=timezone.utc) - timestamp).total_seconds()
+
+
+def repeated_sightings(
+    client, start_time=None, end_time=None, thresh=5, window=None, collection=None
+):
+    """
+    Returns a tuple with persons and vehicles that repeatedly show up in time range.
+
+    Counts come from the similarity index when it covers the range, so that
+    differently worded descriptions of the same person count together.
+    Otherwise they come from the in-memory rolling counters if a window they
+    cover is given, or from the hourly rollups, so the scenes are never
+    rescanned.
+
+    :param client: MongoClient: database client
+    :param start_time: datetime: left side of timestamp range (default: start of today)
+    :param end_time: datetime: right side of timestamp range (default: now)
+    :param thresh: int: minimum number of counts to consider a repeat pattern 'common'
+        (default: 5)
+    :param window: float: look at the last `window` seconds instead of a time range
+    :param collection: str: mongo collection name (if not provided, uses client default)
+    """
+    index = client.sighting_index(collection=collection)
+    if index is not None:
+        if window is not None:
+            covered = window <= index.window
+        else:
+            start_time = today_start() if start_time is None else start_time
+            covered = _seconds_ago(start_time) <= index.window
+        if covered:
+            return index.repeated(start_time, end_time, window, thresh)
+
+    rolling = None
+    if window is not None:
+        rolling = client.rolling_sightings(collection=collection)
+        if window > rolling.window:
+            # further back than the rolling counters go, the rollups have it
+            start_time = datetime.now(tz=timezone.utc) - timedelta(seconds=window)
+            end_time = rolling = None
+    if rolling is not None:
+        persons, vehicles = rolling.counts(window)
+    else:
+        start_time = today_start() if start_time is None else start_time
+        persons, vehicles = client.get_sightings_in_timerange(
+            start_time, end_time, collection=collection
+        )
+
+    common_persons = {p: count for p, count in persons.items() if count > thresh}
+    common_vehicles = {v: count for v, count in vehicles.items() if count > thresh}
+    return common_persons, common_vehicles
+
+
+class _QueryResource(resource.Resource):
+    "Common argument parsing and error handling of the history resources"
+
+    isLeaf = True
+
+    def __init__(self, client, collection):
+        super().__init__()
+        self.client = client
+        self.collection = collection
+
+    _arg = staticmethod(query_arg)
+
+    @staticmethod
+    def _time(value):
+        timestamp = datetime.fromisoformat(value)
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.replace(tzinfo=timezone.utc)
+        return timestamp
+
+    def _collection(self, request):
+        return self._arg(request, "camera", default=self.collection)
+
+    def render_GET(self, request):
+        request.setHeader("Content-Type", "application/json")
+        deferred = defer.maybeDeferred(self._render, request)
+        deferred.addErrback(self._render_error, request)
+        return server.NOT_DONE_YET
+
+    @staticmethod
+    def _render_error(failure, request):
+        if request.finished or request._disconnected:
+            return
+        if request.startedWriting:
+            # too late for an error status, cut the response short
+            request.finish()
+            return
+        if failure.check(BadRequest, AssertionError):
+            request.setResponseCode(http.BAD_REQUEST)
+        else:
+            request.setResponseCode(http.INTERNAL_SERVER_ERROR)
+        request.write(json.dumps({"error": failure.getErrorMessage()}).encode())
+        request.finish()
+
+
+class SceneHistory(_QueryResource):
+    "Paginated scene history, streamed to the client chunk by chunk"
+
+    @defer.inlineCallbacks
+    def _render(self, request):
+        start_time = self._arg(request, "start", self._time, default=today_start())
+        end_time = self._arg(request, "end", self._time)
+        limit = self._arg(request, "limit", int, default=DEFAULT_PAGE_SIZE)
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        after = self._arg(request, "cursor", decode_cursor)
+        order = self._arg(request, "order", default="asc")
+        if order not in ("asc", "desc"):
+            raise BadRequest(f"Invalid value for order: {order}")
+
+        # one more than the page size, to know whether there is a next page
+        documents = self.client.iter_scenes(
+            start_time,
+            end_time,
+            projection={"scene": True, "timestamp": True},
+            batch_size=CHUNK_SIZE,
+            after=after,
+            limit=limit + 1,
+            reverse=order == "desc",
+            collection=self._collection(request),
+        )
+
+        def next_chunk():
+            return [document for _, document in zip(range(CHUNK_SIZE), documents)]
+
+        gone = []
+        request.notifyFinish().addBoth(gone.append)
+
+        written = 0
+        last = None
+        has_next = False
+        separator = b""
+        # fetch the first chunk before writing, so query errors still get a 400/500
+        chunk = yield threads.deferToThread(next_chunk)
+        request.write(b'{"scenes": [')
+        while chunk and not gone:
+            # the extra document only tells us that there is a next page
+            if len(chunk) > limit - written:
+                has_next = True
+                chunk = chunk[: limit - written]
+            for document in chunk:
+                last = document
+                request.write(
+                    separator
+                    + json.dumps(
+                        {
+                            "scene": document["scene"],
+                            "timestamp": document["timestamp"],
+                        },
+                        default=str,
+                    ).encode()
+                )
+                separator = b", "
+            written += len(chunk)
+            if has_next:
+                break
+            chunk = yield threads.deferToThread(next_chunk)
+
+        documents.close()
+        if gone:
+            return
+        next_cursor = (
+            encode_cursor((last["timestamp"], last["_id"])) if has_next else None
+        )
+        request.write(f'], "next": {json.dumps(next_cursor)}}}'.encode())
+        request.finish()
+
+
+class SceneSummary(_QueryResource):
+    "Repeat sightings over a time range or a recent window"
+
+    @defer.inlineCallbacks
+    def _render(self, request):
+        start_time = self._arg(request, "start", self._time)
+        end_time = self._arg(request, "end", self._time)
+        window = self._arg(request, "window", float)
+        thresh = self._arg(request, "thresh", int, default=5)
+        gone = []
+        request.notifyFinish().addBoth(gone.append)
+
+        persons, vehicles = yield threads.deferToThread(
+            repeated_sightings,
+            self.client,
+            start_time,
+            end_time,
+            thresh,
+            window,
+            collection=self._collection(request),
+        )
+        response = {
+            "persons": [
+                {"gender": gender, "clothes": clothes, "count": count}
+                for (gender, clothes), count in persons.items()
+            ],
+            "vehicles": [
+                {"type": vehicle_type, "color": color, "count": count}
+                for (vehicle_type, color), count in vehicles.items()
+            ],
+        }
+        if not gone:
+            request.write(json.dumps(response).encode())
+            request.finish()
+
+
+class SightingCount(_QueryResource):
+    "Sightings of one person or vehicle, by similarity of the descriptions"
+
+    @defer.inlineCallbacks
+    def _render(self, request):
+        clothes = self._arg(request, "clothes")
+        vehicle_type = self._arg(request, "type")
+        color = self._arg(request, "color")
+        if clothes is not None:
+            kind, description = PERSON, clothes
+        elif vehicle_type is not None or color is not None:
+            kind, description = VEHICLE, f"{color or ''} {vehicle_type or ''}"
+        else:
+            raise BadRequest("Give the clothes of a person, or a vehicle type or color")
+        gender = self._arg(request, "gender")
+        window = self._arg(request, "window", float, default=3600)
+        gone = []
+        request.notifyFinish().addBoth(gone.append)
+
+        # seeding the index the first time reads the database
+        index = yield threads.deferToThread(
+            self.client.sighting_index, collection=self._collection(request)
+        )
+        if index is None:
+            raise BadRequest("The similarity index is disabled")
+        if window > index.window:
+            raise BadRequest(f"window can't be longer than {index.window} seconds")
+        count = yield threads.deferToThread(
+            index.count, kind, description, gender, window
+        )
+        if not gone:
+            request.write(json.dumps({"count": count}).encode())
+            request.finish()
@@ -0,0 +1,169 @@
+import logging
+
+from twisted.python.failure import Failure
+
+from src.camera import Camera
+from src.model import Model, ModelChoices
+from src.services.pipeline import Pipeline, TickDropped
+from src.services.runner import CCTVLoggerRunner, Tick
+from src.store import open_store
+
+LOG = logging.getLogger("cctv_logger")
+
+
+class MultiCameraRunner:
+    """Runs the CCTV logger for several cameras in a single process.
+
+    Every camera gets its own CCTVLoggerRunner (motion detector, scene cache,
+    pending batch, stats) storing scenes in a collection named after the
+    camera, while the model and the Mongo connection pool are shared.
+
+    All cameras feed one Pipeline whose infer stage has a fixed number of
+    workers, which caps the number of concurrent model requests (pass an
+    InferenceEngine as the model to also respect the API quota). Scheduling
+    is fair: each camera has at most one tick in flight, and cameras are
+    submitted in rotating order so none is always last in the infer queue.
+
+    Without a scheduler every camera is sampled on every tick; with an
+    AdaptiveScheduler (see src.scheduler) each camera is sampled at its own,
+    activity-dependent rate, and ticks only need to come often enough to
+    honour the shortest interval.
+
+    >> runner = MultiCameraRunner({"door": 0, "drive": "rtsp://10.0.0.2/stream"})
+    >> runner.pipeline.setServiceParent(top_service)
+    >> internet.TimerService(step=5, callable=runner.tick)
+    """
+
+    def __init__(
+        self,
+        sources,
+        inference_concurrency=4,
+        grabbing=False,
+        scene_cache_factory=None,
+        region_cropper_factory=None,
+        local_detector_factory=None,
+        frame_archive_factory=None,
+        model=None,
+        client=None,
+        scheduler=None,
+        **runner_options,
+    ):
+        """
+        :param sources: dict: camera name -> device index, stream URL or video file path
+        :param inference_concurrency: int: maximum number of concurrent model requests
+        :param grabbing: bool: whether cameras grab frames on a background thread
+        :param scene_cache_factory: callable: camera name -> SceneCache (None disables caching)
+        :param region_cropper_factory: callable: camera name -> RegionCropper
+            (None sends whole frames)
+        :param local_detector_factory: callable: camera name -> LocalDetector
+            (None disables local detection)
+        :param frame_archive_factory: callable: camera name -> FrameArchive
+            (None doesn't keep the frames)
+        :param model: Model: shared model (defaults to Model(ModelChoices.PRO))
+        :param client: SceneStore: shared database client (defaults to open_store())
+        :param scheduler: AdaptiveScheduler: decides when each camera is sampled
+            (None: every camera on every tick)
+        :param runner_options: passed on to every CCTVLoggerRunner
+        """
+        self.model = model or Model(ModelChoices.PRO)
+        self.client = client or open_store()
+        self.scheduler = scheduler
+        self.runners = {
+            name: CCTVLoggerRunner(
+                camera=Camera(source, grabbing=grabbing),
+                scene_cache=scene_cache_factory(name) if scene_cache_factory else None,
+                region_cropper=(
+                    region_cropper_factory(name) if region_cropper_factory else None
+                ),
+                local_detector=(
+                    local_detector_factory(name) if local_detector_factory else None
+                ),
+                frame_archive=(
+                    frame_archive_factory(name) if frame_archive_factory else None
+                ),
+                model=self.model,
+                client=self.client,
+                collection=name,
+                **runner_options,
+            )
+            for name, source in sources.items()
+        }
+        self._in_flight = set()
+        self._next = 0
+
+        cameras = len(self.runners)
+        self.pipeline = Pipeline(
+            [
+                ("capture", self.capture, cameras),
+                ("encode", self.encode, cameras),
+                ("infer", self.infer, inference_concurrency),
+                ("persist", self.persist),
+            ],
+            # one tick per camera in flight, which every queue takes but the
+            # model's: beyond one per worker, ticks waiting for the model are
+            # stale and the oldest is dropped
+            queue_size=cameras,
+            queue_sizes={"infer": inference_concurrency},
+            max_in_flight=cameras,
+            # described scenes are persisted even when stopping
+            drain=("persist",),
+            # frames waiting for a batch are described before the writer closes
+            on_stop=self.flush,
+        )
+
+    def tick(self):
+        """
+        Callable for internet.TimerService: submits a tick for every idle
+        camera, or only for those the scheduler says are due.
+        """
+        names = list(self.runners)
+        self._next = (self._next + 1) % len(names)
+        for name in names[self._next :] + names[: self._next]:
+            if name in self._in_flight:
+                if self.scheduler is None:
+                    LOG.info(f"Camera {name} still busy, skipping tick")
+                continue
+            if self.scheduler is not None and not self.scheduler.due(name):
+                continue
+            self._in_flight.add(name)
+            deferred = self.pipeline.submit(Tick(camera=name))
+            if self.scheduler is not None:
+                deferred.addBoth(self._sampled, name)
+            deferred.addErrback(self.pipeline.log_failure)
+            deferred.addBoth(lambda _, name=name: self._in_flight.discard(name))
+
+    def _sampled(self, result, name):
+        "Reports the outcome of a tick to the scheduler, passes the result on"
+        if not isinstance(result, Failure):
+            # None when the pipeline was too busy to take the tick
+            self.scheduler.sampled(name, result)
+        elif result.check(TickDropped):
+            self.scheduler.sampled(name, None)
+        # other failures leave the interval as it is
+        return result
+
+    def flush(self):
+        "Describes the frames every camera still holds for a batch"
+        for runner in self.runners.values():
+            runner.flush()
+
+    def capture(self, tick):
+        return self.runners[tick.camera].capture(tick)
+
+    def encode(self, tick):
+        return self.runners[tick.camera].encode(tick)
+
+    def infer(self, tick):
+        return self.runners[tick.camera].infer(tick)
+
+    def persist(self, tick):
+        return self.runners[tick.camera].persist(tick)
+
+    def stats(self):
+        stats = {
+            "pipeline": self.pipeline.stats(),
+            "cameras": {name: runner.stats() for name, runner in self.runners.items()},
+        }
+        if self.scheduler is not None:
+            stats["scheduler"] = self.scheduler.stats()
+        return stats
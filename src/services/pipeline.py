@@ -0,0 +1,340 @@
+"""
+Staged pipeline that runs blocking work off the Twisted reactor thread.
+
+Each stage has its own worker thread(s) and the stages are joined by small
+bounded queues. When a queue is full the oldest item is dropped, so a slow
+stage (usually the model) makes the pipeline lose stale frames rather than
+pile them up; queues only fill up when more items are allowed in flight than
+they hold. Every submitted item gets a Deferred that fires on the reactor
+thread with the output of the last stage.
+
+When the pipeline stops, the stages are stopped in order, each once the ones
+before it have finished their items. Items waiting in front of a stage are
+dropped, unless the stage is among those to drain, which finish them: work
+already paid for upstream (e.g. a model response waiting to be persisted)
+isn't lost.
+
+>> pipeline = Pipeline(runner.stages())
+>> pipeline.setServiceParent(top_service)
+>> internet.TimerService(step=5, callable=pipeline.tick)
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+
+from twisted.application import service
+from twisted.internet import defer, threads
+from twisted.python.failure import Failure
+
+from src.metrics import REGISTRY
+
+LOG = logging.getLogger("cctv_logger")
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "cctv_pipeline_stage_seconds",
+    "Time spent running each pipeline stage",
+    ("pipeline", "stage"),
+)
+STAGE_FAILURES = REGISTRY.counter(
+    "cctv_pipeline_failures_total",
+    "Ticks that raised in each pipeline stage",
+    ("pipeline", "stage"),
+)
+TICKS_DROPPED = REGISTRY.counter(
+    "cctv_pipeline_dropped_total",
+    "Ticks dropped from a full queue or skipped because the pipeline was busy",
+    ("pipeline", "reason"),
+)
+
+
+class QueueClosed(Exception):
+    pass
+
+
+class TickDropped(Exception):
+    "Raised through a Deferred when its item was pushed out of a full queue"
+
+
+class DropOldestQueue:
+    """
+    Thread-safe bounded FIFO queue. Putting into a full queue evicts
+    (and returns) the oldest item instead of blocking the producer.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._items = deque()
+        self._condition = threading.Condition()
+        self._closed = False
+
+    def put(self, item):
+        """Appends item, returns the item that was dropped to make room (or None)."""
+        with self._condition:
+            if self._closed:
+                raise QueueClosed()
+            dropped = None
+            if len(self._items) >= self.maxsize:
+                dropped = self._items.popleft()
+            self._items.append(item)
+            self._condition.notify()
+            return dropped
+
+    def get(self):
+        """Blocks until an item is available. Raises QueueClosed once closed and drained."""
+        with self._condition:
+            while not self._items:
+                if self._closed:
+                    raise QueueClosed()
+                self._condition.wait()
+            return self._items.popleft()
+
+    def close(self, drain=False):
+        """
+        Wakes up all consumers; any remaining items are returned, unless
+        `drain` is True: consumers then get them before QueueClosed.
+        """
+        with self._condition:
+            self._closed = True
+            remaining = []
+            if not drain:
+                remaining = list(self._items)
+                self._items.clear()
+            self._condition.notify_all()
+            return remaining
+
+    def __len__(self):
+        return len(self._items)
+
+
+class _Job:
+    __slots__ = ("item", "deferred")
+
+    def __init__(self, item, deferred):
+        self.item = item
+        self.deferred = deferred
+
+
+class Stage:
+    """
+    A named step of the pipeline, with the queue feeding it.
+
+    :param name: str: name used in logs and stats
+    :param func: callable: takes the output of the previous stage, returns its own output
+    :param workers: int: number of threads running func
+    :param queue_size: int: capacity of the input queue
+    """
+
+    def __init__(self, name, func, workers=1, queue_size=2):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.queue = DropOldestQueue(queue_size)
+        self.processed = 0
+        self.failed = 0
+        self.dropped = 0
+
+
+class Pipeline(service.Service):
+    """
+    Runs a sequence of stages on worker threads.
+
+    Stages are given as (name, callable) or (name, callable, workers) tuples.
+    The pipeline is a Twisted service: threads start with startService()
+    and are joined on stopService().
+    """
+
+    name = "pipeline"
+
+    def __init__(
+        self,
+        stages,
+        queue_size=2,
+        queue_sizes=None,
+        max_in_flight=1,
+        drain=(),
+        on_stop=None,
+        reactor=None,
+    ):
+        """
+        :param stages: list: (name, callable[, workers]) tuples, in order
+        :param queue_size: int: capacity of the queue in front of each stage
+            (the oldest item is dropped when max_in_flight goes over it)
+        :param queue_sizes: dict: stage name -> capacity of its queue, for the
+            stages whose queue differs from queue_size
+        :param max_in_flight: int: maximum number of ticks going through the pipeline
+            at once; further ticks are skipped until one finishes (tick-overrun policy)
+        :param drain: tuple: names of the stages that finish the items waiting
+            for them when the pipeline stops, instead of dropping them
+        :param on_stop: callable: run on a thread once the workers have finished,
+            e.g. to flush what the stages hold on to (None: nothing to do)
+        :param reactor: reactor to deliver results on (defaults to the global reactor)
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        queue_sizes = queue_sizes or {}
+        self.stages = [
+            Stage(*stage, queue_size=queue_sizes.get(stage[0], queue_size))
+            for stage in stages
+        ]
+        self.max_in_flight = max_in_flight
+        self.drain = set(drain)
+        self.on_stop = on_stop
+        self.in_flight = 0
+        self.overruns = 0
+        self._threads = []
+
+    def startService(self):
+        super().startService()
+        REGISTRY.gauge(
+            f"cctv_{self.name}_in_flight",
+            "Ticks going through the pipeline",
+            lambda: self.in_flight,
+        )
+        REGISTRY.gauge(
+            f"cctv_{self.name}_queued",
+            "Ticks waiting in front of each stage",
+            lambda: {(stage.name,): len(stage.queue) for stage in self.stages},
+            ("stage",),
+        )
+        for index, stage in enumerate(self.stages):
+            for worker in range(stage.workers):
+                thread = threading.Thread(
+                    target=self._work,
+                    args=(index,),
+                    name=f"{self.name}-{stage.name}-{worker}",
+                    daemon=True,
+                )
+                thread.start()
+                self._threads.append((index, thread))
+
+    def stopService(self):
+        super().stopService()
+        # no new ticks from here on
+        self._close(0)
+        return self._join()
+
+    def _close(self, index):
+        stage = self.stages[index]
+        for job in stage.queue.close(drain=stage.name in self.drain):
+            self._fail(job, Failure(TickDropped(f"pipeline stopped at {stage.name}")))
+
+    def _join(self):
+        workers, self._threads = self._threads, []
+
+        def join_all():
+            # a stage is closed once the workers of the previous one, which
+            # feed its queue, are done
+            for index in range(len(self.stages)):
+                if index > 0:
+                    self._close(index)
+                for stage_index, thread in workers:
+                    if stage_index == index:
+                        thread.join()
+            if self.on_stop is not None:
+                self.on_stop()
+
+        return threads.deferToThreadPool(
+            self._reactor, self._reactor.getThreadPool(), join_all
+        )
+
+    def submit(self, item=None):
+        """
+        Feeds an item to the first stage. Must be called from the reactor thread.
+
+        :return: Deferred firing with the output of the last stage,
+            or with None if the tick was skipped because the pipeline is full
+        """
+        if self.in_flight >= self.max_in_flight:
+            self.overruns += 1
+            TICKS_DROPPED.inc(pipeline=self.name, reason="overrun")
+            LOG.warning(
+                f"Pipeline busy ({self.in_flight} in flight), skipping tick "
+                f"({self.overruns} overruns so far)"
+            )
+            return defer.succeed(None)
+
+        self.in_flight += 1
+        deferred = defer.Deferred()
+        deferred.addBoth(self._finished)
+        self._enqueue(0, _Job(item, deferred))
+        return deferred
+
+    def tick(self):
+        """Callable for internet.TimerService: submits a tick and logs its failures.
+
+        Doesn't return the Deferred, so the timer keeps its own pace and
+        overruns are handled by submit() rather than by delaying the timer.
+        """
+        self.submit().addErrback(self.log_failure)
+
+    def _finished(self, result):
+        self.in_flight -= 1
+        return result
+
+    @staticmethod
+    def log_failure(failure):
+        if failure.check(TickDropped):
+            LOG.info(f"Tick dropped: {failure.getErrorMessage()}")
+        else:
+            LOG.error(f"Tick failed: {failure.getTraceback()}")
+
+    def _enqueue(self, index, job):
+        stage = self.stages[index]
+        try:
+            dropped = stage.queue.put(job)
+        except QueueClosed:
+            self._fail(job, Failure(TickDropped(f"pipeline stopped at {stage.name}")))
+            return
+        if dropped is not None:
+            stage.dropped += 1
+            TICKS_DROPPED.inc(pipeline=self.name, reason="queue_full")
+            self._fail(dropped, Failure(TickDropped(f"queue full at {stage.name}")))
+
+    def _fail(self, job, failure):
+        self._reactor.callFromThread(job.deferred.errback, failure)
+
+    def _work(self, index):
+        stage = self.stages[index]
+        is_last = index == len(self.stages) - 1
+        while True:
+            try:
+                job = stage.queue.get()
+            except QueueClosed:
+                return
+
+            start = time.perf_counter()
+            try:
+                job.item = stage.func(job.item)
+            except Exception:
+                stage.failed += 1
+                STAGE_FAILURES.inc(pipeline=self.name, stage=stage.name)
+                self._fail(job, Failure())
+                continue
+            finally:
+                STAGE_SECONDS.observe(
+                    time.perf_counter() - start, pipeline=self.name, stage=stage.name
+                )
+            stage.processed += 1
+
+            if is_last:
+                self._reactor.callFromThread(job.deferred.callback, job.item)
+            else:
+                self._enqueue(index + 1, job)
+
+    def stats(self):
+        return {
+            "in_flight": self.in_flight,
+            "overruns": self.overruns,
+            "stages": {
+                stage.name: {
+                    "processed": stage.processed,
+                    "failed": stage.failed,
+                    "dropped": stage.dropped,
+                    "queued": len(stage.queue),
+                }
+                for stage in self.stages
+            },
+        }
@@ -1,42 +1,475 @@
-import json
 import logging
+from contextlib import contextmanager
+from datetime import datetime, timezone
 
+from src.cache import dhash
 from src.camera import Camera
+from src.metrics import REGISTRY, SIZE_BUCKETS
 from src.model import Model, ModelChoices
-from src.mongo_client import MongoClient
-from src.schemas import Scene
+from src.motion import DEFAULT_MOTION_THRESHOLD, MotionDetector
+from src.parsing import SceneStream, coerce_scene, parse_scene
+from src.store import open_store
 from src.utils import convert_frame_to_blob
 
 LOG = logging.getLogger("cctv_logger")
 
+STEP_SECONDS = REGISTRY.histogram(
+    "cctv_step_seconds",
+    "Time spent in each step of a tick (read_frame, regions, detect, motion, hash, "
+    "crop, encode, model_request, parse, archive, insert)",
+    ("camera", "step"),
+)
+FRAMES = REGISTRY.counter(
+    "cctv_frames_total",
+    "Frames by outcome (described, skipped, cached, failed)",
+    ("camera", "outcome"),
+)
+PAYLOAD_BYTES = REGISTRY.histogram(
+    "cctv_payload_bytes",
+    "Size of the encoded frames sent to the model",
+    ("camera",),
+    buckets=SIZE_BUCKETS,
+)
+
+
+class Tick:
+    """State of a single frame as it goes through the runner stages."""
+
+    def __init__(self, timestamp=None, camera=None):
+        self.timestamp = timestamp or datetime.now(tz=timezone.utc)
+        # name of the camera the frame comes from, when running several cameras
+        self.camera = camera
+        self.frame = None
+        self.frame_hash = None
+        self.blob = None
+        self.scene = None
+        self.motion_score = None
+        # regions of the frame that differ from the background, and geometry
+        # of the part of the frame sent to the model, see src.roi
+        self.regions = None
+        self.crop = None
+        # persons and vehicles found by the local detector, see src.detector
+        self.detections = None
+        # set when the frame didn't change enough to be worth describing
+        self.skipped = False
+        # set when the frame waits to be described with the next batch
+        self.batched = False
+        # batch requests the frame was part of that failed
+        self.failed_attempts = 0
+        # ticks described by a batch request that completed on this tick
+        self.batch = []
+
 
 class CCTVLoggerRunner:
     """The runner integrates the logic for:
     1. Taking a picture with the camera
-    2. Sending it to the model
-    3. Persisting the response to the database
+    2. Checking whether the picture changed since the last one sent
+    3. Looking up near-identical frames in the scene cache
+    4. Sending it to the model
+    5. Persisting the response to the database
 
     It must implement a run() method that will be invoked
     by the twisted service, for instance
     internet.TimerService(step=30, callable=runner.run)
+
+    The same steps are exposed as separate stages (capture, encode, infer,
+    persist) so they can run on worker threads through a Pipeline instead.
     """
 
-    def __init__(self):
-        self.model = Model(ModelChoices.PRO)
-        self.camera = Camera()
-        self.client = MongoClient()
+    def __init__(
+        self,
+        motion_threshold=DEFAULT_MOTION_THRESHOLD,
+        scene_cache=None,
+        camera=None,
+        encoding_profile=None,
+        batch_size=1,
+        batch_max_age=60,
+        batch_retries=2,
+        model=None,
+        client=None,
+        collection=None,
+        writer=None,
+        latest_scenes=None,
+        region_cropper=None,
+        local_detector=None,
+        detection_refresh=600,
+        frame_archive=None,
+        streaming=False,
+    ):
+        """
+        :param motion_threshold: float: minimum frame difference to call the model
+            (None disables motion gating, every frame is sent)
+        :param scene_cache: SceneCache: cache of scenes for near-identical frames
+            (None disables caching)
+        :param camera: Camera: capturing device (defaults to Camera())
+        :param encoding_profile: EncodingProfile: how frames are encoded for upload
+            (defaults to full-resolution PNG)
+        :param batch_size: int: number of frames described per model request
+        :param batch_max_age: float: seconds after which an incomplete batch is sent anyway
+        :param batch_retries: int: times the frames of a failed batch are sent again
+            with the next batch, before they are counted as failed
+        :param model: Model: model describing the frames (defaults to Model(ModelChoices.PRO))
+        :param client: SceneStore: database client (defaults to open_store(), a local MongoDB)
+        :param collection: str: collection scenes are stored in (defaults to the client's)
+        :param writer: BulkSceneWriter: buffers scenes and inserts them in batches
+            (default: each scene is inserted as soon as it is described)
+        :param latest_scenes: LatestScenes: where persisted scenes are published for
+            the web server
+        :param region_cropper: RegionCropper: sends only the changed regions of
+            frames to the model (None: whole frames are sent)
+        :param local_detector: LocalDetector: counts persons and vehicles on the CPU;
+            frames are only sent to the model when the counts change, and the
+            counts of the other frames are stored instead (None: no local detection)
+        :param detection_refresh: float: seconds after which a frame is sent anyway,
+            to keep the environment description up to date
+        :param frame_archive: FrameArchive: keeps the frames sent to the model on
+            disk, referenced from their scenes (None: frames aren't kept)
+        :param streaming: bool: stream the model's responses and publish partial
+            scenes to latest_scenes as persons and vehicles come in (single frame
+            requests only, batches are never streamed)
+        """
+        self.model = model or Model(ModelChoices.PRO)
+        self.camera = camera or Camera()
+        self.client = client or open_store()
+        self.collection = collection
+        self.writer = writer
+        self.latest_scenes = latest_scenes
+        self.motion_detector = (
+            MotionDetector(threshold=motion_threshold)
+            if motion_threshold is not None
+            else None
+        )
+        self.scene_cache = scene_cache
+        self.region_cropper = region_cropper
+        self.local_detector = local_detector
+        self.detection_refresh = detection_refresh
+        self.frame_archive = frame_archive
+        self.streaming = streaming
+        # local counts and time of the last frame sent to the model
+        self._sent_counts = None
+        self._sent_at = None
+        self.encoding_profile = encoding_profile
+        self.batch_size = batch_size
+        self.batch_max_age = batch_max_age
+        self.batch_retries = batch_retries
+        self._pending = []
+        # arrays of encoded frames, which the next captures read into
+        self._free_frames = []
+        # ticks where the frame didn't change enough to call the model
+        self.skipped_frames = 0
+        self.last_heartbeat = None
+        self.described_frames = 0
+        # label of the metrics, one set per camera when running several
+        self.camera_label = self.collection or self.client.default_collection
 
     def run(self):
+        return self.persist(self.infer(self.encode(self.capture())))
+
+    def stages(self):
+        "Stages in the format expected by Pipeline"
+        return [
+            ("capture", self.capture),
+            ("encode", self.encode),
+            ("infer", self.infer),
+            ("persist", self.persist),
+        ]
+
+    def capture(self, tick=None):
+        tick = tick or Tick()
+        try:
+            out = self._free_frames.pop()
+        except IndexError:
+            out = None
+        with STEP_SECONDS.time(camera=self.camera_label, step="read_frame"):
+            tick.frame = self.camera.read_frame(out=out)
+        return tick
+
+    def encode(self, tick):
+        """
+        Gates on motion and on the local detector counts, looks up the scene
+        cache, crops and encodes the frame.
+
+        The frame isn't needed past this stage, its array is reused by a
+        later capture.
+        """
+        try:
+            return self._encode(tick)
+        finally:
+            if tick.frame is not None:
+                self._free_frames.append(tick.frame)
+                tick.frame = None
+
+    def _encode(self, tick):
+        camera = self.camera_label
+        if self.region_cropper is not None:
+            # before the gates, so the background follows the skipped frames too
+            with STEP_SECONDS.time(camera=camera, step="regions"):
+                tick.regions = self.region_cropper.update(tick.frame)
+
+        if self.local_detector is not None:
+            # before the motion gate: the background subtractor needs every frame
+            with STEP_SECONDS.time(camera=camera, step="detect"):
+                tick.detections = self.local_detector.detect(tick.frame)
+
+        if self.motion_detector:
+            with STEP_SECONDS.time(camera=camera, step="motion"):
+                # the reference only moves once the frame is described, see below
+                tick.skipped = not self.motion_detector.has_changed(
+                    tick.frame, update=False
+                )
+            tick.motion_score = self.motion_detector.last_score
+            if tick.skipped:
+                return tick
+
+        if tick.detections is not None:
+            tick.skipped = not self._warrants_request(tick)
+            if tick.skipped:
+                return tick
+
+        # described from here on, by the model or from the cache
+        if self.motion_detector:
+            self.motion_detector.accept()
+
+        # hash before encoding, the cache works on the raw array
+        if self.scene_cache is not None:
+            with STEP_SECONDS.time(camera=camera, step="hash"):
+                tick.frame_hash = dhash(tick.frame)
+                tick.scene = self.scene_cache.get(tick.frame_hash)
+            if tick.scene is not None:
+                LOG.info(f"Scene cache hit ({self.scene_cache.stats()})")
+                return tick
+
+        image = tick.frame
+        if self.region_cropper is not None:
+            with STEP_SECONDS.time(camera=camera, step="crop"):
+                image, tick.crop = self.region_cropper.crop(tick.frame, tick.regions)
+
+        with STEP_SECONDS.time(camera=camera, step="encode"):
+            tick.blob = convert_frame_to_blob(image, self.encoding_profile)
+        PAYLOAD_BYTES.observe(len(tick.blob.data), camera=camera)
+        return tick
+
+    def _warrants_request(self, tick):
+        "Whether the local counts changed enough to ask the model, see local_detector"
+        counts = tick.detections.counts()
+        counts = (counts["persons"], counts["vehicles"])
+        stale = (
+            self._sent_at is None
+            or (tick.timestamp - self._sent_at).total_seconds()
+            >= self.detection_refresh
+        )
+        if counts == self._sent_counts and not stale:
+            return False
+        self._sent_counts = counts
+        self._sent_at = tick.timestamp
+        return True
+
+    def infer(self, tick):
+        if self.batch_size > 1:
+            return self._infer_batch(tick)
+
+        if tick.skipped or tick.scene is not None:
+            return tick
+
         LOG.info("Sending picture...")
-        frame = self.camera.read_frame()
-        blob = convert_frame_to_blob(frame)
-        response = self.model.describe_image_from_blob(blob)
+        with self._count_failures(1), self._retract_partials(tick):
+            with STEP_SECONDS.time(camera=self.camera_label, step="model_request"):
+                if self.streaming and self.latest_scenes is not None:
+                    response = self.model.describe_image_from_blob(
+                        tick.blob, on_text=SceneStream(self._partial_publisher(tick))
+                    )
+                else:
+                    response = self.model.describe_image_from_blob(tick.blob)
+            LOG.info("Response:")
+            LOG.info(response)
+
+            with STEP_SECONDS.time(camera=self.camera_label, step="parse"):
+                tick.scene = parse_scene(response)
+        return tick
+
+    def _partial_publisher(self, tick):
+        def publish(scene):
+            self.latest_scenes.publish(
+                self.collection or self.client.default_collection,
+                scene,
+                tick.timestamp,
+                partial=True,
+            )
+
+        return publish
+
+    @contextmanager
+    def _retract_partials(self, tick):
+        "Retracts the partial scenes of the tick if the block raises"
+        try:
+            yield
+        except Exception:
+            if self.streaming and self.latest_scenes is not None:
+                self.latest_scenes.retract(
+                    self.collection or self.client.default_collection, tick.timestamp
+                )
+            raise
+
+    @contextmanager
+    def _count_failures(self, frames):
+        "Counts the frames as failed if the block raises"
+        try:
+            yield
+        except Exception:
+            FRAMES.inc(frames, camera=self.camera_label, outcome="failed")
+            raise
+
+    def _infer_batch(self, tick):
+        """
+        Queues the tick until batch_size frames are pending (or the oldest is
+        older than batch_max_age), then describes them all in one request.
+        Every tick passes through here, so skipped ticks also flush old batches.
+
+        If the request fails, the frames are queued again in front of the
+        others, and given up on after batch_retries failed requests.
+        """
+        if not tick.skipped and tick.scene is None:
+            tick.batched = True
+            self._pending.append(tick)
+
+        if not self._pending:
+            return tick
+        age = (tick.timestamp - self._pending[0].timestamp).total_seconds()
+        if len(self._pending) < self.batch_size and age < self.batch_max_age:
+            return tick
+
+        # frames queued again after a failure may make more than a batch
+        batch = self._pending[: self.batch_size]
+        self._pending = self._pending[self.batch_size :]
+        try:
+            self._describe_batch(batch)
+        except Exception:
+            retried = [pending for pending in batch if self._retry(pending)]
+            FRAMES.inc(
+                len(batch) - len(retried), camera=self.camera_label, outcome="failed"
+            )
+            self._pending = retried + self._pending
+            raise
+        tick.batch = batch
+        return tick
+
+    def _retry(self, tick):
+        "Whether a frame of a failed batch is to be sent again"
+        tick.failed_attempts += 1
+        return tick.failed_attempts <= self.batch_retries
+
+    def _describe_batch(self, batch):
+        timestamps = [pending.timestamp for pending in batch]
+        LOG.info(f"Sending batch of {len(batch)} pictures...")
+        with STEP_SECONDS.time(camera=self.camera_label, step="model_request"):
+            response = self.model.describe_images_from_blobs(
+                [pending.blob for pending in batch], timestamps
+            )
         LOG.info("Response:")
         LOG.info(response)
 
-        scene = Scene(json.loads(response))
-        for key in Scene.__required_keys__:
-            if key not in scene:
-                scene[key] = []
-        self.client.insert_scene(scene)
-        # ...
+        with STEP_SECONDS.time(camera=self.camera_label, step="parse"):
+            for pending, (_, scene) in zip(
+                batch, self.model.split_batch_response(response, timestamps)
+            ):
+                pending.scene = coerce_scene(scene)
+
+    def flush(self):
+        """
+        Describes and persists the frames still waiting for a batch, e.g. once
+        the pipeline has stopped. Frames that can't be described are counted
+        as failed.
+        """
+        pending, self._pending = self._pending, []
+        while pending:
+            batch, pending = pending[: self.batch_size], pending[self.batch_size :]
+            try:
+                self._describe_batch(batch)
+            except Exception:
+                LOG.exception(f"Could not describe {len(batch)} pending pictures")
+                FRAMES.inc(len(batch), camera=self.camera_label, outcome="failed")
+                continue
+            for described in batch:
+                self._persist_scene(described)
+
+    def persist(self, tick):
+        for described in tick.batch:
+            self._persist_scene(described)
+
+        if tick.skipped:
+            self.skipped_frames += 1
+            FRAMES.inc(camera=self.camera_label, outcome="skipped")
+            self.last_heartbeat = tick.timestamp
+            details = []
+            if tick.motion_score is not None:
+                details.append(f"score {tick.motion_score:.2f}")
+            if tick.detections is not None:
+                counts = tick.detections.counts()
+                details.append(
+                    f"{counts['persons']} persons, {counts['vehicles']} vehicles"
+                )
+                with STEP_SECONDS.time(camera=self.camera_label, step="insert"):
+                    self.client.insert_detections(
+                        counts, timestamp=tick.timestamp, collection=self.collection
+                    )
+            LOG.info(
+                f"Heartbeat at {self.last_heartbeat.isoformat()}: no significant change "
+                f"({', '.join(details)}), {self.skipped_frames} frames skipped so far"
+            )
+            return tick
+
+        if not tick.batched:
+            self._persist_scene(tick)
+        return tick
+
+    def _persist_scene(self, tick):
+        if tick.blob is not None and tick.frame_hash is not None:
+            self.scene_cache.put(tick.frame_hash, tick.scene)
+        frame = None
+        if self.frame_archive is not None and tick.blob is not None:
+            with STEP_SECONDS.time(camera=self.camera_label, step="archive"):
+                try:
+                    frame = self.frame_archive.append(
+                        tick.blob.data, tick.blob.mime_type, tick.timestamp
+                    )
+                except OSError:
+                    # the scene is worth storing even without its frame
+                    LOG.exception("Could not archive the frame")
+        with STEP_SECONDS.time(camera=self.camera_label, step="insert"):
+            if self.writer is not None:
+                self.writer.add(
+                    tick.scene,
+                    timestamp=tick.timestamp,
+                    collection=self.collection,
+                    crop=tick.crop,
+                    frame=frame,
+                )
+            else:
+                self.client.insert_scene(
+                    tick.scene,
+                    timestamp=tick.timestamp,
+                    collection=self.collection,
+                    crop=tick.crop,
+                    frame=frame,
+                )
+        if self.latest_scenes is not None:
+            self.latest_scenes.publish(
+                self.collection or self.client.default_collection,
+                tick.scene,
+                tick.timestamp,
+            )
+        self.described_frames += 1
+        outcome = "cached" if tick.blob is None else "described"
+        FRAMES.inc(camera=self.camera_label, outcome=outcome)
+
+    def stats(self):
+        stats = {
+            "described_frames": self.described_frames,
+            "skipped_frames": self.skipped_frames,
+            "last_heartbeat": self.last_heartbeat,
+        }
+        if self.scene_cache is not None:
+            stats["scene_cache"] = self.scene_cache.stats()
+        if self.camera.grabber is not None:
+            stats["grabber"] = self.camera.grabber.stats()
+        return stats
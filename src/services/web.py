@@ -1,38 +1,378 @@
 import json
 
-from twisted.web import resource
+from twisted.internet import defer, task, threads
+from twisted.web import http, resource, server
 
-from src.mongo_client import MongoClient
-from src.utils import today_start, summarise_scenes
+from src.metrics import REGISTRY
+from src.services.frames import FramePage
+from src.services.history import (
+    BadRequest,
+    SceneHistory,
+    SceneSummary,
+    SightingCount,
+    query_arg,
+    repeated_sightings,
+)
+from src.store import open_store
+
+# seconds between keep-alive comments on idle event streams
+EVENT_STREAM_KEEPALIVE = 15
+# longest a long-poll request may wait for a new scene
+MAX_LONG_POLL_WAIT = 60
+
+
+class LatestScenes:
+    """
+    In-memory copy of the latest scene of every collection.
+
+    The runner publishes each scene as it persists it, so serving the
+    latest scene never touches the database, and listeners (event streams,
+    long-poll requests) are notified as soon as a scene arrives.
+
+    Partial scenes, published while a response is streaming in, are sent to
+    the listeners but kept apart from the latest complete scene, which
+    get() returns. If the description fails, retract() sends the listeners
+    the latest complete scene again.
+
+    publish() and retract() may be called from any thread, everything else
+    runs on the reactor.
+    """
+
+    def __init__(self, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        # collection -> (etag, scene_data)
+        self._latest = {}
+        # collection -> (etag, scene_data) of the scene being described
+        self._partial = {}
+        # collection -> list of callables taking (etag, scene_data)
+        self._listeners = {}
+        self._version = 0
+
+    def publish(self, collection, scene, timestamp, partial=False):
+        """
+        Records a new scene for a collection and notifies its listeners.
+
+        :param collection: str: mongo collection name
+        :param scene: Scene: scene description as outputted by model
+        :param timestamp: datetime: time when scene was captured
+        :param partial: bool: whether the scene is still being described, the
+            complete scene follows with the same timestamp
+        """
+        scene_data = {"scene": scene, "timestamp": timestamp}
+        if partial:
+            scene_data["partial"] = True
+        self._reactor.callFromThread(self._update, collection, scene_data)
+
+    def retract(self, collection, timestamp):
+        """
+        Drops the partial scene of a frame whose description failed, and
+        sends the listeners the latest complete scene again.
+
+        :param collection: str: mongo collection name
+        :param timestamp: datetime: time when the frame was captured
+        """
+        self._reactor.callFromThread(self._retract, collection, timestamp)
+
+    def _retract(self, collection, timestamp):
+        partial = self._partial.get(collection)
+        if partial is None or partial[1]["timestamp"] != timestamp:
+            return
+        del self._partial[collection]
+        latest = self._latest.get(collection)
+        if latest is not None:
+            for listener in list(self._listeners.get(collection, [])):
+                listener(*latest)
+
+    def _update(self, collection, scene_data):
+        timestamp = scene_data["timestamp"]
+        current = self._latest.get(collection)
+        if current is not None and current[1]["timestamp"] is not None:
+            # batches and late inserts can arrive out of order
+            if _naive(timestamp) < _naive(current[1]["timestamp"]):
+                return
+        self._version += 1
+        # the version alone would repeat after a restart, the timestamp makes it unique
+        seconds = _naive(timestamp).timestamp() if timestamp is not None else 0
+        etag = f'"{self._version}-{seconds:.0f}"'
+        if scene_data.get("partial"):
+            self._partial[collection] = (etag, scene_data)
+        else:
+            self._latest[collection] = (etag, scene_data)
+            partial = self._partial.get(collection)
+            if partial is not None and timestamp is not None:
+                # completed, or superseded by a later frame
+                if _naive(partial[1]["timestamp"]) <= _naive(timestamp):
+                    del self._partial[collection]
+        for listener in list(self._listeners.get(collection, [])):
+            listener(etag, scene_data)
+
+    def seed(self, collection, scene_data):
+        "Sets the latest scene from the database, unless one was published already"
+        if collection not in self._latest:
+            self._update(collection, scene_data)
+
+    def get(self, collection):
+        """Returns (etag, scene_data) for a collection, or None if unknown."""
+        return self._latest.get(collection)
+
+    def listen(self, collection, listener):
+        self._listeners.setdefault(collection, []).append(listener)
+
+    def unlisten(self, collection, listener):
+        listeners = self._listeners.get(collection, [])
+        if listener in listeners:
+            listeners.remove(listener)
+
+    def next(self, collection, timeout):
+        """
+        Returns a Deferred firing with (etag, scene_data) of the next published
+        complete scene, or with None after timeout seconds.
+        """
+        deferred = defer.Deferred()
+        current = self._latest.get(collection)
+
+        def on_scene(etag, scene_data):
+            if scene_data.get("partial") or (current and etag == current[0]):
+                # a partial scene, or the current one again after a retraction
+                return
+            self.unlisten(collection, on_scene)
+            if not deferred.called:
+                deferred.callback((etag, scene_data))
+
+        def on_timeout():
+            self.unlisten(collection, on_scene)
+            if not deferred.called:
+                deferred.callback(None)
+
+        def cancel_timer(result):
+            if timer.active():
+                timer.cancel()
+            return result
+
+        self.listen(collection, on_scene)
+        timer = self._reactor.callLater(timeout, on_timeout)
+        deferred.addBoth(cancel_timer)
+        return deferred
+
+
+def _naive(timestamp):
+    "Mongo returns naive UTC datetimes, the runner aware ones, compare them as naive"
+    return timestamp.replace(tzinfo=None)
+
+
+def _dumps(data):
+    return json.dumps(data, default=str).encode("utf-8")
 
 
 class CCTVLoggerServer(resource.Resource):
-    isLeaf = True
-    client = MongoClient()
+    """
+    Serves the latest scene, as JSON, on any path without a resource of its own.
+
+    Responses carry an ETag: requests with a matching If-None-Match get a
+    304. Adding ?wait=<seconds> turns a matching request into a long poll
+    that is answered as soon as a new scene is published.
+    """
+
+    def __init__(
+        self,
+        client=None,
+        latest_scenes=None,
+        collection=None,
+        profiler=None,
+        frame_archives=None,
+    ):
+        """
+        :param client: SceneStore: database client, share the runner's to get
+            its rolling sighting counters (defaults to open_store(), a local MongoDB)
+        :param latest_scenes: LatestScenes: latest scenes published by the runner
+        :param collection: str: collection to serve (defaults to the client's)
+        :param profiler: SamplingProfiler: served at /profile when given
+        :param frame_archives: dict: camera name -> FrameArchive, whose frames are
+            served at /frame when given
+        """
+        super().__init__()
+        self.client = client or open_store()
+        self.latest_scenes = latest_scenes or LatestScenes()
+        self.collection = collection or self.client.default_collection
+        self.putChild(b"events", SceneEvents(self.latest_scenes, self.collection))
+        self.putChild(b"metrics", MetricsPage(REGISTRY))
+        if profiler is not None:
+            self.putChild(b"profile", ProfilePage(profiler))
+        if frame_archives is not None:
+            self.putChild(b"frame", FramePage(frame_archives, self.collection))
+        # gzip is used when the client sends Accept-Encoding: gzip
+        for name, history_resource in (
+            (b"history", SceneHistory),
+            (b"summary", SceneSummary),
+            (b"sightings", SightingCount),
+        ):
+            self.putChild(
+                name,
+                resource.EncodingResourceWrapper(
+                    history_resource(self.client, self.collection),
+                    [server.GzipEncoderFactory()],
+                ),
+            )
+
+    def getChild(self, path, request):
+        # the latest scene is served on every path, e.g. "/" or "/scene"
+        return self
 
     def render_GET(self, request):
-        scene_data = self.client.get_latest_scene()
+        self._render_latest(request).addErrback(self._render_error, request)
+        return server.NOT_DONE_YET
+
+    @defer.inlineCallbacks
+    def _render_latest(self, request):
+        wait = min(query_arg(request, "wait", float, default=0), MAX_LONG_POLL_WAIT)
+        # the client may go away while we wait for the database or a new scene
+        gone = []
+        request.notifyFinish().addBoth(gone.append)
+
+        latest = self.latest_scenes.get(self.collection)
+        if latest is None:
+            # nothing published since start-up, read it once from the database
+            scene_data = yield threads.deferToThread(
+                self.client.get_latest_scene, collection=self.collection
+            )
+            self.latest_scenes.seed(self.collection, scene_data)
+            latest = self.latest_scenes.get(self.collection)
+
+        if_none_match = request.getHeader("If-None-Match")
+        if wait > 0 and if_none_match == latest[0]:
+            latest = (yield self.latest_scenes.next(self.collection, wait)) or latest
+        if gone:
+            return
+
+        etag, scene_data = latest
+        request.setHeader("Cache-Control", "no-cache")
+        if request.setETag(etag.encode()) == http.CACHED:
+            request.finish()
+            return
+
         # repeated_counts = self._check_repeated()
         response = {
             "scene_data": scene_data,
             # "repeated_counts": repeated_counts
         }
         request.setHeader("Content-Type", "application/json")
-        return json.dumps(response, default=str).encode("utf-8")
+        request.write(_dumps(response))
+        request.finish()
+
+    @staticmethod
+    def _render_error(failure, request):
+        if failure.check(BadRequest):
+            request.setResponseCode(http.BAD_REQUEST)
+        else:
+            request.setResponseCode(http.INTERNAL_SERVER_ERROR)
+        request.write(_dumps({"error": failure.getErrorMessage()}))
+        request.finish()
 
-    def _check_repeated(self, start_time=None, end_time=None, thresh=5):
+    def _check_repeated(self, start_time=None, end_time=None, thresh=5, window=None):
         """
         Returns a tuple with persons and vehicles that repeatedly show up in time range.
 
-        :param start_time: datetime: left side of timestamp range (default: start of today)
-        :param end_time: datetime: right side of timestamp range (default: now)
-        :param thresh: int: minimum number of counts to consider a repeat pattern 'common'
-            (default: 5)
+        See src.services.history.repeated_sightings.
         """
-        start_time = today_start if start_time is None else start_time
-        scenes_in_range = self.client.get_scenes_in_timerange(start_time, end_time)
-        persons, vehicles = summarise_scenes(scenes_in_range, thresh)
+        return repeated_sightings(
+            self.client, start_time, end_time, thresh, window, self.collection
+        )
+
+
+class SceneEvents(resource.Resource):
+    """
+    Server-Sent Events stream of new scenes.
+
+    The current scene is sent on connection, then every published scene as
+    a "scene" event whose id is the scene's ETag.
+
+    >> new EventSource("/events").addEventListener("scene", ...)
+    """
+
+    isLeaf = True
+
+    def __init__(self, latest_scenes, collection):
+        super().__init__()
+        self.latest_scenes = latest_scenes
+        self.collection = collection
+        self._streams = set()
+        self._keepalive = task.LoopingCall(self._send_keepalive)
+
+    def render_GET(self, request):
+        request.setHeader("Content-Type", "text/event-stream")
+        request.setHeader("Cache-Control", "no-cache")
+        # don't let proxies buffer the stream
+        request.setHeader("X-Accel-Buffering", "no")
+
+        def send(etag, scene_data):
+            request.write(
+                b"event: scene\nid: "
+                + etag.encode()
+                + b"\ndata: "
+                + _dumps({"scene_data": scene_data})
+                + b"\n\n"
+            )
+
+        latest = self.latest_scenes.get(self.collection)
+        last_event_id = request.getHeader("Last-Event-ID")
+        if latest is not None and latest[0] != last_event_id:
+            send(*latest)
+        else:
+            request.write(b": connected\n\n")
+
+        self.latest_scenes.listen(self.collection, send)
+        self._streams.add(request)
+        if not self._keepalive.running:
+            self._keepalive.start(EVENT_STREAM_KEEPALIVE, now=False)
 
-        common_persons = {p: count for p, count in persons.items() if count > thresh}
-        common_vehicles = {v: count for v, count in vehicles.items() if count > thresh}
-        return common_persons, common_vehicles
+        def closed(_):
+            self.latest_scenes.unlisten(self.collection, send)
+            self._streams.discard(request)
+            if not self._streams and self._keepalive.running:
+                self._keepalive.stop()
+
+        request.notifyFinish().addBoth(closed)
+        return server.NOT_DONE_YET
+
+    def _send_keepalive(self):
+        for request in list(self._streams):
+            request.write(b": keepalive\n\n")
+
+
+class MetricsPage(resource.Resource):
+    "Metrics in the Prometheus text format, for scraping"
+
+    isLeaf = True
+
+    def __init__(self, registry):
+        super().__init__()
+        self.registry = registry
+
+    def render_GET(self, request):
+        request.setHeader("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        return self.registry.render().encode("utf-8")
+
+
+class ProfilePage(resource.Resource):
+    """
+    Stacks sampled by a SamplingProfiler, in the folded format.
+
+    $ curl localhost:8080/profile | flamegraph.pl > profile.svg
+
+    ?reset=1 clears the samples after reading them.
+    """
+
+    isLeaf = True
+
+    def __init__(self, profiler):
+        super().__init__()
+        self.profiler = profiler
+
+    def render_GET(self, request):
+        request.setHeader("Content-Type", "text/plain; charset=utf-8")
+        folded = self.profiler.folded()
+        if request.args.get(b"reset"):
+            self.profiler.reset()
+        return folded.encode("utf-8")
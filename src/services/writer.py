@@ -0,0 +1,31 @@
+"""
+Service closing a BulkSceneWriter once the services feeding it have stopped.
+
+Pipeline workers finish their current ticks when the pipeline stops, and
+those ticks may still add scenes to the writer. The services that use the
+writer are made children of SceneWriterService, which closes the writer
+only after all of them are stopped, on a thread since closing flushes the
+buffer to the database.
+
+>> writer_service = SceneWriterService(BulkSceneWriter(MongoClient()))
+>> runner.pipeline.setServiceParent(writer_service)
+>> writer_service.setServiceParent(top_service)
+"""
+
+from twisted.application import service
+from twisted.internet import threads
+
+
+class SceneWriterService(service.MultiService):
+    def __init__(self, writer):
+        """
+        :param writer: BulkSceneWriter: closed once the child services are stopped
+        """
+        super().__init__()
+        self.writer = writer
+
+    def stopService(self):
+        stopped = super().stopService()
+        # write out the buffered scenes before exiting
+        stopped.addCallback(lambda _: threads.deferToThread(self.writer.close))
+        return stopped
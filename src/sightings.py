@@ -0,0 +1,132 @@
+"""
+Module for counting repeat sightings of persons and vehicles.
+
+Counts are kept per time bucket, so a query over a window only combines a
+handful of buckets instead of rescanning every scene in it:
+
+- RollingSightings keeps minute buckets in memory for a sliding window
+  (e.g. "this man has passed by 3 times in the last hour").
+- MongoClient and SQLiteClient keep hourly rollups in the database, used
+  for longer ranges (e.g. everything since midnight).
+"""
+
+import threading
+from collections import Counter, deque
+from datetime import datetime, timezone
+
+from src.utils import scene_sighting_keys
+
+PERSON = "person"
+VEHICLE = "vehicle"
+# names of the parts of a sighting key, as stored in the rollups
+KEY_FIELDS = {PERSON: ("gender", "clothes"), VEHICLE: ("type", "color")}
+
+
+def hour_start(timestamp: datetime) -> datetime:
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+
+def rollup_increments(scene):
+    """
+    Returns a Counter of (kind, key) -> count for a scene, as stored in the
+    hourly rollups.
+    """
+    persons, vehicles = scene_sighting_keys(scene)
+    increments = Counter((PERSON, key) for key in persons)
+    increments.update((VEHICLE, key) for key in vehicles)
+    return increments
+
+
+class RollingSightings:
+    """
+    Sliding-window counters of (gender, clothes) and (type, color) sightings.
+
+    Sightings are added to fixed-size time buckets, and buckets older than the
+    window are dropped as new ones come in, so a query costs O(buckets).
+    """
+
+    def __init__(self, window=3600, bucket=60):
+        """
+        :param window: float: length of the sliding window in seconds
+        :param bucket: float: length of each bucket in seconds
+        """
+        self.window = window
+        self.bucket = bucket
+        # (bucket start as unix time, persons Counter, vehicles Counter), oldest first
+        self._buckets = deque()
+        self._lock = threading.Lock()
+
+    def _bucket_start(self, timestamp: datetime) -> float:
+        return timestamp.timestamp() // self.bucket * self.bucket
+
+    def _expire(self, now: float):
+        while self._buckets and self._buckets[0][0] <= now - self.window - self.bucket:
+            self._buckets.popleft()
+
+    def _find_bucket(self, start):
+        "Returns the bucket starting at `start`, creating it in order if needed"
+        # scenes usually arrive in order, so search from the newest bucket
+        for index in range(len(self._buckets) - 1, -1, -1):
+            if self._buckets[index][0] == start:
+                return self._buckets[index]
+            if self._buckets[index][0] < start:
+                break
+        else:
+            index = -1
+        bucket = (start, Counter(), Counter())
+        self._buckets.insert(index + 1, bucket)
+        return bucket
+
+    def add(self, scene, timestamp=None):
+        """
+        Counts the persons and vehicles of a scene.
+
+        :param scene: Scene: scene description as outputted by model
+        :param timestamp: datetime: time when scene was captured (if not provided, uses now())
+        """
+        timestamp = timestamp or datetime.now(tz=timezone.utc)
+        start = self._bucket_start(timestamp)
+        persons, vehicles = scene_sighting_keys(scene)
+
+        with self._lock:
+            bucket = self._find_bucket(start)
+            bucket[1].update(persons)
+            bucket[2].update(vehicles)
+            self._expire(self._bucket_start(datetime.now(tz=timezone.utc)))
+
+    def counts(self, window=None, now=None):
+        """
+        Returns (persons, vehicles) Counters for the last `window` seconds.
+
+        :param window: float: seconds to look back (defaults to the full window,
+            can't be longer than it)
+        :param now: datetime: end of the window (if not provided, uses now())
+        """
+        window = window or self.window
+        if window > self.window:
+            raise ValueError(
+                f"Can't count over {window} seconds, only {self.window} are kept"
+            )
+        now = now or datetime.now(tz=timezone.utc)
+        since = now.timestamp() - window
+
+        persons = Counter()
+        vehicles = Counter()
+        with self._lock:
+            self._expire(now.timestamp())
+            for start, bucket_persons, bucket_vehicles in reversed(self._buckets):
+                # a bucket counts if any of it falls in the window
+                if start + self.bucket <= since:
+                    break
+                persons.update(bucket_persons)
+                vehicles.update(bucket_vehicles)
+        return persons, vehicles
+
+    def seed(self, scenes_with_timestamps):
+        """
+        Fills the counters from (scene, timestamp) tuples, e.g. on start-up.
+        """
+        for scene, timestamp in scenes_with_timestamps:
+            if timestamp.tzinfo is None:
+                timestamp = timestamp.replace(tzinfo=timezone.utc)
+            self.add(scene, timestamp)
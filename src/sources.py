@@ -0,0 +1,176 @@
+"""
+Module for replaying recorded footage as if it came from a camera.
+
+Sources have the same interface as Camera (read_frame, frames, is_open,
+close), so they can be passed to CCTVLoggerRunner in place of a camera.
+Frames follow the recording's timeline: at speed=1 a source returns the
+frame that would be live now, at speed=10 it plays ten times faster, and
+with speed=None every read returns the next frame.
+
+>> source = VideoFileSource("/path/to/doorstep.mp4", speed=10, loop=True)
+>> runner = CCTVLoggerRunner(camera=source)
+
+>> for frame in ImageDirectorySource("/path/to/snapshots", fps=0.2).frames():
+>>     ...
+"""
+
+import os
+import time
+from abc import ABC, abstractmethod
+
+import cv2
+import numpy as np
+
+from src.camera import FrameNotFoundError, show_frame
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp", ".bmp")
+
+
+class ReplaySource(ABC):
+    """
+    Base class for sources replaying a fixed sequence of frames.
+
+    Subclasses implement the abstract _frame_count(), _fps() and _load(index).
+    """
+
+    # replay sources never run a background grabber, see Camera.grabber
+    grabber = None
+
+    def __init__(self, speed=1.0, loop=False):
+        """
+        :param speed: float: replay speed relative to real time (None: no pacing,
+            every read returns the next frame)
+        :param loop: bool: whether to start over at the end of the recording
+        """
+        self.speed = speed
+        self.loop = loop
+        self._started_at = None
+        self._next_index = 0
+        self._closed = False
+
+    @abstractmethod
+    def _frame_count(self) -> int:
+        "Number of frames in the recording"
+
+    @abstractmethod
+    def _fps(self) -> float:
+        "Frames per second of the recording"
+
+    @abstractmethod
+    def _load(self, index) -> np.ndarray:
+        "Returns the frame at an index"
+
+    def _current_index(self):
+        "Index of the frame to return now, following the replay timeline"
+        if self.speed is None:
+            index = self._next_index
+            self._next_index += 1
+        else:
+            if self._started_at is None:
+                self._started_at = time.monotonic()
+            elapsed = (time.monotonic() - self._started_at) * self.speed
+            index = int(elapsed * self._fps())
+
+        count = self._frame_count()
+        if index >= count:
+            if not self.loop or count == 0:
+                raise FrameNotFoundError("End of recording")
+            index %= count
+        return index
+
+    def read_frame(self, out=None) -> np.ndarray:
+        "Returns the frame due now, `out` is ignored: frames are loaded as new arrays"
+        if self._closed:
+            raise FrameNotFoundError("Source is closed")
+        return self._load(self._current_index())
+
+    def frames(self) -> "Iterable[np.ndarray]":
+        while True:
+            try:
+                yield self.read_frame()
+            except FrameNotFoundError:
+                return
+
+    def is_open(self):
+        return not self._closed
+
+    def close(self):
+        self._closed = True
+
+    def show_current_frame(self):
+        """For debugging purposes."""
+        show_frame(self.read_frame())
+
+
+class VideoFileSource(ReplaySource):
+    "Replays a video file (anything OpenCV can decode)"
+
+    def __init__(self, path, speed=1.0, loop=False):
+        """
+        :param path: str: path of the video file
+        """
+        super().__init__(speed=speed, loop=loop)
+        self.path = path
+        self.video_capture = cv2.VideoCapture(path)
+        if not self.video_capture.isOpened():
+            raise FrameNotFoundError(f"Could not open video {path}")
+        self._count = int(self.video_capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        self._video_fps = self.video_capture.get(cv2.CAP_PROP_FPS) or 25.0
+        # index of the frame the capture will decode next
+        self._position = 0
+
+    def _frame_count(self):
+        return self._count
+
+    def _fps(self):
+        return self._video_fps
+
+    def _load(self, index):
+        if index < self._position or index - self._position > self._video_fps:
+            # seeking is slow, only worth it for jumps longer than a second
+            self.video_capture.set(cv2.CAP_PROP_POS_FRAMES, index)
+            self._position = index
+        while self._position < index:
+            # grab() skips frames without decoding them
+            self.video_capture.grab()
+            self._position += 1
+
+        returned, frame = self.video_capture.read()
+        if not returned:
+            raise FrameNotFoundError(f"Could not read frame {index} of {self.path}")
+        self._position += 1
+        return frame
+
+    def close(self):
+        super().close()
+        self.video_capture.release()
+
+
+class ImageDirectorySource(ReplaySource):
+    "Replays the images of a directory, in file name order, at a fixed frame rate"
+
+    def __init__(self, path, fps=1.0, speed=1.0, loop=False):
+        """
+        :param path: str: directory containing the images
+        :param fps: float: frame rate the images were taken at
+        """
+        super().__init__(speed=speed, loop=loop)
+        self.path = path
+        self.fps = fps
+        self.paths = sorted(
+            os.path.join(path, name)
+            for name in os.listdir(path)
+            if name.lower().endswith(IMAGE_EXTENSIONS)
+        )
+
+    def _frame_count(self):
+        return len(self.paths)
+
+    def _fps(self):
+        return self.fps
+
+    def _load(self, index):
+        frame = cv2.imread(self.paths[index])
+        if frame is None:
+            raise FrameNotFoundError(f"Could not read image {self.paths[index]}")
+        return frame
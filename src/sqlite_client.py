@@ -0,0 +1,512 @@
+"""
+Module for storing scenes in an SQLite database file, for single-box
+installs that shouldn't need a MongoDB server.
+
+Scenes are stored as JSON, in one table for all collections, indexed by
+(collection, timestamp). Hourly sighting counts are kept up to date with a
+JSON1 query over the persons and vehicles of the inserted scenes, in the
+same transaction, so they can't disagree with the scenes.
+
+The database runs in WAL mode: each thread reads through its own
+connection without waiting for the writer, and all writes go through one
+connection, a batch of scenes per transaction.
+
+>> store = SQLiteClient("cctv_logger.db", retention=30 * 86400)
+>> store.insert_scene(scene)
+>> store.get_latest_scene()
+"""
+
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+from src.sightings import PERSON, VEHICLE, hour_start
+from src.store import LocalCountsDocument, MongoDocument, SceneStore, StoreUnavailable
+from src.utils import sanitise_string
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+HOUR_MICROS = 3600 * 10**6
+# seconds between deletions of the scenes older than the retention period
+PURGE_INTERVAL = 60
+
+# timestamps are integer microseconds since the epoch (UTC), exact enough
+# for keyset pagination to compare them for equality
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scenes (
+    id INTEGER PRIMARY KEY,
+    collection TEXT NOT NULL,
+    timestamp INTEGER NOT NULL,
+    doc_id TEXT NOT NULL UNIQUE,
+    scene TEXT NOT NULL CHECK (json_valid(scene)),
+    crop TEXT,
+    frame TEXT
+);
+CREATE INDEX IF NOT EXISTS scenes_timestamp ON scenes (collection, timestamp, doc_id);
+CREATE TABLE IF NOT EXISTS detections (
+    id INTEGER PRIMARY KEY,
+    collection TEXT NOT NULL,
+    timestamp INTEGER NOT NULL,
+    persons INTEGER NOT NULL,
+    vehicles INTEGER NOT NULL,
+    moving INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS detections_timestamp ON detections (collection, timestamp);
+CREATE TABLE IF NOT EXISTS sightings_hourly (
+    collection TEXT NOT NULL,
+    hour INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    -- JSON encoded parts of the sighting key, see KEY_FIELDS ("null" if missing)
+    first TEXT NOT NULL,
+    second TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    UNIQUE (collection, hour, kind, first, second)
+);
+"""
+
+INSERT_SCENE = """
+INSERT OR IGNORE INTO scenes (collection, timestamp, doc_id, scene, crop, frame)
+VALUES (?, ?, ?, ?, ?, ?)
+"""
+# counts the persons and vehicles of the scenes inserted after a rowid,
+# keyed like src.utils.scene_sighting_keys
+ROLLUP_SIGHTINGS = f"""
+INSERT INTO sightings_hourly (collection, hour, kind, first, second, count)
+SELECT collection, hour, kind, first, second, count(*) FROM (
+    SELECT s.collection, s.timestamp - s.timestamp % {HOUR_MICROS} AS hour,
+        '{PERSON}' AS kind,
+        json_quote(json_extract(p.value, '$.gender')) AS first,
+        json_quote(sanitise(coalesce(json_extract(p.value, '$.clothes'), ''))) AS second
+    FROM scenes AS s, json_each(s.scene, '$.persons') AS p
+    WHERE s.id > ?
+    UNION ALL
+    SELECT s.collection, s.timestamp - s.timestamp % {HOUR_MICROS}, '{VEHICLE}',
+        json_quote(json_extract(v.value, '$.type')),
+        json_quote(json_extract(v.value, '$.color'))
+    FROM scenes AS s, json_each(s.scene, '$.vehicles') AS v
+    WHERE s.id > ?
+)
+GROUP BY collection, hour, kind, first, second
+ON CONFLICT (collection, hour, kind, first, second)
+DO UPDATE SET count = count + excluded.count
+"""
+INSERT_DETECTIONS = """
+INSERT INTO detections (collection, timestamp, persons, vehicles, moving)
+VALUES (?, ?, ?, ?, ?)
+"""
+SELECT_SIGHTINGS = """
+SELECT kind, first, second, sum(count) FROM sightings_hourly
+WHERE collection = ? AND hour >= ? AND hour <= ?
+GROUP BY kind, first, second
+"""
+SELECT_DETECTIONS = """
+SELECT timestamp, persons, vehicles, moving FROM detections
+WHERE collection = ? AND timestamp >= ? AND timestamp <= ?
+ORDER BY timestamp
+"""
+
+# scene document field -> column
+COLUMNS = {
+    "_id": "doc_id",
+    "scene": "scene",
+    "timestamp": "timestamp",
+    "crop": "crop",
+    "frame": "frame",
+}
+JSON_FIELDS = ("scene", "crop", "frame")
+
+
+def to_micros(timestamp):
+    "Microseconds since the epoch of a datetime (naive datetimes are UTC)"
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return (timestamp - EPOCH) // MICROSECOND
+
+
+def from_micros(micros):
+    "Naive UTC datetime, as pymongo returns them"
+    return EPOCH + timedelta(microseconds=micros)
+
+
+def _dumps(value):
+    return None if value is None else json.dumps(value)
+
+
+class SQLiteClient(SceneStore):
+    "Stores the scenes of all cameras in an SQLite database file"
+
+    def __init__(
+        self,
+        path="cctv_logger.db",
+        sightings_window=3600,
+        retention=None,
+        sighting_index_window=None,
+        busy_timeout=5,
+    ):
+        """
+        :param path: str: database file, created if needed (":memory:" keeps
+            everything in memory, for tests and benchmarks)
+        :param sightings_window: float: seconds covered by the in-memory rolling
+            sighting counters
+        :param retention: int: seconds after which scenes are deleted
+            (default: scenes are kept forever)
+        :param sighting_index_window: float: seconds of sightings kept in the
+            in-memory similarity index, see src.reid (None disables the index)
+        :param busy_timeout: float: seconds a write waits for another process
+            holding the database before giving up
+        """
+        super().__init__(
+            sightings_window=sightings_window,
+            retention=retention,
+            sighting_index_window=sighting_index_window,
+        )
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        self._last_purge = 0
+        self._writer = self._connect()
+        self._writer.create_function("sanitise", 1, sanitise_string, deterministic=True)
+        with self._write_lock:
+            self._writer.executescript(SCHEMA)
+
+    @property
+    def in_memory(self):
+        return self.path == ":memory:"
+
+    def _connect(self):
+        # isolation_level=None: transactions are begun explicitly, reads
+        # don't hold a snapshot open between statements
+        connection = sqlite3.connect(
+            self.path,
+            timeout=self.busy_timeout,
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=256,
+        )
+        if not self.in_memory:
+            connection.execute("PRAGMA journal_mode=WAL")
+            # WAL makes NORMAL safe against corruption, the last transactions
+            # may only be lost on a power failure
+            connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def _read(self, sql, parameters=()):
+        "Runs a query on the calling thread's connection, returns all rows"
+        if self.in_memory:
+            # a private in-memory database can only be shared with the writer
+            with self._write_lock:
+                return self._writer.execute(sql, parameters).fetchall()
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._local.connection = self._connect()
+        return connection.execute(sql, parameters).fetchall()
+
+    def _write(self, statements):
+        """
+        Runs (sql, parameters) pairs, or callables taking the connection, in
+        a single transaction.
+
+        Raises StoreUnavailable if the database is busy or can't be written.
+        """
+        with self._write_lock:
+            try:
+                self._writer.execute("BEGIN IMMEDIATE")
+                try:
+                    result = statements(self._writer)
+                    self._purge()
+                except BaseException:
+                    # some errors roll the transaction back by themselves
+                    if self._writer.in_transaction:
+                        self._writer.execute("ROLLBACK")
+                    raise
+                self._writer.execute("COMMIT")
+            except sqlite3.OperationalError as e:
+                raise StoreUnavailable(f"Could not write to {self.path}: {e}") from e
+        return result
+
+    def _purge(self):
+        "Deletes the scenes and detections older than the retention period"
+        if self.retention is None or time.time() - self._last_purge < PURGE_INTERVAL:
+            return
+        self._last_purge = time.time()
+        oldest = to_micros(datetime.now(tz=timezone.utc)) - self.retention * 10**6
+        self._writer.execute("DELETE FROM scenes WHERE timestamp < ?", (oldest,))
+        self._writer.execute("DELETE FROM detections WHERE timestamp < ?", (oldest,))
+
+    def insert_scene(
+        self, scene, timestamp=None, db=None, collection=None, crop=None, frame=None
+    ):
+        """
+        Insert a scene as captured by model into database
+
+        :param scene: Scene: scene description as outputted by model
+        :param timestamp: datetime: time when scene was captured (if not provided, uses now())
+        :param db: str: ignored, there is a single database
+        :param collection: str: collection name (if not provided, uses object default)
+        :param crop: CropGeometry: parts of the frame the scene describes (None: whole frame)
+        :param frame: FrameRef: where the frame is archived (None: not archived)
+        """
+        timestamp = timestamp or datetime.now(tz=timezone.utc)
+        # Pydantic performs validation for us
+        document = MongoDocument(
+            scene=scene, timestamp=timestamp, crop=crop, frame=frame
+        ).dict()
+        return self.insert_documents([document], db=db, collection=collection)
+
+    def insert_documents(self, documents, db=None, collection=None, write_concern=None):
+        """
+        Insert already validated documents in a single transaction.
+
+        Documents whose "_id" is already in the database are skipped, so a
+        batch can be retried after a failure.
+
+        :param documents: list: MongoDocument dicts, as built by insert_scene
+        :param db: str: ignored, there is a single database
+        :param collection: str: collection name (if not provided, uses object default)
+        :param write_concern: dict: ignored, see synchronous in _connect()
+
+        :return: list: the inserted documents
+        """
+        collection = collection or self.default_collection
+        rows = [
+            (
+                collection,
+                to_micros(document["timestamp"]),
+                str(document.get("_id") or uuid.uuid4().hex),
+                json.dumps(document["scene"]),
+                _dumps(document.get("crop")),
+                _dumps(document.get("frame")),
+            )
+            for document in documents
+        ]
+
+        def insert(connection):
+            last_id = connection.execute(
+                "SELECT coalesce(max(id), 0) FROM scenes"
+            ).fetchone()[0]
+            inserted = []
+            for document, row in zip(documents, rows):
+                # rowcount is 0 for documents that were already inserted
+                if connection.execute(INSERT_SCENE, row).rowcount:
+                    inserted.append(document)
+            if inserted:
+                connection.execute(ROLLUP_SIGHTINGS, (last_id, last_id))
+            return inserted
+
+        # seed the rolling counters first, so these scenes aren't counted twice
+        self._seed_sightings(db=db, collection=collection)
+        inserted = self._write(insert)
+        for document in inserted:
+            self._count_sightings(
+                document["scene"], document["timestamp"], db=db, collection=collection
+            )
+        return inserted
+
+    def insert_detections(self, counts, timestamp=None, db=None, collection=None):
+        """
+        Insert the local detector counts of a frame that wasn't described
+
+        :param counts: dict: persons, vehicles and moving counts, see Detections.counts()
+        :param timestamp: datetime: time when the frame was captured (if not provided, uses now())
+        :param db: str: ignored, there is a single database
+        :param collection: str: scene collection name (if not provided, uses object default)
+        """
+        timestamp = timestamp or datetime.now(tz=timezone.utc)
+        document = LocalCountsDocument(timestamp=timestamp, **counts)
+        row = (
+            collection or self.default_collection,
+            to_micros(document.timestamp),
+            document.persons,
+            document.vehicles,
+            document.moving,
+        )
+        self._write(lambda connection: connection.execute(INSERT_DETECTIONS, row))
+
+    def _get_scene(self, collection=None, reverse=True):
+        order = "DESC" if reverse else "ASC"
+        rows = self._read(
+            "SELECT scene, timestamp FROM scenes WHERE collection = ? "
+            f"ORDER BY timestamp {order} LIMIT 1",
+            (collection or self.default_collection,),
+        )
+        if not rows:
+            return {"scene": None, "timestamp": None}
+        scene, timestamp = rows[0]
+        return {"scene": json.loads(scene), "timestamp": from_micros(timestamp)}
+
+    def get_first_scene(self, db=None, collection=None, verbose=False):
+        """
+        Retrieve the first scene from the database
+
+        :param db: str: ignored, there is a single database
+        :param collection: str: collection name (if not provided, uses object default)
+        """
+        return self._get_scene(collection=collection, reverse=False)
+
+    def get_latest_scene(self, db=None, collection=None, verbose=False):
+        """
+        Retrieve the latest scene from the database
+
+        :param db: str: ignored, there is a single database
+        :param collection: str: collection name (if not provided, uses object default)
+        """
+        return self._get_scene(collection=collection)
+
+    @staticmethod
+    def _fields(projection):
+        "Returns the document fields selected by a MongoDB-style projection"
+        if not projection:
+            return list(COLUMNS)
+        included = [field for field, value in projection.items() if value]
+        if included:
+            fields = [field for field in COLUMNS if field in included]
+            if projection.get("_id", True) and "_id" not in fields:
+                fields.insert(0, "_id")
+            return fields
+        return [field for field in COLUMNS if field not in projection]
+
+    def iter_scenes(
+        self,
+        start_time,
+        end_time=None,
+        projection=None,
+        batch_size=500,
+        after=None,
+        limit=None,
+        reverse=False,
+        db=None,
+        collection=None,
+    ):
+        """
+        Lazily yields the documents with timestamp within a range, sorted by timestamp.
+
+        Documents are fetched batch_size at a time, each batch starting after
+        the last document of the previous one, so no read stays open while
+        the caller processes them.
+
+        :param start_time: datetime: left side of timestamp range
+        :param end_time: datetime: right side of timestamp range (if not provided, uses now)
+        :param projection: dict: fields to return (default: all fields)
+        :param batch_size: int: number of documents fetched per query
+        :param after: tuple: (timestamp, _id) of the last document already seen,
+            only documents after it are returned (keyset pagination)
+        :param limit: int: maximum number of documents (default: no limit)
+        :param reverse: bool: newest documents first
+        :param db: str: ignored, there is a single database
+        :param collection: str: collection name (if not provided, uses object default)
+        """
+        start_time, end_time = self._timerange(start_time, end_time)
+        fields = self._fields(projection)
+        # the keyset columns are always selected, last
+        columns = ", ".join(COLUMNS[field] for field in fields)
+        order, op = ("DESC", "<") if reverse else ("ASC", ">")
+        sql = (
+            f"SELECT {columns}, timestamp, doc_id FROM scenes "
+            "WHERE collection = ? AND timestamp >= ? AND timestamp <= ? "
+            f"AND (timestamp, doc_id) {op} (?, ?) "
+            f"ORDER BY timestamp {order}, doc_id {order} LIMIT ?"
+        )
+        collection = collection or self.default_collection
+        if after is not None:
+            key = (to_micros(after[0]), str(after[1]))
+        elif reverse:
+            key = (to_micros(end_time) + 1, "")
+        else:
+            key = (to_micros(start_time) - 1, "")
+
+        remaining = limit
+        while remaining is None or remaining > 0:
+            size = batch_size if remaining is None else min(batch_size, remaining)
+            rows = self._read(
+                sql,
+                (collection, to_micros(start_time), to_micros(end_time), *key, size),
+            )
+            for row in rows:
+                document = {}
+                for field, value in zip(fields, row):
+                    if field == "timestamp":
+                        value = from_micros(value)
+                    elif field in JSON_FIELDS and value is not None:
+                        value = json.loads(value)
+                    document[field] = value
+                yield document
+            if len(rows) < size:
+                return
+            key = rows[-1][-2:]
+            if remaining is not None:
+                remaining -= len(rows)
+
+    def get_sightings_in_timerange(
+        self, start_time, end_time=None, db=None, collection=None
+    ):
+        """
+        Counts persons and vehicles seen within a time range from the hourly rollups.
+
+        The range is widened to whole hours: any hour overlapping it is included.
+
+        :param start_time: datetime: left side of timestamp range
+        :param end_time: datetime: right side of timestamp range (if not provided, uses now)
+        :param db: str: ignored, there is a single database
+        :param collection: str: collection name (if not provided, uses object default)
+
+        :return: tuple of (gender, clothes) and (type, color) Counters
+        """
+        end_time = end_time or datetime.now(tz=timezone.utc)
+        rows = self._read(
+            SELECT_SIGHTINGS,
+            (
+                collection or self.default_collection,
+                to_micros(hour_start(start_time)),
+                to_micros(end_time),
+            ),
+        )
+        persons = Counter()
+        vehicles = Counter()
+        for kind, first, second, count in rows:
+            key = (json.loads(first), json.loads(second))
+            if kind == PERSON:
+                persons[key] += count
+            elif kind == VEHICLE:
+                vehicles[key] += count
+        return persons, vehicles
+
+    def get_detections_in_timerange(
+        self, start_time, end_time=None, db=None, collection=None
+    ):
+        """
+        Retrieve the local detector counts of the frames that weren't described,
+        sorted by timestamp. Together with the scenes they cover every tick.
+
+        :param start_time: datetime: left side of timestamp range
+        :param end_time: datetime: right side of timestamp range (if not provided, uses now)
+        :param db: str: ignored, there is a single database
+        :param collection: str: scene collection name (if not provided, uses object default)
+        """
+        start_time, end_time = self._timerange(start_time, end_time)
+        rows = self._read(
+            SELECT_DETECTIONS,
+            (
+                collection or self.default_collection,
+                to_micros(start_time),
+                to_micros(end_time),
+            ),
+        )
+        return [
+            {
+                "timestamp": from_micros(timestamp),
+                "persons": persons,
+                "vehicles": vehicles,
+                "moving": moving,
+            }
+            for timestamp, persons, vehicles, moving in rows
+        ]
+
+    def close(self):
+        "Closes the writer connection, the readers are closed with their threads"
+        with self._write_lock:
+            self._writer.close()
@@ -0,0 +1,347 @@
+"""
+Module defining what the runner, the web server and the bulk writer need
+from the database storing the scenes.
+
+SceneStore is the interface, implemented by MongoClient (src.mongo_client)
+and SQLiteClient (src.sqlite_client), and holds what doesn't depend on the
+database: the document schemas, the in-memory sighting counters and the
+similarity index. open_store() picks the implementation from a URI:
+
+>> store = open_store("sqlite:///cctv_logger.db")  # a file, no server needed
+>> store = open_store("mongodb://localhost:27017/")
+"""
+
+import threading
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta, timezone
+
+from pydantic import BaseModel as PydanticModel
+
+from src.reid import SightingIndex
+from src.schemas import CropGeometry, FrameRef, Scene
+from src.sightings import RollingSightings
+
+SQLITE_SCHEME = "sqlite://"
+
+
+class MongoDocument(PydanticModel):
+    scene: Scene
+    timestamp: datetime
+    # set when only part of the frame was described, see src.roi
+    crop: CropGeometry | None = None
+    # the encoded frame in the frame archive, see src.archive
+    frame: FrameRef | None = None
+
+
+class LocalCountsDocument(PydanticModel):
+    "Counts of the local detector for a frame that wasn't sent to the model"
+
+    timestamp: datetime
+    persons: int
+    vehicles: int
+    moving: int = 0
+
+
+class StoreUnavailable(Exception):
+    "Raised when the database can't take writes for now, they can be retried later"
+
+
+class SceneStore(ABC):
+    """
+    Scenes, local detector counts and sighting counts of several collections
+    (one per camera).
+
+    Subclasses implement the abstract methods; `db` and `collection` default
+    to default_db and default_collection.
+    """
+
+    default_db = "cctv_logger"
+    default_collection = "camera0"
+
+    def __init__(
+        self, sightings_window=3600, retention=None, sighting_index_window=None
+    ):
+        """
+        :param sightings_window: float: seconds covered by the in-memory rolling
+            sighting counters
+        :param retention: int: seconds after which scenes are deleted
+            (default: scenes are kept forever)
+        :param sighting_index_window: float: seconds of sightings kept in the
+            in-memory similarity index, see src.reid (None disables the index)
+        """
+        self.sightings_window = sightings_window
+        self.retention = retention
+        self.sighting_index_window = sighting_index_window
+        # (db, collection) -> RollingSightings
+        self._rolling_sightings = {}
+        # (db, collection) -> SightingIndex
+        self._sighting_indexes = {}
+        self._lock = threading.Lock()
+
+    @abstractmethod
+    def insert_scene(
+        self, scene, timestamp=None, db=None, collection=None, crop=None, frame=None
+    ):
+        """
+        Insert a scene as captured by model into database
+
+        :param scene: Scene: scene description as outputted by model
+        :param timestamp: datetime: time when scene was captured (if not provided, uses now())
+        :param db: str: database name (if not provided, uses object default)
+        :param collection: str: collection name (if not provided, uses object default)
+        :param crop: CropGeometry: parts of the frame the scene describes (None: whole frame)
+        :param frame: FrameRef: where the frame is archived (None: not archived)
+        """
+
+    @abstractmethod
+    def insert_documents(self, documents, db=None, collection=None, write_concern=None):
+        """
+        Insert already validated documents, in a single round trip or transaction.
+        Documents whose "_id" was already inserted are skipped.
+
+        :param documents: list: MongoDocument dicts, as built by insert_scene
+        :param db: str: database name (if not provided, uses object default)
+        :param collection: str: collection name (if not provided, uses object default)
+        :param write_concern: dict: e.g. {"w": 1, "j": False}, for stores that have one
+
+        Raises StoreUnavailable (or pymongo's ConnectionFailure) when the
+        documents can be retried later.
+        """
+
+    @abstractmethod
+    def insert_detections(self, counts, timestamp=None, db=None, collection=None):
+        """
+        Insert the local detector counts of a frame that wasn't described
+
+        :param counts: dict: persons, vehicles and moving counts, see Detections.counts()
+        :param timestamp: datetime: time when the frame was captured (if not provided, uses now())
+        :param db: str: database name (if not provided, uses object default)
+        :param collection: str: scene collection name (if not provided, uses object default)
+        """
+
+    @abstractmethod
+    def get_first_scene(self, db=None, collection=None, verbose=False):
+        """
+        Retrieve the first scene from the database, as {"scene", "timestamp"}
+        (both None if there is none)
+        """
+
+    @abstractmethod
+    def get_latest_scene(self, db=None, collection=None, verbose=False):
+        """
+        Retrieve the latest scene from the database, as {"scene", "timestamp"}
+        (both None if there is none)
+        """
+
+    @abstractmethod
+    def iter_scenes(
+        self,
+        start_time,
+        end_time=None,
+        projection=None,
+        batch_size=500,
+        after=None,
+        limit=None,
+        reverse=False,
+        db=None,
+        collection=None,
+    ):
+        """
+        Lazily yields the documents with timestamp within a range, sorted by timestamp.
+
+        :param start_time: datetime: left side of timestamp range
+        :param end_time: datetime: right side of timestamp range (if not provided, uses now)
+        :param projection: dict: fields to return (default: all fields)
+        :param batch_size: int: number of documents fetched at a time
+        :param after: tuple: (timestamp, _id) of the last document already seen,
+            only documents after it are returned (keyset pagination), the _id
+            may be given as a string
+        :param limit: int: maximum number of documents (default: no limit)
+        :param reverse: bool: newest documents first
+        :param db: str: database name (if not provided, uses object default)
+        :param collection: str: collection name (if not provided, uses object default)
+        """
+
+    @abstractmethod
+    def get_sightings_in_timerange(
+        self, start_time, end_time=None, db=None, collection=None
+    ):
+        """
+        Counts persons and vehicles seen within a time range from the hourly rollups.
+
+        The range is widened to whole hours: any hour overlapping it is included.
+
+        :return: tuple of (gender, clothes) and (type, color) Counters
+        """
+
+    @abstractmethod
+    def get_detections_in_timerange(
+        self, start_time, end_time=None, db=None, collection=None
+    ):
+        """
+        Retrieve the local detector counts of the frames that weren't described,
+        sorted by timestamp. Together with the scenes they cover every tick.
+        """
+
+    def _count_sightings(self, scene, timestamp, db=None, collection=None):
+        "Updates the in-memory counters and index for an inserted scene"
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.replace(tzinfo=timezone.utc)
+        self.rolling_sightings(db=db, collection=collection).add(scene, timestamp)
+        index = self.sighting_index(db=db, collection=collection)
+        if index is not None:
+            index.add(scene, timestamp)
+
+    def rolling_sightings(self, db=None, collection=None):
+        """
+        Returns the in-memory sliding-window sighting counters of a collection,
+        seeding them from the database the first time.
+
+        :param db: str: database name (if not provided, uses object default)
+        :param collection: str: collection name (if not provided, uses object default)
+        """
+        key = (db or self.default_db, collection or self.default_collection)
+        with self._lock:
+            sightings = self._rolling_sightings.get(key)
+            if sightings is None:
+                sightings = RollingSightings(window=self.sightings_window)
+                start_time = datetime.now(tz=timezone.utc) - timedelta(
+                    seconds=self.sightings_window
+                )
+                sightings.seed(
+                    self.get_scenes_in_timerange(
+                        start_time, db=db, collection=collection, verbose=True
+                    )
+                )
+                self._rolling_sightings[key] = sightings
+            return sightings
+
+    def sighting_index(self, db=None, collection=None):
+        """
+        Returns the similarity index of the sightings of a collection, seeding
+        it from the database the first time, or None if the index is disabled.
+
+        :param db: str: database name (if not provided, uses object default)
+        :param collection: str: collection name (if not provided, uses object default)
+        """
+        if self.sighting_index_window is None:
+            return None
+        key = (db or self.default_db, collection or self.default_collection)
+        with self._lock:
+            index = self._sighting_indexes.get(key)
+            if index is None:
+                index = SightingIndex(window=self.sighting_index_window)
+                start_time = datetime.now(tz=timezone.utc) - timedelta(
+                    seconds=self.sighting_index_window
+                )
+                # can be weeks of scenes, stream them rather than load a list
+                index.seed(
+                    (doc["scene"], doc["timestamp"])
+                    for doc in self.iter_scenes(
+                        start_time,
+                        projection={"scene": True, "timestamp": True},
+                        db=db,
+                        collection=collection,
+                    )
+                )
+                self._sighting_indexes[key] = index
+            return index
+
+    def _seed_sightings(self, db=None, collection=None):
+        "Seeds the in-memory sighting counters and index, if not done yet"
+        self.rolling_sightings(db=db, collection=collection)
+        self.sighting_index(db=db, collection=collection)
+
+    def get_scenes_in_timerange(
+        self, start_time, end_time=None, db=None, collection=None, verbose=False
+    ):
+        """
+        Retrieve the scenes from the database with timestamp within a range.
+
+        :param start_time: datetime: left side of timestamp range
+        :param end_time: datetime: right side of timestamp range (if not provided, uses now)
+        :param db: str: database name (if not provided, uses object default)
+        :param collection: str: collection name (if not provided, uses object default)
+        """
+        res = self.iter_scenes(
+            start_time,
+            end_time,
+            projection={"scene": True, "timestamp": True},
+            db=db,
+            collection=collection,
+        )
+        if verbose:
+            return [(doc["scene"], doc["timestamp"]) for doc in res]
+        return [doc["scene"] for doc in res]
+
+    def get_scenes_page(
+        self,
+        start_time,
+        end_time=None,
+        after=None,
+        page_size=100,
+        projection=None,
+        reverse=False,
+        db=None,
+        collection=None,
+    ):
+        """
+        Retrieve one page of documents with timestamp within a range.
+
+        :param after: tuple: cursor returned with the previous page (None for the first page)
+        :param page_size: int: maximum number of documents in the page
+
+        See iter_scenes() for the other parameters.
+
+        :return: tuple of (list of documents, cursor for the next page or None if last)
+        """
+        if projection is not None:
+            # the cursor is built from these
+            projection = {**projection, "_id": True, "timestamp": True}
+        docs = list(
+            self.iter_scenes(
+                start_time,
+                end_time,
+                projection=projection,
+                batch_size=page_size + 1,
+                after=after,
+                limit=page_size + 1,
+                reverse=reverse,
+                db=db,
+                collection=collection,
+            )
+        )
+        if len(docs) <= page_size:
+            return docs, None
+        docs = docs[:page_size]
+        return docs, (docs[-1]["timestamp"], docs[-1]["_id"])
+
+    @staticmethod
+    def _timerange(start_time, end_time=None):
+        "Returns the range as timezone-aware datetimes (end defaults to now)"
+        end_time = end_time or datetime.now(tz=timezone.utc)
+        # Might need to convert times if timezone-naive to timezone-aware
+        if start_time.tzinfo is None:
+            start_time = datetime.fromtimestamp(start_time.timestamp(), timezone.utc)
+        if end_time.tzinfo is None:
+            end_time = datetime.fromtimestamp(end_time.timestamp(), timezone.utc)
+        assert start_time < end_time, "Not a valid timestamp range!"
+        return start_time, end_time
+
+
+def open_store(uri=None, **options):
+    """
+    Returns the store for a URI: "sqlite:///<path>" (or "sqlite:///:memory:")
+    for SQLite, anything else for MongoDB (default: local instance).
+
+    :param options: passed on to the store, see SceneStore
+    """
+    if uri is not None and uri.startswith(SQLITE_SCHEME):
+        from src.sqlite_client import SQLiteClient
+
+        # sqlite:///relative/path.db, sqlite:////absolute/path.db
+        return SQLiteClient(uri[len(SQLITE_SCHEME) + 1 :], **options)
+
+    from src.mongo_client import MongoClient
+
+    return MongoClient(uri, **options)
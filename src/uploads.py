@@ -0,0 +1,203 @@
+"""
+Module for reusing the images uploaded to the Gemini File API.
+
+Uploaded files are keyed by the SHA-256 of their content, so describing
+the same image again (a reference frame, a rerun over a directory) reuses
+the remote file instead of uploading it again. Files are forgotten before
+the server deletes them (48 hours after the upload), and the least
+recently used ones are deleted once the cache is full. Deletions run on a
+pool of worker threads, so neither eviction nor clear() waits for them
+one by one.
+
+>> uploads = UploadCache()
+>> uploaded_file = uploads.get(image_path)  # uploads on a miss
+>> uploads.clear()  # deletes every remote file, in parallel
+"""
+
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+
+import google.generativeai as genai
+
+from src.metrics import REGISTRY
+
+LOG = logging.getLogger("cctv_logger")
+
+UPLOADS = REGISTRY.counter(
+    "cctv_uploads_total",
+    "Images described from a path, by whether their upload was reused",
+    ("result",),
+)
+DELETIONS = REGISTRY.counter(
+    "cctv_upload_deletions_total",
+    "Uploaded files deleted, by result",
+    ("result",),
+)
+
+# the File API deletes uploads after 48 hours
+SERVER_TTL = 48 * 3600
+# files are forgotten this long before the server deletes them, so a request
+# never refers to a file that is gone by the time it is read
+EXPIRY_MARGIN = 3600
+
+
+def file_digest(path, chunk_size=2**20):
+    "SHA-256 of a file's content"
+    digest = hashlib.sha256()
+    with open(path, "rb") as image_file:
+        while chunk := image_file.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class UploadCache:
+    """
+    Uploaded files by content hash, with LRU eviction and expiry.
+
+    Thread-safe: concurrent get() calls for the same content wait for a
+    single upload.
+    """
+
+    def __init__(self, capacity=1000, ttl=SERVER_TTL - EXPIRY_MARGIN, delete_workers=8):
+        """
+        :param capacity: int: maximum number of files kept, the least recently
+            used are deleted beyond it
+        :param ttl: float: seconds after which a file is forgotten (it is left for
+            the server to delete), shortened to the file's own expiration time
+        :param delete_workers: int: threads deleting evicted files
+        """
+        self.capacity = capacity
+        self.ttl = ttl
+        # digest -> (Future of the uploaded file, expiry as unix time)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._deleter = ThreadPoolExecutor(
+            max_workers=delete_workers, thread_name_prefix="upload-cleanup"
+        )
+        self._deletions = set()
+
+    def _expiry(self, uploaded_file):
+        expiry = time.time() + self.ttl
+        expiration_time = getattr(uploaded_file, "expiration_time", None)
+        if isinstance(expiration_time, datetime):
+            if expiration_time.tzinfo is None:
+                expiration_time = expiration_time.replace(tzinfo=timezone.utc)
+            expiry = min(expiry, expiration_time.timestamp() - EXPIRY_MARGIN)
+        return expiry
+
+    def get(self, path, verbose=False):
+        """
+        Returns the uploaded file with the content of `path`, uploading it if
+        it isn't in the cache.
+
+        :param path: str: image path
+        :param verbose: bool: whether to print uploads
+        """
+        digest = file_digest(path)
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is not None and entry[1] > time.time():
+                self._entries.move_to_end(digest)
+                UPLOADS.inc(result="reused")
+                upload = entry[0]
+            else:
+                # an expired file is left for the server to delete
+                upload = Future()
+                self._entries[digest] = (upload, float("inf"))
+                self._entries.move_to_end(digest)
+                entry = None
+        if entry is not None:
+            return upload.result()
+
+        UPLOADS.inc(result="uploaded")
+        try:
+            uploaded_file = genai.upload_file(path=path)
+        except Exception as error:
+            with self._lock:
+                if self._entries.get(digest, (None,))[0] is upload:
+                    del self._entries[digest]
+            upload.set_exception(error)
+            raise
+        if verbose:
+            print(
+                f"Uploaded file '{uploaded_file.display_name}' as: {uploaded_file.uri}."
+            )
+        upload.set_result(uploaded_file)
+        with self._lock:
+            if self._entries.get(digest, (None,))[0] is upload:
+                self._entries[digest] = (upload, self._expiry(uploaded_file))
+            evicted = self._evict()
+        self._delete(evicted)
+        return uploaded_file
+
+    def _evict(self):
+        "Removes the least recently used uploads beyond capacity, returns their files"
+        evicted = []
+        while len(self._entries) > self.capacity:
+            _, (upload, _) = self._entries.popitem(last=False)
+            evicted.append(upload)
+        return evicted
+
+    def _delete(self, uploads):
+        for upload in uploads:
+            future = self._deleter.submit(self._delete_file, upload)
+            with self._lock:
+                self._deletions.add(future)
+            future.add_done_callback(self._deletion_done)
+
+    def _deletion_done(self, future):
+        with self._lock:
+            self._deletions.discard(future)
+
+    @staticmethod
+    def _delete_file(upload):
+        try:
+            # waits for uploads still in progress
+            name = upload.result().name
+        except Exception:
+            return
+        try:
+            genai.delete_file(name)
+        except Exception:
+            DELETIONS.inc(result="error")
+            LOG.exception(f"Could not delete uploaded file {name}")
+        else:
+            DELETIONS.inc(result="ok")
+
+    def files(self):
+        "Returns the uploaded files in the cache, least recently used first"
+        with self._lock:
+            uploads = [upload for upload, _ in self._entries.values()]
+        return [upload.result() for upload in uploads if upload.done()]
+
+    def clear(self, timeout=None):
+        """
+        Deletes every uploaded file, in parallel, and waits for the deletions.
+
+        :param timeout: float: seconds to wait for the deletions (None: no limit)
+        :return: int: number of files deleted or being deleted
+        """
+        with self._lock:
+            uploads = [upload for upload, _ in self._entries.values()]
+            self._entries.clear()
+        self._delete(uploads)
+        with self._lock:
+            pending = list(self._deletions)
+        wait(pending, timeout=timeout)
+        return len(uploads)
+
+    def close(self):
+        self.clear()
+        self._deleter.shutdown(wait=True)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        with self._lock:
+            return {"files": len(self._entries), "deleting": len(self._deletions)}
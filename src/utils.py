@@ -1,14 +1,102 @@
+import threading
 from collections import Counter
 from datetime import datetime, timezone
 
 import cv2
 import google.generativeai as genai
+import numpy as np
 
 
-def convert_frame_to_blob(frame: "np.ndarray") -> genai.protos.Blob:
-    """Converts an array representing a frame to a Blob object."""
-    _, buffer = cv2.imencode(".png", frame)
-    return genai.protos.Blob(mime_type="image/png", data=buffer.tobytes())
+class EncodingProfile:
+    """
+    How frames are prepared before being uploaded to the model.
+
+    Downscaling and lossy compression make encoding faster and the upload
+    smaller; the model doesn't need full-resolution PNGs to describe a scene.
+    """
+
+    FORMATS = {
+        "png": (".png", "image/png", cv2.IMWRITE_PNG_COMPRESSION),
+        "jpeg": (".jpg", "image/jpeg", cv2.IMWRITE_JPEG_QUALITY),
+        "webp": (".webp", "image/webp", cv2.IMWRITE_WEBP_QUALITY),
+    }
+
+    def __init__(
+        self, image_format="png", quality=None, max_side=None, night_grayscale=None
+    ):
+        """
+        :param image_format: str: one of "png", "jpeg", "webp"
+        :param quality: int: JPEG/WebP quality (0-100) or PNG compression level (0-9)
+        :param max_side: int: downscale so that the longest side is at most this many pixels
+        :param night_grayscale: float: encode in grayscale when the mean brightness
+            (0-255) is below this value, colour carries no information at night
+        """
+        assert image_format in self.FORMATS, f"Unsupported format: {image_format}"
+        self.image_format = image_format
+        self.quality = quality
+        self.max_side = max_side
+        self.night_grayscale = night_grayscale
+        self.extension, self.mime_type, quality_flag = self.FORMATS[image_format]
+        self.params = [quality_flag, quality] if quality is not None else []
+        # scratch arrays reused between calls, one set per thread
+        self._buffers = threading.local()
+
+    def __repr__(self):
+        return (
+            f"EncodingProfile({self.image_format!r}, quality={self.quality}, "
+            f"max_side={self.max_side}, night_grayscale={self.night_grayscale})"
+        )
+
+    def _scratch(self, name, shape, dtype):
+        "Returns a reusable array of the given shape, allocating only when it changes"
+        buffer = getattr(self._buffers, name, None)
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = np.empty(shape, dtype=dtype)
+            setattr(self._buffers, name, buffer)
+        return buffer
+
+    def prepare(self, frame: np.ndarray) -> np.ndarray:
+        "Resizes and converts the frame according to the profile"
+        height, width = frame.shape[:2]
+        if self.max_side and max(height, width) > self.max_side:
+            scale = self.max_side / max(height, width)
+            size = (round(width * scale), round(height * scale))
+            resized = self._scratch(
+                "resized", (size[1], size[0]) + frame.shape[2:], frame.dtype
+            )
+            frame = cv2.resize(frame, size, dst=resized, interpolation=cv2.INTER_AREA)
+
+        if self.night_grayscale is not None and frame.ndim == 3:
+            gray = self._scratch("gray", frame.shape[:2], frame.dtype)
+            cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=gray)
+            if gray.mean() < self.night_grayscale:
+                frame = gray
+        return frame
+
+    def encode(self, frame: np.ndarray) -> bytes:
+        _, buffer = cv2.imencode(self.extension, self.prepare(frame), self.params)
+        return buffer.tobytes()
+
+
+ENCODING_PROFILES = {
+    # the original behaviour: full resolution, lossless
+    "lossless": EncodingProfile("png"),
+    "balanced": EncodingProfile("jpeg", quality=85, max_side=1280, night_grayscale=40),
+    "small": EncodingProfile("webp", quality=70, max_side=768, night_grayscale=40),
+}
+DEFAULT_ENCODING_PROFILE = ENCODING_PROFILES["lossless"]
+
+
+def convert_frame_to_blob(
+    frame: "np.ndarray", profile: EncodingProfile = None
+) -> genai.protos.Blob:
+    """Converts an array representing a frame to a Blob object.
+
+    :param frame: np.ndarray: BGR frame
+    :param profile: EncodingProfile: how to encode it (default: full-resolution PNG)
+    """
+    profile = profile or DEFAULT_ENCODING_PROFILE
+    return genai.protos.Blob(mime_type=profile.mime_type, data=profile.encode(frame))
 
 
 def today_start():
@@ -20,6 +108,19 @@ def sanitise_string(s):
     return s.replace("t-", "t").replace(" and ", ", ").replace("a ", "")
 
 
+def scene_sighting_keys(scene):
+    """
+    Returns the (gender, clothes) keys of the persons and the (type, color)
+    keys of the vehicles in a scene, as used to count repeat sightings.
+    """
+    persons = [
+        (p.get("gender"), sanitise_string(p.get("clothes") or ""))
+        for p in scene.get("persons") or []
+    ]
+    vehicles = [(v.get("type"), v.get("color")) for v in scene.get("vehicles") or []]
+    return persons, vehicles
+
+
 def summarise_scenes(scenes):
     """
     Returns a tuple with summarised persons and vehicles for collection of scenes.
@@ -28,12 +129,8 @@ def summarise_scenes(scenes):
     persons = Counter()
     vehicles = Counter()
     for scene in scenes:
-        persons += Counter(
-            (p.get("gender"), sanitise_string(p.get("clothes")))
-            for p in scene.get("persons")
-        )
-        vehicles += Counter(
-            (v.get("type"), v.get("color")) for v in scene.get("vehicles")
-        )
+        scene_persons, scene_vehicles = scene_sighting_keys(scene)
+        persons.update(scene_persons)
+        vehicles.update(scene_vehicles)
 
     return persons, vehicles
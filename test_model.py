@@ -6,12 +6,12 @@ TODO: make a proper test out of this
 
 import argparse
 import google.generativeai as genai
-import json
 
 from src.camera import Camera, show_frame
 from src.model import Model, ModelChoices
 from src.utils import convert_frame_to_blob
-from src.mongo_client import MongoClient, Scene
+from src.store import open_store
+from src.parsing import parse_scene
 
 
 def parse_args():
@@ -66,15 +66,9 @@ def describe_from_live_feed(model):
 
 
 def insert_database_responses(responses, db_uri=None):
-    client = MongoClient(uri=db_uri)
+    client = open_store(db_uri)
     for res in responses:
-        scene = Scene(json.loads(res))
-        # workaround when response is missing parts
-        # parts of the schema
-        for key in Scene.__required_keys__:
-            if key not in scene:
-                scene[key] = []
-        client.insert_scene(scene)
+        client.insert_scene(parse_scene(res))
 
 
 def main():
@@ -0,0 +1,65 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from src.reid import DEFAULT_THRESHOLD, HashedNgramVectorizer, SightingIndex
+from src.sightings import PERSON
+
+
+def similarity(first, second):
+    vectorizer = HashedNgramVectorizer()
+    return float(vectorizer.vector(first) @ vectorizer.vector(second))
+
+
+@pytest.mark.parametrize(
+    "first, second",
+    [
+        ("blue jacket and jeans", "black jacket and jeans"),
+        ("white t-shirt and black shorts", "black t-shirt and white shorts"),
+        ("red hoodie", "green hoodie"),
+    ],
+)
+def test_different_colours_dont_match(first, second):
+    assert similarity(first, second) < DEFAULT_THRESHOLD
+
+
+@pytest.mark.parametrize(
+    "first, second",
+    [
+        ("blue jacket and jeans", "wearing a blue jacket, jeans"),
+        ("man in a blue jacket", "man wearing blue jacket and jeans"),
+        ("grey suit", "gray suit"),
+    ],
+)
+def test_rewordings_match(first, second):
+    assert similarity(first, second) >= DEFAULT_THRESHOLD
+
+
+def test_repeated_keeps_colours_apart():
+    now = datetime.now(tz=timezone.utc)
+    index = SightingIndex()
+    for minutes, clothes in enumerate(
+        [
+            "blue jacket and jeans",
+            "wearing a blue jacket, jeans",
+            "black jacket and jeans",
+            "white t-shirt and black shorts",
+            "black t-shirt and white shorts",
+            "",
+        ]
+    ):
+        index.add(
+            {"persons": [{"gender": "male", "clothes": clothes}], "vehicles": []},
+            now - timedelta(minutes=minutes),
+        )
+
+    persons, vehicles = index.repeated(window=3600, end_time=now)
+    assert persons == {
+        ("male", "blue jacket and jeans"): 2,
+        ("male", "black jacket and jeans"): 1,
+        ("male", "white t-shirt and black shorts"): 1,
+        ("male", "black t-shirt and white shorts"): 1,
+        ("male", ""): 1,
+    }
+    assert vehicles == {}
+    assert index.count(PERSON, "blue jacket, jeans", "male", now=now) == 2
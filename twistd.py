@@ -19,6 +19,7 @@ application logic (web servers, SSH clients, etc.).
 """
 
 import logging
+from datetime import time
 
 # if '.' is not added to PYTHONPATH,
 # twistd won't do it for you so you'll get import errors.
@@ -27,26 +28,235 @@ import sys
 sys.path.append(".")
 
 from twisted.application import internet, service
+from twisted.internet import reactor
 from twisted.python import log
 from twisted.web import server
 
-from src.services import CCTVLoggerRunner, CCTVLoggerServer
+from src.archive import FrameArchive
+from src.bulk_writer import BulkSceneWriter
+from src.cache import SceneCache
+from src.cascade import ModelCascade
+from src.inference import InferenceEngine
+from src.camera import VIDEO_CAPTURING_DEVICE_ID
+from src.detector import LocalDetector
+from src.metrics import SamplingProfiler
+from src.model import MODEL_QUOTAS, Model, ModelChoices
+from src.roi import RegionCropper
+from src.scheduler import AdaptiveScheduler, SamplingProfile
+from src.services import (
+    CCTVLoggerServer,
+    LatestScenes,
+    MultiCameraRunner,
+    SceneWriterService,
+)
+from src.store import open_store
+from src.utils import ENCODING_PROFILES
 
-TIME_INTERVAL = 5
+# how often each camera is sampled, by local time of day: every min_interval
+# seconds while persons, vehicles or motion are seen, then backing off by
+# SAMPLING_BACKOFF with every static frame, up to max_interval
+SAMPLING_PROFILES = [
+    SamplingProfile(time(7), min_interval=2, max_interval=30, weight=3),
+    SamplingProfile(time(22), min_interval=5, max_interval=120, weight=1),
+]
+SAMPLING_BACKOFF = 2
+# model requests per day, by all cameras, spread across the day by the
+# profiles' weights; batches count once, retries, hedges and escalations
+# to PRO count too (None: no budget, only the quotas apply)
+DAILY_MODEL_BUDGET = 20_000
+# seconds between checks for cameras due for a sample
+SCHEDULER_STEP = 0.5
+# camera name -> device index, RTSP URL or video file.
+# Scenes from each camera are stored in a collection named after it.
+CAMERA_SOURCES = {"camera0": VIDEO_CAPTURING_DEVICE_ID}
+# maximum number of model requests running at once, shared by all cameras
+INFERENCE_CONCURRENCY = 4
+# every frame goes to FLASH, only frames with persons, vehicles or unclear
+# answers are described again by PRO (False: every frame goes to PRO)
+MODEL_CASCADE = True
+# stream the model's responses and publish partial scenes, marked "partial",
+# as soon as persons and vehicles come in (batches are never streamed)
+STREAM_RESPONSES = True
+# seconds before a model request is abandoned and retried, up to MODEL_RETRIES times
+MODEL_DEADLINE = 60
+MODEL_RETRIES = 3
+# send a duplicate request when one is slower than this quantile of recent ones
+# (None disables hedging)
+MODEL_HEDGE_QUANTILE = None
+# database the scenes are stored in: a MongoDB connection string (None: local
+# instance) or "sqlite:///<path>" for a database file, without a server
+STORE_URI = None
+# scenes older than this many seconds are deleted (None keeps them forever)
+SCENE_RETENTION = None
+# seconds of sightings kept in memory to count repeat visitors by similarity
+# of their descriptions, at /summary and /sightings (None: exact matches only)
+SIGHTING_INDEX_WINDOW = 7 * 86400
+# scenes are inserted in batches of BULK_WRITE_SIZE, or after BULK_WRITE_MAX_AGE seconds
+BULK_WRITE_SIZE = 20
+BULK_WRITE_MAX_AGE = 10
+# grab frames continuously on a background thread so each tick gets the freshest one
+CAMERA_GRABBING = True
+# see src.utils.ENCODING_PROFILES, compare them with benchmark_encoding.py
+ENCODING_PROFILE = "balanced"
+# frames described per model request, an incomplete batch is sent after BATCH_MAX_AGE seconds
+BATCH_SIZE = 1
+BATCH_MAX_AGE = 60
+# mean pixel difference (0-255) between consecutive frames needed to call the model
+MOTION_THRESHOLD = 8.0
+# responses for near-identical frames are reused for up to an hour
+SCENE_CACHE_TTL = 3600
+SCENE_CACHE_PATH = "scene_cache_{camera}.db"
+# send only the regions that differ from the background, instead of whole frames
+CROP_REGIONS = True
+# count persons and vehicles on the CPU and only call the model when the counts
+# change, or every LOCAL_DETECTION_REFRESH seconds
+LOCAL_DETECTION = True
+LOCAL_DETECTION_REFRESH = 600
+# samples the detector learns the background from: it only sees the sampled
+# frames, so this is minutes rather than seconds of video
+LOCAL_DETECTION_HISTORY = 20
+# SSD detection model (and its config) for cv2.dnn, e.g. MobileNet-SSD
+# (None: HOG people detector)
+LOCAL_DETECTION_MODEL = None
+LOCAL_DETECTION_CONFIG = None
+# frames sent to the model are kept on disk, served at /frame and referenced
+# from their scenes; segments rotate by size or age (None: frames aren't kept)
+FRAME_ARCHIVE_PATH = "frames/{camera}"
+FRAME_SEGMENT_BYTES = 256 * 2**20
+FRAME_SEGMENT_AGE = 3600
+# frames are deleted after FRAME_RETENTION seconds, or sooner when the archive
+# of a camera outgrows FRAME_ARCHIVE_BYTES, whatever the scenes' retention
+# (None: no limit)
+FRAME_RETENTION = 7 * 86400
+FRAME_ARCHIVE_BYTES = 20 * 2**30
+# seconds between stack samples of the pipeline threads, served at /profile
+# (None disables the profiler)
+PROFILER_INTERVAL = None
 
 logging.basicConfig(level=logging.INFO)
 
 top_service = service.MultiService()
 
 # service to take logs
-cctv_logger_runner = CCTVLoggerRunner()
+scene_store = open_store(
+    STORE_URI, retention=SCENE_RETENTION, sighting_index_window=SIGHTING_INDEX_WINDOW
+)
+scene_writer = BulkSceneWriter(
+    scene_store, max_docs=BULK_WRITE_SIZE, max_age=BULK_WRITE_MAX_AGE
+)
+# closes the writer once the pipeline, which adds scenes to it, has stopped
+scene_writer_service = SceneWriterService(scene_writer)
+scene_writer_service.setServiceParent(top_service)
+# the runner publishes scenes here, the web server serves them from memory
+latest_scenes = LatestScenes()
+
+
+# charged by the inference engines for every request they send
+scheduler = AdaptiveScheduler(
+    profiles=SAMPLING_PROFILES,
+    daily_budget=DAILY_MODEL_BUDGET,
+    backoff=SAMPLING_BACKOFF,
+    motion_threshold=MOTION_THRESHOLD,
+)
+
+
+def inference_engine(model_choice):
+    # requests wait for the quota rather than fail with 429s
+    requests_per_minute, tokens_per_minute = MODEL_QUOTAS[model_choice]
+    return InferenceEngine(
+        # a little longer than the deadline, to free abandoned requests' slots
+        Model(model_choice, request_timeout=MODEL_DEADLINE + 10),
+        max_in_flight=INFERENCE_CONCURRENCY,
+        requests_per_minute=requests_per_minute,
+        tokens_per_minute=tokens_per_minute,
+        deadline=MODEL_DEADLINE,
+        max_retries=MODEL_RETRIES,
+        hedge_quantile=MODEL_HEDGE_QUANTILE,
+        budget=scheduler.budget,
+    )
+
+
+frame_archives = {}
+if FRAME_ARCHIVE_PATH is not None:
+    frame_archives = {
+        camera: FrameArchive(
+            FRAME_ARCHIVE_PATH.format(camera=camera),
+            max_segment_bytes=FRAME_SEGMENT_BYTES,
+            max_segment_age=FRAME_SEGMENT_AGE,
+            retention=FRAME_RETENTION,
+            max_bytes=FRAME_ARCHIVE_BYTES,
+        )
+        for camera in CAMERA_SOURCES
+    }
+    for archive in frame_archives.values():
+        # after the scene writer, whose scenes reference the frames
+        reactor.addSystemEventTrigger("after", "shutdown", archive.close)
+
+
+def local_detector(camera):
+    return LocalDetector(
+        model_path=LOCAL_DETECTION_MODEL,
+        config_path=LOCAL_DETECTION_CONFIG,
+        history=LOCAL_DETECTION_HISTORY,
+    )
+
+
+# shared by all cameras, so the quotas are shared as well
+if MODEL_CASCADE:
+    model = ModelCascade(
+        inference_engine(ModelChoices.FLASH), inference_engine(ModelChoices.PRO)
+    )
+else:
+    model = inference_engine(ModelChoices.PRO)
+cctv_logger_runner = MultiCameraRunner(
+    CAMERA_SOURCES,
+    inference_concurrency=INFERENCE_CONCURRENCY,
+    grabbing=CAMERA_GRABBING,
+    scene_cache_factory=lambda camera: SceneCache(
+        ttl=SCENE_CACHE_TTL, path=SCENE_CACHE_PATH.format(camera=camera)
+    ),
+    region_cropper_factory=(lambda camera: RegionCropper()) if CROP_REGIONS else None,
+    local_detector_factory=local_detector if LOCAL_DETECTION else None,
+    frame_archive_factory=frame_archives.get if frame_archives else None,
+    detection_refresh=LOCAL_DETECTION_REFRESH,
+    motion_threshold=MOTION_THRESHOLD,
+    encoding_profile=ENCODING_PROFILES[ENCODING_PROFILE],
+    batch_size=BATCH_SIZE,
+    batch_max_age=BATCH_MAX_AGE,
+    streaming=STREAM_RESPONSES,
+    model=model,
+    client=scene_store,
+    writer=scene_writer,
+    latest_scenes=latest_scenes,
+    scheduler=scheduler,
+)
+# capture, model and database calls block, so they run on the pipeline's
+# worker threads and the reactor stays free to serve requests
+cctv_logger_runner.pipeline.setServiceParent(scene_writer_service)
 cctv_logger_service = internet.TimerService(
-    step=TIME_INTERVAL, callable=cctv_logger_runner.run
+    step=SCHEDULER_STEP, callable=cctv_logger_runner.tick
 )
 cctv_logger_service.setServiceParent(top_service)
 
+profiler = None
+if PROFILER_INTERVAL is not None:
+    profiler = SamplingProfiler(
+        interval=PROFILER_INTERVAL,
+        thread_prefix=f"{cctv_logger_runner.pipeline.name}-",
+    )
+    reactor.callWhenRunning(profiler.start)
+    reactor.addSystemEventTrigger("before", "shutdown", profiler.stop)
+
 # service to listen for connections
-cctv_logger_server = server.Site(CCTVLoggerServer())
+# sharing the runner's client gives the server its rolling sighting counters
+cctv_logger_server = server.Site(
+    CCTVLoggerServer(
+        client=cctv_logger_runner.client,
+        latest_scenes=latest_scenes,
+        profiler=profiler,
+        frame_archives=frame_archives or None,
+    )
+)
 tcp_service = internet.TCPServer(8080, cctv_logger_server)
 tcp_service.setServiceParent(top_service)
 